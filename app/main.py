@@ -3,29 +3,10 @@
 
 from __future__ import annotations
 
-def ensure_auth_schema():
-    """Create user_passwords table if not exists for UID password binding."""
-    conn = get_conn()
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS public.user_passwords (
-                        uid TEXT PRIMARY KEY,
-                        password_hash TEXT NOT NULL,
-                        password_cipher BYTEA NOT NULL,
-                        password_iv BYTEA NOT NULL,
-                        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-                        updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-                    );
-                    CREATE INDEX IF NOT EXISTS user_passwords_uid_idx ON public.user_passwords(uid);
-                """)
-    finally:
-        put_conn(conn)
-
 import bcrypt
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 import base64
+import hashlib
 import asyncio
 
 import re
@@ -60,18 +41,26 @@ def _can_deduct(balance: float, amount: float) -> bool:
 import os
 import json
 import time
+import calendar
 import logging
 from decimal import Decimal
 from typing import Any, Dict, List, Optional, Tuple
 
-import requests
+import sys
+import select
+import threading
+import traceback
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait as _wait_futures
+
+import httpx
 import psycopg2
-from psycopg2 import pool
-from psycopg2.extras import RealDictCursor, Json
+from psycopg2.extras import RealDictCursor, Json, execute_values
 
 from fastapi import FastAPI, HTTPException, Header, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, StreamingResponse
 from pydantic import BaseModel, Field
 
 # =========================
@@ -95,26 +84,575 @@ PAYTABS_BASE_URL = (os.getenv("PAYTABS_BASE_URL") or "").strip().rstrip("/")
 PAYTABS_CURRENCY = (os.getenv("PAYTABS_CURRENCY") or "IQD").strip() or "IQD"
 BACKEND_PUBLIC_URL = (os.getenv("BACKEND_PUBLIC_URL") or "").strip().rstrip("/")
 
-POOL_MIN, POOL_MAX = 1, int(os.getenv("DB_POOL_MAX", "5"))
-dbpool: pool.SimpleConnectionPool = pool.SimpleConnectionPool(POOL_MIN, POOL_MAX, dsn=DATABASE_URL)
+# =========================
+# Logging
+# =========================
+logger = logging.getLogger("smm")
+logging.basicConfig(level=logging.INFO)
 
-def get_conn() -> psycopg2.extensions.connection:
-    """Get a healthy connection from the pool (auto-reopen if closed)."""
-    conn = dbpool.getconn()
+# =========================
+# Outbound HTTP
+# =========================
+# One keep-alive pool per remote destination instead of a fresh connection
+# (TCP + TLS handshake) per call. Each destination has its own timeout and
+# connection limit (HTTP_<NAME>_TIMEOUT / HTTP_<NAME>_POOL) and is negotiated
+# over HTTP/2 when the h2 package is installed and the remote supports it.
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "1") == "1"
+
+def _h2_available() -> bool:
     try:
-        if getattr(conn, "closed", 0):
-            raise Exception("connection closed")
-        with conn.cursor() as cur:
-            cur.execute("SELECT 1")
+        import h2  # noqa: F401
+        return True
     except Exception:
+        return False
+
+class HttpDestination:
+    """
+    Shared httpx clients for one destination: a sync client for worker threads
+    and blocking endpoints, and an async client for coroutines. The async client
+    is created on first use and rebuilt if the running event loop changes.
+    """
+
+    def __init__(self, name: str, timeout: float, pool: int):
+        env = name.upper()
+        self.name = name
+        self.timeout = float(os.getenv(f"HTTP_{env}_TIMEOUT", str(timeout)))
+        self.pool = int(os.getenv(f"HTTP_{env}_POOL", str(pool)))
+        self.http2 = HTTP2_ENABLED and _h2_available()
+        self._lock = threading.Lock()
+        self._client: Optional[httpx.Client] = None
+        self._aclient: Optional[httpx.AsyncClient] = None
+        self._aloop = None
+        self._requests = 0
+        self._errors = 0
+
+    def _options(self) -> Dict[str, Any]:
+        return {
+            "http2": self.http2,
+            "timeout": httpx.Timeout(self.timeout, connect=min(self.timeout, 5.0)),
+            "limits": httpx.Limits(max_connections=self.pool, max_keepalive_connections=self.pool),
+            "follow_redirects": True,
+        }
+
+    @property
+    def client(self) -> httpx.Client:
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = httpx.Client(**self._options())
+        return self._client
+
+    def _async_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        if self._aclient is None or self._aloop is not loop:
+            self._aclient = httpx.AsyncClient(**self._options())
+            self._aloop = loop
+        return self._aclient
+
+    def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        self._requests += 1
+        try:
+            return self.client.request(method, url, **kwargs)
+        except Exception:
+            self._errors += 1
+            raise
+
+    def post(self, url: str, **kwargs) -> httpx.Response:
+        return self.request("POST", url, **kwargs)
+
+    async def arequest(self, method: str, url: str, **kwargs) -> httpx.Response:
+        self._requests += 1
+        try:
+            return await self._async_client().request(method, url, **kwargs)
+        except Exception:
+            self._errors += 1
+            raise
+
+    async def apost(self, url: str, **kwargs) -> httpx.Response:
+        return await self.arequest("POST", url, **kwargs)
+
+    async def aclose(self) -> None:
+        client, self._client = self._client, None
+        aclient, self._aclient = self._aclient, None
+        if client is not None:
+            client.close()
+        if aclient is not None and self._aloop is asyncio.get_running_loop():
+            await aclient.aclose()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"timeout": self.timeout, "pool": self.pool, "http2": self.http2,
+                "requests": self._requests, "errors": self._errors}
+
+_http_destinations: Dict[str, HttpDestination] = {
+    "fcm": HttpDestination("fcm", 10, int(os.getenv("FCM_HTTP_POOL", "32"))),
+    "oauth": HttpDestination("oauth", 10, 2),
+    "provider": HttpDestination("provider", 25, 16),
+    "paytabs": HttpDestination("paytabs", 20, 4),
+}
+
+def _http(name: str) -> HttpDestination:
+    return _http_destinations[name]
+
+# =========================
+# DB connection pool
+# =========================
+POOL_MIN, POOL_MAX = 1, int(os.getenv("DB_POOL_MAX", "5"))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))              # max seconds a caller waits for a connection
+POOL_MAX_WAITERS = int(os.getenv("DB_POOL_MAX_WAITERS", "64"))        # callers allowed to queue before failing fast
+POOL_IDLE_CHECK = float(os.getenv("DB_POOL_IDLE_CHECK", "30"))        # ping only connections idle longer than this
+POOL_MAX_LIFETIME = float(os.getenv("DB_POOL_MAX_LIFETIME", "1800"))  # recycle connections older than this
+POOL_CONNECT_RETRIES = int(os.getenv("DB_CONNECT_RETRIES", "4"))
+POOL_LEAK_MS = int(os.getenv("DB_POOL_LEAK_MS", "5000"))             # log connections held longer than this
+POOL_TRACK_STACKS = os.getenv("DB_POOL_TRACK_STACKS", "1") == "1"    # capture the checkout stack for leak reports
+
+# ASGI scope of the request being served; set by the logging middleware
+_CURRENT_SCOPE: contextvars.ContextVar = contextvars.ContextVar("current_scope", default=None)
+
+def _current_route() -> Optional[str]:
+    """'METHOD /route/{template}' of the request on this context, if any."""
+    scope = _CURRENT_SCOPE.get()
+    if not scope:
+        return None
+    route = scope.get("route")
+    return f"{scope.get('method', '')} {getattr(route, 'path', None) or scope.get('path', '')}"
+
+
+class _Checkout:
+    __slots__ = ("site", "route", "thread", "taken_at", "wait_ms", "stack", "nested", "reported")
+
+    def __init__(self, site, route, thread, taken_at, wait_ms, stack, nested):
+        self.site = site
+        self.route = route
+        self.thread = thread
+        self.taken_at = taken_at
+        self.wait_ms = wait_ms
+        self.stack = stack
+        self.nested = nested
+        self.reported = False
+
+
+class PoolDiagnostics:
+    """
+    Bookkeeping for BlockingConnectionPool: wait time per checkout, hold time
+    per connection, call site and request route that took it, peak usage and
+    nested checkouts (a thread taking a second connection while holding one).
+    Connections held longer than `leak_ms` are logged with the stack that
+    checked them out — once when returned and once while still held.
+    """
+
+    _SKIP_FUNCS = ("getconn", "get_conn")
+
+    def __init__(self, leak_ms: int = 5000, track_stacks: bool = True, samples: int = 2048):
+        self.leak_ms = int(leak_ms)
+        self.track_stacks = bool(track_stacks)
+        self._lock = threading.Lock()
+        self._held: Dict[int, _Checkout] = {}
+        self._per_thread = threading.local()
+        self._wait_samples: "deque[float]" = deque(maxlen=samples)
+        self._hold_samples: "deque[float]" = deque(maxlen=samples)
+        self._last_scan = 0.0
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.started_at = time.time()
+            self.checkouts = 0
+            self.waited = 0
+            self.timeouts = 0
+            self.nested = 0
+            self.leaks = 0
+            self.peak_in_use = len(self._held)
+            self.wait_ms_max = 0.0
+            self.hold_ms_max = 0.0
+            self.by_site: Dict[str, Dict[str, float]] = {}
+            self.by_route: Dict[str, Dict[str, float]] = {}
+            self._wait_samples.clear()
+            self._hold_samples.clear()
+
+    @classmethod
+    def _call_site(cls) -> Tuple[str, Any]:
+        f = sys._getframe(1)
+        while f is not None and (f.f_code.co_name in cls._SKIP_FUNCS or f.f_code.co_name.startswith("_on_")):
+            f = f.f_back
+        if f is None:
+            return "?", None
+        return f"{f.f_code.co_name}:{f.f_lineno}", f
+
+    @staticmethod
+    def _bump(table: Dict[str, Dict[str, float]], key: str, **vals: float) -> None:
+        row = table.get(key)
+        if row is None:
+            row = table[key] = {"count": 0, "wait_ms": 0.0, "wait_ms_max": 0.0, "hold_ms": 0.0, "hold_ms_max": 0.0, "nested": 0}
+        for k, v in vals.items():
+            if k.endswith("_max"):
+                row[k] = max(row[k], v)
+            else:
+                row[k] += v
+
+    def _thread_depth(self, delta: int) -> int:
+        depth = getattr(self._per_thread, "depth", 0) + delta
+        self._per_thread.depth = depth
+        return depth
+
+    def _on_checkout(self, conn, wait_s: float, in_use: int) -> None:
+        site, frame = self._call_site()
+        route = _current_route()
+        stack = traceback.extract_stack(frame, limit=12) if (self.track_stacks and frame is not None) else None
+        nested = self._thread_depth(+1) > 1
+        wait_ms = wait_s * 1000.0
+        co = _Checkout(site, route, threading.current_thread().name, time.monotonic(), wait_ms, stack, nested)
+        with self._lock:
+            self._held[id(conn)] = co
+            self.checkouts += 1
+            if wait_ms >= 1.0:
+                self.waited += 1
+            if nested:
+                self.nested += 1
+            self.peak_in_use = max(self.peak_in_use, in_use)
+            self.wait_ms_max = max(self.wait_ms_max, wait_ms)
+            self._wait_samples.append(wait_ms)
+            self._bump(self.by_site, site, count=1, wait_ms=wait_ms, wait_ms_max=wait_ms, nested=int(nested))
+            if route:
+                self._bump(self.by_route, route, count=1, wait_ms=wait_ms, wait_ms_max=wait_ms, nested=int(nested))
+        self.scan(throttle=5.0)
+
+    def _on_checkin(self, conn) -> None:
+        with self._lock:
+            co = self._held.pop(id(conn), None)
+            if co is None:
+                return
+            hold_ms = (time.monotonic() - co.taken_at) * 1000.0
+            self.hold_ms_max = max(self.hold_ms_max, hold_ms)
+            self._hold_samples.append(hold_ms)
+            self._bump(self.by_site, co.site, hold_ms=hold_ms, hold_ms_max=hold_ms)
+            if co.route:
+                self._bump(self.by_route, co.route, hold_ms=hold_ms, hold_ms_max=hold_ms)
+            long_held = hold_ms > self.leak_ms and not co.reported
+            if long_held:
+                self.leaks += 1
+        if co.thread == threading.current_thread().name:
+            self._thread_depth(-1)
+        if long_held:
+            logger.warning("db pool: connection held %.0f ms by %s (%s); taken at:\n%s",
+                           hold_ms, co.site, co.route or "-", self._fmt_stack(co))
+
+    def _on_timeout(self, wait_s: float) -> None:
+        site, _ = self._call_site()
+        with self._lock:
+            self.timeouts += 1
+        logger.warning("db pool: checkout timed out after %.0f ms at %s (%s); holders: %s",
+                       wait_s * 1000.0, site, _current_route() or "-",
+                       ", ".join(f"{h['site']}={h['held_ms']}ms" for h in self.held()))
+
+    @staticmethod
+    def _fmt_stack(co: _Checkout) -> str:
+        return "".join(traceback.format_list(co.stack)) if co.stack else "  (stack tracking disabled)\n"
+
+    def scan(self, throttle: float = 0.0) -> None:
+        """Log connections that are still checked out past the leak threshold (once per checkout)."""
+        now = time.monotonic()
+        if throttle and now - self._last_scan < throttle:
+            return
+        self._last_scan = now
+        overdue = []
+        with self._lock:
+            for co in self._held.values():
+                if not co.reported and (now - co.taken_at) * 1000.0 > self.leak_ms:
+                    co.reported = True
+                    self.leaks += 1
+                    overdue.append(co)
+        for co in overdue:
+            logger.warning("db pool: connection still held after %.0f ms by %s (%s, thread %s); taken at:\n%s",
+                           (now - co.taken_at) * 1000.0, co.site, co.route or "-", co.thread, self._fmt_stack(co))
+
+    def held(self) -> List[Dict[str, Any]]:
+        now = time.monotonic()
+        with self._lock:
+            items = list(self._held.values())
+        return sorted(({
+            "site": co.site,
+            "route": co.route,
+            "thread": co.thread,
+            "held_ms": int((now - co.taken_at) * 1000.0),
+            "wait_ms": round(co.wait_ms, 1),
+            "nested": co.nested,
+        } for co in items), key=lambda h: -h["held_ms"])
+
+    @staticmethod
+    def _percentiles(samples: List[float]) -> Dict[str, float]:
+        if not samples:
+            return {"p50": 0.0, "p95": 0.0, "p99": 0.0}
+        xs = sorted(samples)
+        pick = lambda q: round(xs[min(len(xs) - 1, int(q * len(xs)))], 1)
+        return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99)}
+
+    def snapshot(self) -> Dict[str, Any]:
+        self.scan()
+        with self._lock:
+            waits = list(self._wait_samples)
+            holds = list(self._hold_samples)
+            by_site = {k: dict(v) for k, v in self.by_site.items()}
+            by_route = {k: dict(v) for k, v in self.by_route.items()}
+            out = {
+                "since": int(self.started_at * 1000),
+                "checkouts": self.checkouts,
+                "waited": self.waited,
+                "timeouts": self.timeouts,
+                "nested_checkouts": self.nested,
+                "long_held": self.leaks,
+                "leak_threshold_ms": self.leak_ms,
+                "peak_in_use": self.peak_in_use,
+                "wait_ms": dict(self._percentiles(waits), max=round(self.wait_ms_max, 1)),
+                "hold_ms": dict(self._percentiles(holds), max=round(self.hold_ms_max, 1)),
+            }
+
+        def _rows(table: Dict[str, Dict[str, float]], key_name: str) -> List[Dict[str, Any]]:
+            rows = []
+            for key, r in table.items():
+                n = max(1, int(r["count"]))
+                rows.append({
+                    key_name: key,
+                    "count": int(r["count"]),
+                    "nested": int(r["nested"]),
+                    "wait_ms_avg": round(r["wait_ms"] / n, 1),
+                    "wait_ms_max": round(r["wait_ms_max"], 1),
+                    "hold_ms_avg": round(r["hold_ms"] / n, 1),
+                    "hold_ms_max": round(r["hold_ms_max"], 1),
+                    "hold_ms_total": int(r["hold_ms"]),
+                })
+            return sorted(rows, key=lambda x: -x["hold_ms_total"])
+
+        out["by_site"] = _rows(by_site, "site")
+        out["by_route"] = _rows(by_route, "route")
+        out["held"] = self.held()
+        return out
+
+
+class _PoolWaiter:
+    __slots__ = ("event", "conn", "slot")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.conn = None   # idle entry handed over by put_conn
+        self.slot = False  # permission to open a new connection instead
+
+
+class BlockingConnectionPool:
+    """
+    Thread-safe psycopg2 pool. When every connection is checked out, callers
+    wait in a bounded FIFO queue (up to `timeout` seconds) instead of getting
+    PoolError. Health is judged by idle age: only connections that sat idle
+    longer than `idle_check` are pinged, and connections older than
+    `max_lifetime` are recycled. New connections are opened with backoff so a
+    Neon suspend/restart does not fail the first request that hits it.
+    """
+
+    def __init__(self, minconn: int, maxconn: int, dsn: str, timeout: float = 10.0,
+                 max_waiters: int = 64, idle_check: float = 30.0, max_lifetime: float = 1800.0,
+                 connect_retries: int = 4, diagnostics: Optional[PoolDiagnostics] = None, **connect_kwargs):
+        self.diagnostics = diagnostics
+        self.minconn = max(0, int(minconn))
+        self.maxconn = max(1, int(maxconn))
+        self.dsn = dsn
+        self.timeout = float(timeout)
+        self.max_waiters = max(0, int(max_waiters))
+        self.idle_check = float(idle_check)
+        self.max_lifetime = float(max_lifetime)
+        self.connect_retries = max(1, int(connect_retries))
+        self.connect_kwargs = connect_kwargs
+        self._lock = threading.Lock()
+        self._idle: List[Tuple[Any, float]] = []      # (conn, returned_at) — used LIFO
+        self._used: Dict[int, Any] = {}
+        self._born: Dict[int, float] = {}
+        self._waiters: "deque[_PoolWaiter]" = deque()
+        self._size = 0                                # idle + used + being opened
+        for _ in range(self.minconn):
+            conn = self._connect(time.monotonic() + self.timeout)
+            with self._lock:
+                self._size += 1
+                self._idle.append((conn, time.monotonic()))
+
+    # ---- internals ----
+    def _connect(self, deadline: float):
+        delay = 0.2
+        last_exc: Optional[Exception] = None
+        for attempt in range(self.connect_retries):
+            try:
+                conn = psycopg2.connect(self.dsn, **self.connect_kwargs)
+                self._born[id(conn)] = time.monotonic()
+                return conn
+            except psycopg2.OperationalError as e:
+                last_exc = e
+                if attempt + 1 >= self.connect_retries or time.monotonic() + delay > deadline:
+                    break
+                logger.warning("db connect failed (attempt %d): %s; retrying in %.1fs", attempt + 1, e, delay)
+                time.sleep(delay)
+                delay = min(delay * 2, 3.0)
+        raise last_exc or psycopg2.OperationalError("could not connect")
+
+    def _discard(self, conn) -> None:
+        self._born.pop(id(conn), None)
         try:
-            # Remove the bad connection from pool and close it
-            dbpool.putconn(conn, close=True)
+            conn.close()
         except Exception:
             pass
-        # Get a fresh connection
-        conn = dbpool.getconn()
-    return conn
+
+    def _is_healthy(self, conn, idle_since: float) -> bool:
+        if conn.closed:
+            return False
+        now = time.monotonic()
+        if now - self._born.get(id(conn), now) > self.max_lifetime:
+            return False
+        if now - idle_since <= self.idle_check:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _release_slot(self) -> None:
+        """A connection was dropped: let the next waiter open a replacement."""
+        with self._lock:
+            if self._waiters:
+                w = self._waiters.popleft()
+                w.slot = True
+                w.event.set()
+            else:
+                self._size -= 1
+
+    # ---- public API ----
+    def getconn(self):
+        started = time.monotonic()
+        deadline = started + self.timeout
+        while True:
+            entry = None
+            waiter = None
+            with self._lock:
+                if self._idle:
+                    entry = self._idle.pop()
+                elif self._size < self.maxconn:
+                    self._size += 1
+                else:
+                    if len(self._waiters) >= self.max_waiters:
+                        if self.diagnostics:
+                            self.diagnostics._on_timeout(0.0)
+                        raise HTTPException(503, "database busy")
+                    waiter = _PoolWaiter()
+                    self._waiters.append(waiter)
+
+            if waiter is not None:
+                waiter.event.wait(max(0.0, deadline - time.monotonic()))
+                with self._lock:
+                    if waiter.conn is None and not waiter.slot:
+                        try:
+                            self._waiters.remove(waiter)
+                        except ValueError:
+                            pass
+                        timed_out = True
+                    else:
+                        timed_out = False
+                if timed_out:
+                    if self.diagnostics:
+                        self.diagnostics._on_timeout(time.monotonic() - started)
+                    raise HTTPException(503, "database busy")
+                entry = waiter.conn
+
+            if entry is not None:
+                conn, idle_since = entry
+                if not self._is_healthy(conn, idle_since):
+                    self._discard(conn)
+                    self._release_slot()
+                    continue
+            else:
+                try:
+                    conn = self._connect(deadline)
+                except Exception:
+                    self._release_slot()
+                    raise
+
+            with self._lock:
+                self._used[id(conn)] = conn
+                in_use = len(self._used)
+            if self.diagnostics:
+                self.diagnostics._on_checkout(conn, time.monotonic() - started, in_use)
+            return conn
+
+    def putconn(self, conn, close: bool = False) -> None:
+        with self._lock:
+            if self._used.pop(id(conn), None) is None:
+                return  # not ours, or already returned
+        if self.diagnostics:
+            self.diagnostics._on_checkin(conn)
+        if not close and not conn.closed:
+            try:
+                status = conn.info.transaction_status
+                if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    close = True
+                elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                close = True
+        if close or conn.closed:
+            self._discard(conn)
+            self._release_slot()
+            return
+        entry = (conn, time.monotonic())
+        with self._lock:
+            if self._waiters:
+                w = self._waiters.popleft()
+                w.conn = entry
+                w.event.set()
+            else:
+                self._idle.append(entry)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "size": self._size,
+                "max": self.maxconn,
+                "in_use": len(self._used),
+                "idle": len(self._idle),
+                "waiting": len(self._waiters),
+            }
+
+
+dbpool = BlockingConnectionPool(
+    POOL_MIN, POOL_MAX, DATABASE_URL,
+    timeout=POOL_TIMEOUT, max_waiters=POOL_MAX_WAITERS,
+    idle_check=POOL_IDLE_CHECK, max_lifetime=POOL_MAX_LIFETIME,
+    connect_retries=POOL_CONNECT_RETRIES,
+    diagnostics=PoolDiagnostics(leak_ms=POOL_LEAK_MS, track_stacks=POOL_TRACK_STACKS),
+    # TCP keepalives so connections silently dropped by Neon are detected
+    keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3,
+)
+
+# Loop-block guard: get_conn() called on the event loop thread means an async
+# handler is doing blocking DB work inline. "warn" logs each offending call site
+# once, "raise" fails the request (use it when exercising the app locally).
+LOOP_BLOCK_GUARD = os.getenv("LOOP_BLOCK_GUARD", "warn").strip().lower()
+_loop_block_sites: set = set()
+
+def _check_loop_block() -> None:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    f = sys._getframe(2)
+    site = f"{os.path.basename(f.f_code.co_filename)}:{f.f_lineno} {f.f_code.co_name}"
+    if LOOP_BLOCK_GUARD == "raise":
+        raise RuntimeError(f"blocking DB call on the event loop at {site}")
+    if site not in _loop_block_sites:
+        _loop_block_sites.add(site)
+        logger.warning("blocking DB call on the event loop at %s (route=%s)", site, _current_route())
+
+def get_conn() -> psycopg2.extensions.connection:
+    """Check out a connection, waiting up to DB_POOL_TIMEOUT seconds if the pool is exhausted."""
+    if LOOP_BLOCK_GUARD != "off":
+        _check_loop_block()
+    return dbpool.getconn()
 
 def put_conn(conn: psycopg2.extensions.connection) -> None:
     try:
@@ -126,51 +664,197 @@ def put_conn(conn: psycopg2.extensions.connection) -> None:
         except Exception:
             pass
 
+# =========================
+# Device tokens
+# =========================
+DEVICE_TOKEN_CACHE_TTL = float(os.getenv("DEVICE_TOKEN_CACHE_TTL", "60"))      # seconds a uid's token list is reused
+DEVICE_TOKEN_CACHE_MAX = int(os.getenv("DEVICE_TOKEN_CACHE_MAX", "10000"))     # uids kept in memory
+DEVICE_PRUNE_BATCH = int(os.getenv("DEVICE_PRUNE_BATCH", "500"))               # flush invalid tokens once this many are queued
+
+class DeviceTokenCache:
+    """
+    uid -> FCM tokens (user_devices, falling back to users.fcm_token). This
+    process drops entries itself when a device registers or a token is pruned;
+    the TTL bounds how long registrations handled by another process go unseen.
+    A generation counter keeps a load that raced an invalidation from being cached.
+    """
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._by_uid: Dict[str, Tuple[float, int, List[str]]] = {}
+        self._uid_by_user: Dict[int, str] = {}
+        self._uid_by_token: Dict[str, str] = {}
+        self._gen = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def generation(self) -> int:
+        return self._gen
+
+    def _lookup(self, uid: Optional[str]) -> Optional[List[str]]:
+        e = self._by_uid.get(uid) if uid is not None else None
+        if e is None or e[0] < time.monotonic():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return list(e[2])
+
+    def get(self, uid: str) -> Optional[List[str]]:
+        with self._lock:
+            return self._lookup(uid)
+
+    def get_user(self, user_id: int) -> Optional[List[str]]:
+        with self._lock:
+            return self._lookup(self._uid_by_user.get(user_id))
+
+    def _drop(self, uid: str) -> None:
+        e = self._by_uid.pop(uid, None)
+        if e is None:
+            return
+        self._uid_by_user.pop(e[1], None)
+        for t in e[2]:
+            if self._uid_by_token.get(t) == uid:
+                del self._uid_by_token[t]
+
+    def put(self, uid: str, user_id: int, tokens: List[str], generation: int) -> None:
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            if generation != self._gen:
+                return
+            self._drop(uid)
+            while len(self._by_uid) >= self.max_entries:
+                self._drop(next(iter(self._by_uid)))
+            self._by_uid[uid] = (time.monotonic() + self.ttl, user_id, list(tokens))
+            self._uid_by_user[user_id] = uid
+            for t in tokens:
+                self._uid_by_token[t] = uid
+
+    def invalidate(self, uid: str) -> None:
+        with self._lock:
+            self._gen += 1
+            self._drop(uid)
+
+    def invalidate_tokens(self, tokens: List[str]) -> None:
+        with self._lock:
+            self._gen += 1
+            for t in tokens:
+                uid = self._uid_by_token.get(t)
+                if uid is not None:
+                    self._drop(uid)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._gen += 1
+            self._by_uid.clear()
+            self._uid_by_user.clear()
+            self._uid_by_token.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"entries": len(self._by_uid), "hits": self.hits, "misses": self.misses, "ttl": self.ttl}
+
+_device_tokens = DeviceTokenCache(DEVICE_TOKEN_CACHE_TTL, DEVICE_TOKEN_CACHE_MAX)
+_bad_tokens: set = set()
+_bad_tokens_lock = threading.Lock()
+_device_gc_wakeup = threading.Event()
+
+def _load_device_tokens(cur, column: str, value) -> List[str]:
+    """Resolve (and cache) the tokens of the user whose users.<column> = value ('uid' or 'id')."""
+    gen = _device_tokens.generation
+    cur.execute(f"""
+        SELECT u.id, u.uid,
+               COALESCE((SELECT array_agg(d.fcm_token ORDER BY d.id) FROM public.user_devices d
+                         WHERE d.uid = u.uid AND d.fcm_token <> ''),
+                        CASE WHEN u.fcm_token <> '' THEN ARRAY[u.fcm_token] END,
+                        '{{}}'::text[])
+        FROM public.users u WHERE u.{column} = %s
+    """, (value,))
+    r = cur.fetchone()
+    if not r:
+        return []
+    with _bad_tokens_lock:
+        toks = [t for t in r[2] if t not in _bad_tokens]
+    _device_tokens.put(r[1], int(r[0]), toks, gen)
+    return toks
+
 def _prune_bad_fcm_token(bad_token: str):
     """
-    Remove invalid/blocked FCM token from user_devices and users.fcm_token (if matches).
-    Safe to call from anywhere; opens its own DB connection.
+    Queue an invalid/blocked FCM token for bulk removal from user_devices and
+    users.fcm_token. It stops being handed out by the token cache right away.
     """
     if not bad_token:
         return
+    with _bad_tokens_lock:
+        _bad_tokens.add(bad_token)
+        n = len(_bad_tokens)
+    _device_tokens.invalidate_tokens([bad_token])
+    if n >= DEVICE_PRUNE_BATCH:
+        _device_gc_wakeup.set()
+
+def _prune_bad_fcm_tokens(tokens: List[str]) -> int:
+    """Delete tokens from user_devices and users.fcm_token in one transaction. Returns devices removed."""
+    if not tokens:
+        return 0
     conn = get_conn()
     try:
         with conn, conn.cursor() as cur:
-            try:
-                cur.execute("DELETE FROM public.user_devices WHERE fcm_token=%s", (bad_token,))
-            except Exception:
-                pass
-            try:
-                cur.execute("UPDATE public.users SET fcm_token=NULL WHERE fcm_token=%s", (bad_token,))
-            except Exception:
-                pass
-    except Exception as e:
-        logger.exception("prune_bad_fcm_token failed: %s", e)
+            cur.execute("DELETE FROM public.user_devices WHERE fcm_token = ANY(%s)", (tokens,))
+            removed = cur.rowcount
+            cur.execute("UPDATE public.users SET fcm_token=NULL WHERE fcm_token = ANY(%s)", (tokens,))
     finally:
         put_conn(conn)
-# =========================
-# Logging
-# =========================
-logger = logging.getLogger("smm")
-logging.basicConfig(level=logging.INFO)
-
+    _device_tokens.invalidate_tokens(tokens)
+    return removed
+
+def _flush_bad_fcm_tokens() -> int:
+    with _bad_tokens_lock:
+        tokens = list(_bad_tokens)
+    if not tokens:
+        return 0
+    try:
+        removed = _prune_bad_fcm_tokens(tokens)
+    except Exception as e:
+        logger.exception("prune_bad_fcm_tokens failed: %s", e)
+        return 0
+    with _bad_tokens_lock:
+        _bad_tokens.difference_update(tokens)
+    return removed
 
 # =========================
 # FCM helpers (V1 preferred; Legacy fallback)
 # =========================
-def _fcm_get_access_token_v1(sa_info: dict) -> Optional[str]:
+FCM_SCOPE = "https://www.googleapis.com/auth/firebase.messaging"
+# Overridable so a local FCM/IID stand-in can be used in development.
+FCM_API_BASE = os.getenv("FCM_API_BASE", "https://fcm.googleapis.com").rstrip("/")
+IID_API_BASE = os.getenv("IID_API_BASE", "https://iid.googleapis.com").rstrip("/")
+
+# FCM and IID calls from every sender thread (outbox + broadcasts) share one pool.
+_fcm_http = _http("fcm")
+FCM_TOKEN_REFRESH_MARGIN = int(os.getenv("FCM_TOKEN_REFRESH_MARGIN", "300"))  # refresh this many seconds before expiry
+FCM_TOKEN_SHARED = os.getenv("FCM_TOKEN_SHARED", "0") == "1"                # share the token across processes via settings
+_FCM_TOKEN_SETTINGS_KEY = "fcm_access_token"
+_FCM_TOKEN_LOCK_ID = 987654322
+
+def _fcm_fetch_access_token(sa_info: dict, creds_holder: Dict[str, Any]) -> Tuple[Optional[str], float]:
     """
-    Returns OAuth2 access token using google-auth if available; otherwise falls back to manual JWT if PyJWT is installed.
+    Fetch a fresh OAuth2 access token using google-auth if available; otherwise falls back to manual JWT if PyJWT is installed.
+    Returns (token, expires_at epoch seconds). creds_holder keeps the google-auth Credentials between refreshes.
     """
     # Try google-auth first
     try:
         from google.oauth2 import service_account
         from google.auth.transport.requests import Request as GoogleRequest
-        creds = service_account.Credentials.from_service_account_info(sa_info, scopes=[
-            "https://www.googleapis.com/auth/firebase.messaging"
-        ])
+        creds = creds_holder.get("creds")
+        if creds is None:
+            creds = service_account.Credentials.from_service_account_info(sa_info, scopes=[FCM_SCOPE])
+            creds_holder["creds"] = creds
         creds.refresh(GoogleRequest())
-        return creds.token
+        expiry = getattr(creds, "expiry", None)  # naive UTC datetime
+        expires_at = calendar.timegm(expiry.utctimetuple()) if expiry else time.time() + 3000
+        return creds.token, float(expires_at)
     except Exception as e:
         logger.info("google-auth not available or failed: %s", e)
 
@@ -180,42 +864,160 @@ def _fcm_get_access_token_v1(sa_info: dict) -> Optional[str]:
         now = int(_time.time())
         payload = {
             "iss": sa_info["client_email"],
-            "scope": "https://www.googleapis.com/auth/firebase.messaging",
+            "scope": FCM_SCOPE,
             "aud": sa_info.get("token_uri", "https://oauth2.googleapis.com/token"),
             "iat": now,
             "exp": now + 3600,
         }
         signed_jwt = jwt.encode(payload, sa_info["private_key"], algorithm="RS256")
-        resp = requests.post(sa_info.get("token_uri", "https://oauth2.googleapis.com/token"),
+        resp = _http("oauth").post(sa_info.get("token_uri", "https://oauth2.googleapis.com/token"),
             data={
                 "grant_type": "urn:ietf:params:oauth:grant-type:jwt-bearer",
                 "assertion": signed_jwt,
-            }, timeout=10)
+            })
         if resp.status_code in (200, 201):
-            return resp.json().get("access_token")
+            obj = resp.json()
+            return obj.get("access_token"), float(now + int(obj.get("expires_in") or 3600))
         else:
             logger.warning("JWT token fetch failed: %s %s", resp.status_code, resp.text[:200])
     except Exception as e:
         logger.info("pyjwt flow not available or failed: %s", e)
-    return None
+    return None, 0.0
+
+
+class FcmAuth:
+    """
+    Process-wide FCM credentials: the service account JSON is parsed once and the
+    access token is reused until FCM_TOKEN_REFRESH_MARGIN seconds before it
+    expires. Refresh is single-flight (one thread fetches, the others wait and
+    reuse the result). With FCM_TOKEN_SHARED=1 the token is also kept in
+    public.settings so all workers share one token, refreshed under an advisory
+    lock.
+    """
+
+    def __init__(self, sa_json: str, margin: int, shared: bool):
+        self.margin = int(margin)
+        self.shared = bool(shared)
+        self._lock = threading.Lock()
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self._creds: Dict[str, Any] = {}
+        self.refreshes = 0
+        self.sa_info: Optional[dict] = None
+        if sa_json:
+            try:
+                self.sa_info = json.loads(sa_json)
+            except Exception as e:
+                logger.info("Invalid GOOGLE_APPLICATION_CREDENTIALS_JSON: %s", e)
+
+    def _fresh(self, expires_at: float) -> bool:
+        return time.time() < expires_at - self.margin
+
+    def token(self) -> Optional[str]:
+        if self.sa_info is None:
+            return None
+        tok = self._token
+        if tok and self._fresh(self._expires_at):
+            return tok
+        with self._lock:
+            if self._token and self._fresh(self._expires_at):
+                return self._token
+            if self.shared:
+                tok, exp = self._refresh_shared()
+            else:
+                tok, exp = self._fetch()
+            if tok:
+                self._token, self._expires_at = tok, exp
+            return tok
+
+    def invalidate(self, token: Optional[str]) -> None:
+        """Drop a token FCM rejected (401) so the next call refreshes."""
+        with self._lock:
+            if token and token == self._token:
+                self._token, self._expires_at = None, 0.0
+        if self.shared and token:
+            try:
+                conn = get_conn()
+                try:
+                    with conn, conn.cursor() as cur:
+                        cur.execute("DELETE FROM public.settings WHERE key=%s AND value->>'token'=%s",
+                                    (_FCM_TOKEN_SETTINGS_KEY, token))
+                finally:
+                    put_conn(conn)
+            except Exception as e:
+                logger.warning("fcm token invalidate (shared) failed: %s", e)
+
+    def _fetch(self) -> Tuple[Optional[str], float]:
+        tok, exp = _fcm_fetch_access_token(self.sa_info or {}, self._creds)
+        if tok:
+            self.refreshes += 1
+            logger.info("FCM access token refreshed (valid %d s)", int(exp - time.time()))
+        return tok, exp
+
+    def _refresh_shared(self) -> Tuple[Optional[str], float]:
+        try:
+            conn = get_conn()
+        except Exception:
+            return self._fetch()
+        try:
+            with conn, conn.cursor() as cur:
+                # serializes refreshes across workers; released at commit
+                cur.execute("SELECT pg_advisory_xact_lock(%s)", (_FCM_TOKEN_LOCK_ID,))
+                cur.execute("SELECT value FROM public.settings WHERE key=%s", (_FCM_TOKEN_SETTINGS_KEY,))
+                row = cur.fetchone()
+                v = row[0] if row and isinstance(row[0], dict) else {}
+                tok, exp = v.get("token"), float(v.get("expires_at") or 0)
+                if tok and self._fresh(exp):
+                    return tok, exp
+                tok, exp = self._fetch()
+                if tok:
+                    cur.execute("""
+                        INSERT INTO public.settings(key, value, updated_at) VALUES (%s, %s, NOW())
+                        ON CONFLICT (key) DO UPDATE SET value=EXCLUDED.value, updated_at=NOW()
+                    """, (_FCM_TOKEN_SETTINGS_KEY, Json({"token": tok, "expires_at": exp})))
+                return tok, exp
+        except Exception as e:
+            logger.warning("shared FCM token refresh failed, fetching locally: %s", e)
+            return self._fetch()
+        finally:
+            put_conn(conn)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "configured": self.sa_info is not None,
+            "shared": self.shared,
+            "refreshes": self.refreshes,
+            "expires_in": int(self._expires_at - time.time()) if self._token else None,
+        }
 
-def _fcm_send_v1(fcm_token: str, title: str, body: str, order_id: Optional[int], sa_info: dict, project_id: Optional[str] = None):
+fcm_auth = FcmAuth(GOOGLE_APPLICATION_CREDENTIALS_JSON, FCM_TOKEN_REFRESH_MARGIN, FCM_TOKEN_SHARED)
+
+# Delivery outcome of a single FCM send:
+#   sent    - accepted by FCM
+#   invalid - token unregistered/invalid (already pruned); never retry
+#   retry   - transient (network, 429, 5xx, auth refresh); try again later
+#   failed  - permanent for this message (bad request, FCM not configured)
+FCM_SENT, FCM_INVALID, FCM_RETRY, FCM_FAILED = "sent", "invalid", "retry", "failed"
+
+def _fcm_send_v1(fcm_token: Optional[str], title: str, body: str, order_id: Optional[int], sa_info: dict, project_id: Optional[str] = None, topic: Optional[str] = None) -> Tuple[str, str]:
     """
-    Send using FCM HTTP v1. On invalid/blocked tokens, prune them from DB.
+    Send using FCM HTTP v1 to a device token, or to a topic when topic is given.
+    On invalid/blocked tokens, prune them from DB. Returns (outcome, detail).
     """
     try:
-        access_token = _fcm_get_access_token_v1(sa_info)
+        access_token = fcm_auth.token()
         if not access_token:
             logger.warning("FCM v1: could not obtain access token")
-            return False
+            return FCM_RETRY, "no access token"
         pid = project_id or sa_info.get("project_id")
         if not pid:
             logger.warning("FCM v1: missing project_id")
-            return False
-        url = f"https://fcm.googleapis.com/v1/projects/{pid}/messages:send"
+            return FCM_FAILED, "missing project_id"
+        url = f"{FCM_API_BASE}/v1/projects/{pid}/messages:send"
+        target = {"topic": topic} if topic else {"token": fcm_token}
         message = {
             "message": {
-                "token": fcm_token,
+                **target,
                 "notification": {"title": title, "body": body},
                 "data": {
                     "title": title,
@@ -224,13 +1026,15 @@ def _fcm_send_v1(fcm_token: str, title: str, body: str, order_id: Optional[int],
                 }
             }
         }
-        resp = requests.post(url, headers={
+        resp = _fcm_http.post(url, headers={
             "Authorization": f"Bearer {access_token}",
             "Content-Type": "application/json"
-        }, json=message, timeout=10)
+        }, json=message)
 
         if resp.status_code in (200, 201):
-            return True
+            return FCM_SENT, ""
+        if resp.status_code == 401:
+            fcm_auth.invalidate(access_token)
 
         # Try to detect unregistered/invalid tokens and prune
         try:
@@ -239,18 +1043,23 @@ def _fcm_send_v1(fcm_token: str, title: str, body: str, order_id: Optional[int],
             ej = {}
         status = str(ej.get("status") or "").upper()
         message_txt = str(ej.get("message") or "")
-        if resp.status_code in (400, 404) or status in ("INVALID_ARGUMENT", "NOT_FOUND"):
+        detail = f"{resp.status_code} {status or resp.text[:200]}"
+        if fcm_token and (resp.status_code in (400, 404) or status in ("INVALID_ARGUMENT", "NOT_FOUND")):
             if ("Requested entity was not found" in message_txt) or ("Invalid registration token" in message_txt) or ("UNREGISTERED" in message_txt.upper()):
                 _prune_bad_fcm_token(fcm_token)
+                return FCM_INVALID, detail
         logger.warning("FCM v1 send failed (%s): %s", resp.status_code, resp.text[:300])
-        return False
+        if resp.status_code in (401, 403, 408, 429) or resp.status_code >= 500:
+            return FCM_RETRY, detail
+        return FCM_FAILED, detail
     except Exception as ex:
         logger.exception("FCM v1 send exception: %s", ex)
-        return False
+        return FCM_RETRY, str(ex)[:200]
 
-def _fcm_send_legacy(fcm_token: str, title: str, body: str, order_id: Optional[int], server_key: str):
+def _fcm_send_legacy(fcm_token: str, title: str, body: str, order_id: Optional[int], server_key: str) -> Tuple[str, str]:
     """
     Send using Legacy HTTP API. If response indicates an invalid/blocked token, prune it.
+    Returns (outcome, detail).
     """
     try:
         headers = {
@@ -263,10 +1072,12 @@ def _fcm_send_legacy(fcm_token: str, title: str, body: str, order_id: Optional[i
             "notification": {"title": title, "body": body},
             "data": {"title": title, "body": body, "order_id": str(order_id or "")}
         }
-        resp = requests.post("https://fcm.googleapis.com/fcm/send", headers=headers, json=payload, timeout=10)
+        resp = _fcm_http.post(f"{FCM_API_BASE}/fcm/send", headers=headers, json=payload)
         if resp.status_code not in (200, 201):
             logger.warning("FCM legacy send failed (%s): %s", resp.status_code, resp.text[:300])
-            return False
+            if resp.status_code in (401, 429) or resp.status_code >= 500:
+                return FCM_RETRY, f"{resp.status_code}"
+            return FCM_FAILED, f"{resp.status_code}"
         # Parse per-result errors
         try:
             obj = resp.json()
@@ -278,334 +1089,2152 @@ def _fcm_send_legacy(fcm_token: str, title: str, body: str, order_id: Optional[i
                 err = results[0].get("error")
                 if err in ("NotRegistered", "InvalidRegistration", "MismatchSenderId"):
                     _prune_bad_fcm_token(fcm_token)
-                    return False
+                    return FCM_INVALID, err
+                if err in ("Unavailable", "InternalServerError"):
+                    return FCM_RETRY, err
         except Exception:
             pass
-        return True
+        return FCM_SENT, ""
     except Exception as ex:
         logger.exception("FCM legacy send exception: %s", ex)
-        return False
+        return FCM_RETRY, str(ex)[:200]
 
-def _fcm_send_push(fcm_token: Optional[str], title: str, body: str, order_id: Optional[int]):
+def _fcm_deliver(fcm_token: Optional[str], title: str, body: str, order_id: Optional[int]) -> Tuple[str, str]:
     """
-    Wrapper that prefers v1; prunes invalid tokens automatically.
+    Send one push, preferring v1; prunes invalid tokens automatically.
+    Returns (outcome, detail) where outcome is one of FCM_SENT/FCM_INVALID/FCM_RETRY/FCM_FAILED.
     """
     if not fcm_token:
-        return False
-    sa_json = (GOOGLE_APPLICATION_CREDENTIALS_JSON or "").strip()
-    if sa_json:
-        try:
-            info = json.loads(sa_json)
-            return _fcm_send_v1(fcm_token, title, body, order_id, info, project_id=(FCM_PROJECT_ID or None))
-        except Exception as e:
-            logger.info("Invalid GOOGLE_APPLICATION_CREDENTIALS_JSON: %s", e)
+        return FCM_INVALID, "empty token"
+    if fcm_auth.sa_info is not None:
+        return _fcm_send_v1(fcm_token, title, body, order_id, fcm_auth.sa_info, project_id=(FCM_PROJECT_ID or None))
     if FCM_SERVER_KEY:
         return _fcm_send_legacy(fcm_token, title, body, order_id, FCM_SERVER_KEY)
     logger.warning("FCM not configured: missing credentials")
-    return False
+    return FCM_FAILED, "fcm not configured"
+
+def _fcm_configured() -> bool:
+    return fcm_auth.sa_info is not None or bool(FCM_SERVER_KEY)
+
+def _fcm_send_topic(topic: str, title: str, body: str) -> Tuple[str, str]:
+    """One send to every device subscribed to the topic."""
+    if fcm_auth.sa_info is not None:
+        return _fcm_send_v1(None, title, body, None, fcm_auth.sa_info, project_id=(FCM_PROJECT_ID or None), topic=topic)
+    if FCM_SERVER_KEY:
+        return _fcm_send_legacy(f"/topics/{topic}", title, body, None, FCM_SERVER_KEY)
+    return FCM_FAILED, "fcm not configured"
+
+def _fcm_topic_subscribe(tokens: List[str], topic: str) -> Tuple[List[str], List[str]]:
+    """
+    Subscribe up to 1000 tokens to a topic via the IID batchAdd API.
+    Returns (subscribed, invalid); raises on a transient/whole-request failure.
+    """
+    if fcm_auth.sa_info is not None:
+        access_token = fcm_auth.token()
+        if not access_token:
+            raise RuntimeError("no access token")
+        headers = {"Authorization": f"Bearer {access_token}", "access_token_auth": "true"}
+    elif FCM_SERVER_KEY:
+        headers = {"Authorization": f"key={FCM_SERVER_KEY}"}
+    else:
+        raise RuntimeError("fcm not configured")
+    resp = _fcm_http.post(f"{IID_API_BASE}/iid/v1:batchAdd", headers=headers,
+                          json={"to": f"/topics/{topic}", "registration_tokens": tokens}, timeout=20.0)
+    if resp.status_code not in (200, 201):
+        raise RuntimeError(f"batchAdd {resp.status_code}: {resp.text[:200]}")
+    results = (resp.json() or {}).get("results") or []
+    ok, invalid = [], []
+    for tok, res in zip(tokens, results):
+        err = (res or {}).get("error")
+        if not err:
+            ok.append(tok)
+        elif err in ("NOT_FOUND", "INVALID_ARGUMENT"):
+            invalid.append(tok)
+    return ok, invalid
+
+def _fcm_send_push(fcm_token: Optional[str], title: str, body: str, order_id: Optional[int]) -> bool:
+    """
+    Wrapper that prefers v1; prunes invalid tokens automatically.
+    """
+    return _fcm_deliver(fcm_token, title, body, order_id)[0] == FCM_SENT
 
 # =========================
-# Schema & Triggers
+# Schema migrations
 # =========================
-def ensure_schema():
+# Every schema change is a numbered step recorded in public.schema_migrations.
+# Boot reads the applied versions (one query) and only takes the advisory
+# lock when something is pending. Steps registered with concurrent=True get an
+# autocommit connection so they can use CREATE INDEX CONCURRENTLY.
+_MIGRATIONS: List[Tuple[int, str, Any, bool]] = []
+_MIGRATION_LOCK_ID = 987654321
+MIGRATION_LOCK_TIMEOUT = float(os.getenv("MIGRATION_LOCK_TIMEOUT", "300"))
+
+def migration(version: int, name: str, concurrent: bool = False):
+    """Register a schema step. Plain steps get a cursor inside a transaction; concurrent steps get the autocommit connection."""
+    def deco(fn):
+        if any(v == version for v, _, _, _ in _MIGRATIONS):
+            raise RuntimeError(f"duplicate migration version {version}")
+        _MIGRATIONS.append((version, name, fn, concurrent))
+        return fn
+    return deco
+
+def _applied_migrations(conn) -> set:
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT version FROM public.schema_migrations")
+            return {int(r[0]) for r in cur.fetchall()}
+    except psycopg2.errors.UndefinedTable:
+        return set()
+
+def _create_index_concurrently(conn, name: str, ddl: str) -> None:
+    """Run a CREATE INDEX CONCURRENTLY, first dropping an INVALID leftover of an interrupted build."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT i.indisvalid
+            FROM pg_class c
+            JOIN pg_index i ON i.indexrelid = c.oid
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = 'public' AND c.relname = %s
+        """, (name,))
+        row = cur.fetchone()
+        if row and row[0]:
+            return
+        if row:
+            cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS public.{name}")
+        cur.execute(ddl)
+
+def run_migrations() -> None:
     conn = get_conn()
     try:
-        with conn:
+        conn.autocommit = True
+        steps = sorted(_MIGRATIONS, key=lambda m: m[0])
+        if not [m for m in steps if m[0] not in _applied_migrations(conn)]:
+            return
+
+        # Poll instead of blocking in pg_advisory_lock: a session waiting inside a
+        # statement holds a snapshot, and CREATE INDEX CONCURRENTLY would wait on it.
+        deadline = time.monotonic() + MIGRATION_LOCK_TIMEOUT
+        with conn.cursor() as cur:
+            while True:
+                cur.execute("SELECT pg_try_advisory_lock(%s)", (_MIGRATION_LOCK_ID,))
+                if cur.fetchone()[0]:
+                    break
+                if time.monotonic() > deadline:
+                    raise RuntimeError("timed out waiting for the schema migration lock")
+                time.sleep(0.5)
+        try:
             with conn.cursor() as cur:
-                # global advisory lock to avoid race on first boot
-                cur.execute("SELECT pg_advisory_lock(987654321)")
-                try:
-                    cur.execute("CREATE SCHEMA IF NOT EXISTS public;")
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS public.schema_migrations(
+                        version    INTEGER PRIMARY KEY,
+                        name       TEXT NOT NULL,
+                        applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                    )
+                """)
+            applied = _applied_migrations(conn)
+            for version, name, fn, concurrent in steps:
+                if version in applied:
+                    continue
+                t0 = time.time()
+                if concurrent:
+                    fn(conn)
+                    with conn.cursor() as cur:
+                        cur.execute("INSERT INTO public.schema_migrations(version, name) VALUES(%s,%s)", (version, name))
+                else:
+                    conn.autocommit = False
+                    try:
+                        with conn, conn.cursor() as cur:
+                            fn(cur)
+                            cur.execute("INSERT INTO public.schema_migrations(version, name) VALUES(%s,%s)", (version, name))
+                    finally:
+                        conn.autocommit = True
+                logger.info("migration %04d %s applied (%d ms)", version, name, int((time.time() - t0) * 1000))
+        finally:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (_MIGRATION_LOCK_ID,))
+    finally:
+        conn.autocommit = False
+        put_conn(conn)
 
-                    # users
-                    cur.execute("""
-                        CREATE TABLE IF NOT EXISTS public.users(
-                            id         SERIAL PRIMARY KEY,
-                            uid        TEXT UNIQUE NOT NULL,
-                            balance    NUMERIC(18,4) NOT NULL DEFAULT 0,
-                            is_banned  BOOLEAN NOT NULL DEFAULT FALSE,
-                            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-                            fcm_token  TEXT
-                        );
-                    """)
-                    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_uid ON public.users(uid);")
-
-                    # user_devices (multi-device FCM tokens)
-                    cur.execute("""
-                        CREATE TABLE IF NOT EXISTS public.user_devices(
-                            id BIGSERIAL PRIMARY KEY,
-                            uid TEXT NOT NULL,
-                            fcm_token TEXT NOT NULL UNIQUE,
-                            platform TEXT DEFAULT 'android',
-                            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-                        );
-                    """)
-                    cur.execute("CREATE INDEX IF NOT EXISTS idx_user_devices_uid ON public.user_devices(uid);")
-
-                    # wallet_txns
-                    cur.execute("""
-                        CREATE TABLE IF NOT EXISTS public.wallet_txns(
-                            id         SERIAL PRIMARY KEY,
-                            user_id    INTEGER NOT NULL REFERENCES public.users(id) ON DELETE CASCADE,
-                            amount     NUMERIC(18,4) NOT NULL,
-                            reason     TEXT,
-                            meta       JSONB,
-                            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-                        );
-                    """)
-                    cur.execute("CREATE INDEX IF NOT EXISTS idx_wallet_txns_user ON public.wallet_txns(user_id);")
-                    cur.execute("CREATE INDEX IF NOT EXISTS idx_wallet_txns_created ON public.wallet_txns(created_at);")
-
-                    # orders
-                    cur.execute("""
-                        CREATE TABLE IF NOT EXISTS public.orders(
-                            id                 SERIAL PRIMARY KEY,
-                            user_id            INTEGER NOT NULL REFERENCES public.users(id) ON DELETE CASCADE,
-                            title              TEXT NOT NULL,
-                            service_id         BIGINT,
-                            link               TEXT,
-                            quantity           INTEGER NOT NULL DEFAULT 0,
-                            price              NUMERIC(18,4) NOT NULL DEFAULT 0,
-                            status             TEXT NOT NULL DEFAULT 'Pending',
-                            provider_order_id  TEXT,
-                            payload            JSONB DEFAULT '{}'::jsonb,
-                            created_at         TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-                            type               TEXT
-                        );
-                    """)
-                    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_user ON public.orders(user_id);")
-                    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_status ON public.orders(status);")
-                    cur.execute("ALTER TABLE public.orders ADD COLUMN IF NOT EXISTS type TEXT;")
-                    cur.execute("UPDATE public.orders SET type='provider' WHERE type IS NULL;")
-                    cur.execute("ALTER TABLE public.orders ALTER COLUMN type SET DEFAULT 'provider';")
-                    cur.execute("ALTER TABLE public.orders ALTER COLUMN type SET NOT NULL;")
-                    cur.execute("UPDATE public.orders SET payload='{}'::jsonb WHERE payload IS NULL;")
-
-                    # service overrides tables
-                    cur.execute("""
-                        CREATE TABLE IF NOT EXISTS public.service_id_overrides(
-                            ui_key TEXT PRIMARY KEY,
-                            service_id BIGINT NOT NULL,
-                            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
-                        );
-                    """)
-                    cur.execute("""
-                        CREATE TABLE IF NOT EXISTS public.service_pricing_overrides(
-                            ui_key TEXT PRIMARY KEY,
-                            price_per_k NUMERIC(18,6) NOT NULL,
-                            min_qty INTEGER NOT NULL,
-                            max_qty INTEGER NOT NULL,
-                            mode TEXT NOT NULL DEFAULT 'per_k',
-                            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
-                        );
-                    """)
-                    cur.execute("""
-                        CREATE TABLE IF NOT EXISTS public.order_pricing_overrides(
-                            order_id BIGINT PRIMARY KEY,
-                            price NUMERIC(18,6) NOT NULL,
-                            mode TEXT NOT NULL DEFAULT 'flat',
-                            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
-                        );
-                    """)
-
-                    # user_notifications
-                    cur.execute("""
-                        CREATE TABLE IF NOT EXISTS public.user_notifications(
-                            id BIGSERIAL PRIMARY KEY,
-                            user_id INTEGER NOT NULL REFERENCES public.users(id) ON DELETE CASCADE,
-                            order_id INTEGER NULL REFERENCES public.orders(id) ON DELETE SET NULL,
-                            title TEXT NOT NULL,
-                            body  TEXT NOT NULL,
-                            status TEXT NOT NULL DEFAULT 'unread',
-                            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-                            read_at    TIMESTAMPTZ NULL
-                        );
-                    """)
-                    cur.execute("CREATE INDEX IF NOT EXISTS idx_user_notifications_user_created ON public.user_notifications(user_id, created_at DESC);")
-                    cur.execute("CREATE INDEX IF NOT EXISTS idx_user_notifications_status ON public.user_notifications(status);")
-
-                    # trigger: notify on wallet_txns insert (skip asiacell_topup or meta.no_notify)
-                    # announcements (for app-wide news)
-                    cur.execute("""
-                        CREATE OR REPLACE FUNCTION public.wallet_txns_notify()
-                        RETURNS trigger AS $$
-                        DECLARE
-                            t TEXT := 'تم تعديل رصيدك';
-                            b TEXT;
-                        BEGIN
-                            IF NEW.reason = 'asiacell_topup' THEN
-                                RETURN NEW;
-                            END IF;
-                            IF NEW.meta IS NOT NULL AND (NEW.meta ? 'no_notify') AND (NEW.meta->>'no_notify')::boolean IS TRUE THEN
-                                RETURN NEW;
-                            END IF;
-                            b := 'تم تحديث رصيدك. الرصيد الحالي: ' || (SELECT balance FROM public.users WHERE id=NEW.user_id) || ' دينار.';
-                            PERFORM pg_notify('wallet_change', json_build_object(
-                                'user_id', NEW.user_id,
-                                'title', t,
-                                'body',  b
-                            )::text);
-                            RETURN NEW;
-                        END;
-                        $$ LANGUAGE plpgsql;
-                    """)
-                    cur.execute("""
-                        DO $$
-                        BEGIN
-                            IF NOT EXISTS (
-                                SELECT 1 FROM pg_trigger WHERE tgname = 'wallet_txns_notify_ai'
-                            ) THEN
-                                CREATE TRIGGER wallet_txns_notify_ai
-                                AFTER INSERT ON public.wallet_txns
-                                FOR EACH ROW
-                                EXECUTE FUNCTION public.wallet_txns_notify();
-                            END IF;
-                        END $$;
-                    """)
-                finally:
-                    cur.execute("SELECT pg_advisory_unlock(987654321)")
+
+@migration(1, "base_schema")
+def _m0001_base_schema(cur):
+    cur.execute("CREATE SCHEMA IF NOT EXISTS public;")
+
+    # users
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS public.users(
+            id         SERIAL PRIMARY KEY,
+            uid        TEXT UNIQUE NOT NULL,
+            balance    NUMERIC(18,4) NOT NULL DEFAULT 0,
+            is_banned  BOOLEAN NOT NULL DEFAULT FALSE,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            fcm_token  TEXT
+        );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_uid ON public.users(uid);")
+
+    # user_devices (multi-device FCM tokens)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS public.user_devices(
+            id BIGSERIAL PRIMARY KEY,
+            uid TEXT NOT NULL,
+            fcm_token TEXT NOT NULL UNIQUE,
+            platform TEXT DEFAULT 'android',
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_user_devices_uid ON public.user_devices(uid);")
+
+    # wallet_txns
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS public.wallet_txns(
+            id         SERIAL PRIMARY KEY,
+            user_id    INTEGER NOT NULL REFERENCES public.users(id) ON DELETE CASCADE,
+            amount     NUMERIC(18,4) NOT NULL,
+            reason     TEXT,
+            meta       JSONB,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_wallet_txns_user ON public.wallet_txns(user_id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_wallet_txns_created ON public.wallet_txns(created_at);")
+
+    # orders
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS public.orders(
+            id                 SERIAL PRIMARY KEY,
+            user_id            INTEGER NOT NULL REFERENCES public.users(id) ON DELETE CASCADE,
+            title              TEXT NOT NULL,
+            service_id         BIGINT,
+            link               TEXT,
+            quantity           INTEGER NOT NULL DEFAULT 0,
+            price              NUMERIC(18,4) NOT NULL DEFAULT 0,
+            status             TEXT NOT NULL DEFAULT 'Pending',
+            provider_order_id  TEXT,
+            payload            JSONB DEFAULT '{}'::jsonb,
+            created_at         TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            type               TEXT
+        );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_user ON public.orders(user_id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_status ON public.orders(status);")
+    cur.execute("ALTER TABLE public.orders ADD COLUMN IF NOT EXISTS type TEXT;")
+    cur.execute("UPDATE public.orders SET type='provider' WHERE type IS NULL;")
+    cur.execute("ALTER TABLE public.orders ALTER COLUMN type SET DEFAULT 'provider';")
+    cur.execute("ALTER TABLE public.orders ALTER COLUMN type SET NOT NULL;")
+    cur.execute("UPDATE public.orders SET payload='{}'::jsonb WHERE payload IS NULL;")
+
+    # service overrides tables
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS public.service_id_overrides(
+            ui_key TEXT PRIMARY KEY,
+            service_id BIGINT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS public.service_pricing_overrides(
+            ui_key TEXT PRIMARY KEY,
+            price_per_k NUMERIC(18,6) NOT NULL,
+            min_qty INTEGER NOT NULL,
+            max_qty INTEGER NOT NULL,
+            mode TEXT NOT NULL DEFAULT 'per_k',
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS public.order_pricing_overrides(
+            order_id BIGINT PRIMARY KEY,
+            price NUMERIC(18,6) NOT NULL,
+            mode TEXT NOT NULL DEFAULT 'flat',
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    """)
+
+    # user_notifications
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS public.user_notifications(
+            id BIGSERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL REFERENCES public.users(id) ON DELETE CASCADE,
+            order_id INTEGER NULL REFERENCES public.orders(id) ON DELETE SET NULL,
+            title TEXT NOT NULL,
+            body  TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'unread',
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            read_at    TIMESTAMPTZ NULL
+        );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_user_notifications_user_created ON public.user_notifications(user_id, created_at DESC);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_user_notifications_status ON public.user_notifications(status);")
+
+    # trigger: notify on wallet_txns insert (skip asiacell_topup or meta.no_notify)
+    # announcements (for app-wide news)
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION public.wallet_txns_notify()
+        RETURNS trigger AS $$
+        DECLARE
+            t TEXT := 'تم تعديل رصيدك';
+            b TEXT;
+        BEGIN
+            IF NEW.reason = 'asiacell_topup' THEN
+                RETURN NEW;
+            END IF;
+            IF NEW.meta IS NOT NULL AND (NEW.meta ? 'no_notify') AND (NEW.meta->>'no_notify')::boolean IS TRUE THEN
+                RETURN NEW;
+            END IF;
+            b := 'تم تحديث رصيدك. الرصيد الحالي: ' || (SELECT balance FROM public.users WHERE id=NEW.user_id) || ' دينار.';
+            PERFORM pg_notify('wallet_change', json_build_object(
+                'user_id', NEW.user_id,
+                'title', t,
+                'body',  b
+            )::text);
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+    cur.execute("""
+        DO $$
+        BEGIN
+            IF NOT EXISTS (
+                SELECT 1 FROM pg_trigger WHERE tgname = 'wallet_txns_notify_ai'
+            ) THEN
+                CREATE TRIGGER wallet_txns_notify_ai
+                AFTER INSERT ON public.wallet_txns
+                FOR EACH ROW
+                EXECUTE FUNCTION public.wallet_txns_notify();
+            END IF;
+        END $$;
+    """)
+
+
+@migration(2, "user_passwords")
+def _m0002_user_passwords(cur):
+    """user_passwords table for UID password binding."""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS public.user_passwords (
+            uid TEXT PRIMARY KEY,
+            password_hash TEXT NOT NULL,
+            password_cipher BYTEA NOT NULL,
+            password_iv BYTEA NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        CREATE INDEX IF NOT EXISTS user_passwords_uid_idx ON public.user_passwords(uid);
+    """)
+
+@migration(3, "announcements")
+def _m0003_announcements(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS public.announcements(
+            id         BIGSERIAL PRIMARY KEY,
+            title      TEXT NULL,
+            body       TEXT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            updated_at TIMESTAMPTZ NULL
+        );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_announcements_created ON public.announcements(created_at DESC)")
+
+@migration(4, "idx_orders_user_id_desc", concurrent=True)
+def _m0004_idx_orders_user_id(conn):
+    # my-orders listing: WHERE user_id=? ORDER BY id DESC
+    _create_index_concurrently(conn, "idx_orders_user_id_desc",
+        "CREATE INDEX CONCURRENTLY idx_orders_user_id_desc ON public.orders(user_id, id DESC)")
+
+@migration(5, "idx_orders_pending", concurrent=True)
+def _m0005_idx_orders_pending(conn):
+    # admin pending buckets / auto-exec pickers only ever look at Pending rows
+    _create_index_concurrently(conn, "idx_orders_pending",
+        "CREATE INDEX CONCURRENTLY idx_orders_pending ON public.orders(id) WHERE status='Pending'")
+
+# ----- Auxiliary schema objects -----
+# Tables owned by feature sections further down (settings, code pools, pricing
+# overrides, ...) are declared with @schema_object on their _ensure_* helper.
+# Startup verifies them with a single catalog query, creates anything missing,
+# and marks them ready; from then on the helpers return without touching the
+# catalog, so request paths and daemon loops never issue DDL.
+_SCHEMA_OBJECTS: Dict[Tuple[str, Optional[str]], Any] = {}
+_schema_ready: set = set()
+
+def schema_object(table: str, column: Optional[str] = None):
+    """Register an _ensure_* helper for public.<table> (or one column of it)."""
+    def deco(fn):
+        key = (table, column)
+        _SCHEMA_OBJECTS[key] = fn
+        def wrapper(cur):
+            if key in _schema_ready:
+                return
+            fn(cur)
+        wrapper.__name__ = fn.__name__
+        wrapper.__doc__ = fn.__doc__
+        wrapper.raw = fn
+        return wrapper
+    return deco
+
+def _prepare_schema_objects() -> None:
+    keys = list(_SCHEMA_OBJECTS.keys())
+    if not keys:
+        return
+    conn = get_conn()
+    try:
+        with conn, conn.cursor() as cur:
+            probes = []
+            params: List[Any] = []
+            for table, column in keys:
+                if column:
+                    probes.append("EXISTS(SELECT 1 FROM information_schema.columns "
+                                  "WHERE table_schema='public' AND table_name=%s AND column_name=%s)")
+                    params += [table, column]
+                else:
+                    probes.append("to_regclass(%s) IS NOT NULL")
+                    params.append(f"public.{table}")
+            cur.execute("SELECT " + ", ".join(probes), params)
+            present = cur.fetchone()
+        for key, ok in zip(keys, present):
+            if not ok:
+                with conn, conn.cursor() as cur:
+                    cur.execute("SELECT pg_advisory_xact_lock(%s)", (_MIGRATION_LOCK_ID,))
+                    _SCHEMA_OBJECTS[key](cur)
+                logger.info("schema object %s created", ".".join(k for k in key if k))
+            _schema_ready.add(key)
+    finally:
+        put_conn(conn)
+
+@migration(6, "aux_tables")
+def _m0006_aux_tables(cur):
+    for fn in _SCHEMA_OBJECTS.values():
+        fn(cur)
+
+# === Auth AES key (for reveal_password) ===
+USERPWD_AES_KEY_B64 = os.getenv("USERPWD_AES_KEY")
+_AUTH_AES_KEY = base64.b64decode(USERPWD_AES_KEY_B64) if USERPWD_AES_KEY_B64 else None
+
+# === Auth crypto helpers ===
+def _auth_hash_password(pw: str) -> str:
+    return bcrypt.hashpw(pw.encode("utf-8"), bcrypt.gensalt(rounds=12)).decode("utf-8")
+
+def _auth_verify_password(pw: str, pw_hash: str) -> bool:
+    try:
+        return bcrypt.checkpw(pw.encode("utf-8"), pw_hash.encode("utf-8"))
+    except Exception:
+        return False
+
+def _auth_encrypt_password(uid: str, pw: str):
+    if _AUTH_AES_KEY is None:
+        raise HTTPException(status_code=500, detail="SERVER_MISCONFIGURED_AES_KEY")
+    iv = os.urandom(12)
+    aead = AESGCM(_AUTH_AES_KEY)
+    ct = aead.encrypt(iv, pw.encode("utf-8"), uid.encode("utf-8"))
+    return iv, ct
+
+def _auth_decrypt_password(uid: str, iv: bytes, ct: bytes) -> str:
+    if _AUTH_AES_KEY is None:
+        raise HTTPException(status_code=500, detail="SERVER_MISCONFIGURED_AES_KEY")
+    aead = AESGCM(_AUTH_AES_KEY)
+    pt = aead.decrypt(iv, ct, uid.encode("utf-8"))
+    return pt.decode("utf-8")
+
+
+
+
+
+# =========================
+# FastAPI
+# =========================
+app = FastAPI(title="SMM Backend", version="1.9.3")
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"], allow_credentials=True,
+    allow_methods=["*"], allow_headers=["*"]
+)
+
+def _prepare_schema():
+    run_migrations()
+    _prepare_schema_objects()
+
+@app.on_event("startup")
+async def _startup_migrations():
+    # registered first so every other startup hook sees the final schema
+    await _run_blocking(_prepare_schema)
+
+# =========================
+# Blocking work off the event loop
+# =========================
+# async handlers hand psycopg2/requests work to this executor instead of running
+# it on the loop; a dedicated pool keeps a slow FCM fan-out from starving the
+# threadpool that serves sync endpoints.
+BLOCKING_WORKERS = int(os.getenv("BLOCKING_WORKERS", "16"))
+_blocking_executor = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="blocking")
+
+async def _run_blocking(fn, *args, **kwargs):
+    """Run a blocking callable in the blocking executor, keeping the request context (route, diagnostics)."""
+    ctx = contextvars.copy_context()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_blocking_executor, lambda: ctx.run(fn, *args, **kwargs))
+
+def _with_conn(fn, *args, **kwargs):
+    """Call fn(conn, ...) with a pooled connection; for executor jobs that take a connection."""
+    conn = get_conn()
+    try:
+        return fn(conn, *args, **kwargs)
+    finally:
+        put_conn(conn)
+
+@app.on_event("shutdown")
+def _shutdown_blocking_executor():
+    _blocking_executor.shutdown(wait=False)
+
+@app.on_event("shutdown")
+async def _shutdown_http_clients():
+    for dest in _http_destinations.values():
+        await dest.aclose()
+
+# =========================
+# Event-loop lag monitor
+# =========================
+LOOP_LAG_MONITOR = os.getenv("LOOP_LAG_MONITOR", "1") == "1"
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.1"))        # heartbeat period (s)
+LOOP_LAG_THRESHOLD_MS = float(os.getenv("LOOP_LAG_THRESHOLD_MS", "200"))  # stalls longer than this are captured
+
+class LoopLagMonitor:
+    """
+    A heartbeat task sleeps LOOP_LAG_INTERVAL and records how late it wakes up.
+    A watchdog thread notices when the heartbeat stops ticking for longer than
+    the threshold and captures the loop thread's stack while it is still
+    stuck, together with the requests in flight. When the heartbeat resumes,
+    the stall is recorded against the innermost frame from this module.
+    """
+
+    def __init__(self, interval: float, threshold_ms: float, samples: int = 4096):
+        self.interval = float(interval)
+        self.threshold_ms = float(threshold_ms)
+        self._lock = threading.Lock()
+        self._samples: "deque[Tuple[float, float]]" = deque(maxlen=samples)  # (monotonic ts, lag ms)
+        self._inflight: Dict[int, Any] = {}
+        self._stalls: "deque[Dict[str, Any]]" = deque(maxlen=50)
+        self._pending: Optional[Dict[str, Any]] = None
+        self._beat = time.monotonic()
+        self._loop_thread: Optional[int] = None
+        self._pct_cache: Tuple[float, Dict[str, float]] = (0.0, {"p50": 0.0, "p95": 0.0, "p99": 0.0})
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.started_at = time.time()
+            self._samples.clear()
+            self._stalls.clear()
+            self.by_site: Dict[str, Dict[str, Any]] = {}
+            self.stall_count = 0
+            self.lag_ms_max = 0.0
+
+    # ---- request tracking (called from the logging middleware) ----
+    def enter(self, scope) -> int:
+        key = id(scope)
+        self._inflight[key] = (scope, time.monotonic())
+        return key
+
+    def exit(self, key: int) -> None:
+        self._inflight.pop(key, None)
+
+    def lag_since(self, t0: float) -> float:
+        """Worst heartbeat lag observed since monotonic time t0."""
+        worst = 0.0
+        with self._lock:
+            for ts, lag in reversed(self._samples):
+                if ts < t0:
+                    break
+                worst = max(worst, lag)
+        return worst
+
+    def percentiles(self) -> Dict[str, float]:
+        # cached for a second; the request log line reads this on every request
+        now = time.monotonic()
+        at, cached = self._pct_cache
+        if now - at < 1.0:
+            return cached
+        with self._lock:
+            lags = [lag for _, lag in self._samples]
+        pct = PoolDiagnostics._percentiles(lags)
+        self._pct_cache = (now, pct)
+        return pct
+
+    # ---- heartbeat (event loop) ----
+    async def run(self) -> None:
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        threading.Thread(target=self._watchdog, name="loop-watchdog", daemon=True).start()
+        while True:
+            t0 = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            beat, self._beat = self._beat, now
+            lag = max(0.0, (now - t0 - self.interval) * 1000.0)
+            # snapshot()/reset() run on threadpool threads
+            with self._lock:
+                self._samples.append((now, lag))
+            if lag > self.lag_ms_max:
+                self.lag_ms_max = lag
+            if lag >= self.threshold_ms:
+                self._record_stall(lag, beat)
+            elif self._pending is not None:
+                self._pending = None
+
+    def _record_stall(self, lag: float, beat: float) -> None:
+        with self._lock:
+            stall, self._pending = self._pending, None
+            if stall is not None and stall.pop("beat") != beat:
+                stall = None
+            if stall is None:
+                # shorter than a watchdog tick; nothing was captured while it ran
+                stall = {"at": int(time.time() * 1000), "site": "unknown", "routes": [], "stack": None}
+            stall["lag_ms"] = round(lag, 1)
+            self.stall_count += 1
+            agg = self.by_site.setdefault(stall["site"], {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+            agg["count"] += 1
+            agg["total_ms"] = round(agg["total_ms"] + lag, 1)
+            agg["max_ms"] = max(agg["max_ms"], round(lag, 1))
+            self._stalls.append(stall)
+        logger.warning("event loop stalled %.0f ms at %s (in flight: %s)%s", lag, stall["site"],
+                       ", ".join(stall["routes"]) or "-", "\n" + stall["stack"] if stall["stack"] else "")
+
+    # ---- watchdog (own thread) ----
+    def _watchdog(self) -> None:
+        tick = max(0.01, min(self.interval, self.threshold_ms / 2000.0))
+        while True:
+            time.sleep(tick)
+            beat = self._beat
+            stalled_ms = (time.monotonic() - beat - self.interval) * 1000.0
+            if stalled_ms < self.threshold_ms or self._pending is not None:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            routes = []
+            for scope, t0 in list(self._inflight.values()):
+                route = scope.get("route")
+                path = getattr(route, "path", None) or scope.get("path", "")
+                routes.append(f"{scope.get('method', '')} {path} ({int((time.monotonic() - t0) * 1000)} ms)")
+            stack = traceback.extract_stack(frame)[-12:]
+            with self._lock:
+                self._pending = {
+                    "beat": beat,
+                    "at": int(time.time() * 1000),
+                    "site": self._site(stack),
+                    "routes": routes,
+                    "stack": "".join(traceback.format_list(stack)).rstrip(),
+                }
+
+    @staticmethod
+    def _site(stack) -> str:
+        here = os.path.abspath(__file__)
+        for fs in reversed(stack):
+            if os.path.abspath(fs.filename) == here:
+                return f"{os.path.basename(fs.filename)}:{fs.lineno} {fs.name}"
+        fs = stack[-1]
+        return f"{os.path.basename(fs.filename)}:{fs.lineno} {fs.name}"
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            lags = [lag for _, lag in self._samples]
+            by_site = {k: dict(v) for k, v in self.by_site.items()}
+            stalls = list(self._stalls)
+        return {
+            "since": int(self.started_at * 1000),
+            "interval_ms": int(self.interval * 1000),
+            "threshold_ms": self.threshold_ms,
+            "samples": len(lags),
+            "lag_ms": dict(PoolDiagnostics._percentiles(lags), max=round(self.lag_ms_max, 1)),
+            "stalls": self.stall_count,
+            "stalls_by_site": dict(sorted(by_site.items(), key=lambda kv: -kv[1]["total_ms"])),
+            "recent_stalls": stalls[::-1],
+        }
+
+loop_monitor: Optional[LoopLagMonitor] = LoopLagMonitor(LOOP_LAG_INTERVAL, LOOP_LAG_THRESHOLD_MS) if LOOP_LAG_MONITOR else None
+
+@app.on_event("startup")
+async def _startup_loop_monitor():
+    if loop_monitor is not None:
+        asyncio.create_task(loop_monitor.run())
+
+# =========================
+# Async DB (read path)
+# =========================
+# Hot polling endpoints (balance, my orders, notifications, pricing) read through
+# an asyncpg pool so they don't occupy threadpool workers. Writes stay on the
+# psycopg2 pool. If asyncpg is missing or the pool can't be created, the same
+# helpers run the query with psycopg2 in the threadpool.
+ASYNC_DB_ENABLED = os.getenv("ASYNC_DB", "1") == "1"
+ASYNC_DB_MAX = int(os.getenv("ASYNC_DB_POOL_MAX", "10"))
+ASYNC_DB_STATEMENT_CACHE = os.getenv("ASYNC_DB_STATEMENT_CACHE")  # default: off behind Neon's pgbouncer (-pooler host)
+
+_apool = None
+
+def _asyncpg_dsn(dsn: str) -> str:
+    # asyncpg forwards unknown URL params as server settings; channel_binding is libpq-only
+    from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+    parts = urlsplit(dsn)
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k != "channel_binding"]
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+async def _apool_init_conn(conn):
+    for typ in ("json", "jsonb"):
+        await conn.set_type_codec(typ, encoder=json.dumps, decoder=json.loads, schema="pg_catalog")
+
+@app.on_event("startup")
+async def _startup_async_db():
+    global _apool
+    if not ASYNC_DB_ENABLED:
+        return
+    try:
+        import asyncpg
+    except ImportError:
+        logger.warning("asyncpg not installed; async read path falls back to psycopg2")
+        return
+    dsn = _asyncpg_dsn(DATABASE_URL)
+    if ASYNC_DB_STATEMENT_CACHE is not None:
+        cache_size = int(ASYNC_DB_STATEMENT_CACHE)
+    else:
+        cache_size = 0 if "-pooler" in dsn else 100
+    try:
+        _apool = await asyncpg.create_pool(
+            dsn, min_size=1, max_size=ASYNC_DB_MAX,
+            statement_cache_size=cache_size,
+            max_inactive_connection_lifetime=POOL_MAX_LIFETIME,
+            init=_apool_init_conn,
+        )
+    except Exception as e:
+        logger.exception("asyncpg pool init failed, using psycopg2 fallback: %s", e)
+        _apool = None
+
+@app.on_event("shutdown")
+async def _shutdown_async_db():
+    global _apool
+    if _apool is not None:
+        pool, _apool = _apool, None
+        await pool.close()
+
+_PG_PLACEHOLDER = re.compile(r"%s|%%")
+
+def _to_dollar_params(sql: str) -> str:
+    """Rewrite psycopg2 '%s' placeholders to asyncpg '$n'."""
+    n = 0
+    def sub(m):
+        nonlocal n
+        if m.group(0) == "%%":
+            return "%"
+        n += 1
+        return f"${n}"
+    return _PG_PLACEHOLDER.sub(sub, sql)
+
+def _sync_fetch(sql: str, args: tuple) -> List[dict]:
+    conn = get_conn()
+    try:
+        with conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(sql, args)
+            return [dict(r) for r in cur.fetchall()]
+    finally:
+        put_conn(conn)
+
+async def _db_fetch(sql: str, *args) -> List[dict]:
+    """Run a read query (psycopg2 '%s' style) and return rows as dicts."""
+    if _apool is not None:
+        async with _apool.acquire() as conn:
+            rows = await conn.fetch(_to_dollar_params(sql), *args)
+        return [dict(r) for r in rows]
+    return await _run_blocking(_sync_fetch, sql, args)
+
+async def _db_fetchrow(sql: str, *args) -> Optional[dict]:
+    rows = await _db_fetch(sql, *args)
+    return rows[0] if rows else None
+
+# ===== Helpers =====
+
+def _tokens_for_uid(cur, uid: str):
+    """Return list of FCM tokens for a uid from user_devices or fallback to users.fcm_token (cached)"""
+    toks = _device_tokens.get(uid)
+    if toks is None:
+        toks = _load_device_tokens(cur, "uid", uid)
+    return toks
+
+def _require_admin(passwd: str):
+    if passwd != ADMIN_PASSWORD:
+        raise HTTPException(401, "bad admin password")
+
+_payload_jsonb: Optional[bool] = None
+
+def _payload_is_jsonb(conn) -> bool:
+    # column type only changes through a migration, so one lookup per process is enough
+    global _payload_jsonb
+    if _payload_jsonb is not None:
+        return _payload_jsonb
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT data_type FROM information_schema.columns
+                WHERE table_schema='public' AND table_name='orders' AND column_name='payload'
+            """)
+            row = cur.fetchone()
+    except Exception:
+        return False
+    if row:
+        _payload_jsonb = str(row[0]).lower() == "jsonb"
+    return bool(_payload_jsonb)
+
+async def _read_json_object(request: Request) -> Dict[str, Any]:
+    try:
+        data = await request.json()
+    except Exception:
+        raw = (await request.body()).decode("utf-8", errors="ignore").strip()
+        data = json.loads(raw) if raw else {}
+    if data is None:
+        return {}
+    if not isinstance(data, dict):
+        raise HTTPException(400, "Body must be a JSON object")
+    return data
+
+
+# =========================
+# Push outbox
+# =========================
+# Notifications are stored together with one push_outbox row per device token
+# in a single statement; background workers deliver them. Request paths never
+# wait on FCM. Workers claim due rows with FOR UPDATE SKIP LOCKED (safe across
+# processes), send them concurrently, retry transient failures with
+# exponential backoff and dead-letter the rest.
+PUSH_WORKERS = int(os.getenv("PUSH_WORKERS", "2"))
+PUSH_BATCH = int(os.getenv("PUSH_BATCH", "50"))
+PUSH_SEND_CONCURRENCY = int(os.getenv("PUSH_SEND_CONCURRENCY", "8"))
+PUSH_MAX_ATTEMPTS = int(os.getenv("PUSH_MAX_ATTEMPTS", "6"))
+PUSH_RETRY_BASE = float(os.getenv("PUSH_RETRY_BASE", "5"))        # seconds, doubled per attempt
+PUSH_RETRY_MAX = float(os.getenv("PUSH_RETRY_MAX", "900"))
+PUSH_POLL_INTERVAL = float(os.getenv("PUSH_POLL_INTERVAL", "1"))
+PUSH_STALE_AFTER = int(os.getenv("PUSH_STALE_AFTER", "120"))     # reclaim 'sending' rows older than this (s)
+PUSH_RETENTION_DAYS = int(os.getenv("PUSH_RETENTION_DAYS", "7"))
+
+@migration(9, "push_outbox")
+def _m0009_push_outbox(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS public.push_outbox(
+            id              BIGSERIAL PRIMARY KEY,
+            notification_id BIGINT NULL,
+            user_id         INTEGER NULL,
+            fcm_token       TEXT NOT NULL,
+            title           TEXT NOT NULL,
+            body            TEXT NOT NULL,
+            order_id        BIGINT NULL,
+            status          TEXT NOT NULL DEFAULT 'pending',  -- pending | sending | sent | dead
+            attempts        INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            locked_at       TIMESTAMPTZ NULL,
+            last_error      TEXT NULL,
+            created_at      TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            sent_at         TIMESTAMPTZ NULL
+        );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_push_outbox_due ON public.push_outbox(next_attempt_at, id) WHERE status='pending'")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_push_outbox_sending ON public.push_outbox(locked_at) WHERE status='sending'")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_push_outbox_created ON public.push_outbox(created_at)")
+
+def _enqueue_notification(cur, user_id: int, order_id: Optional[int], title: str, body: str) -> Tuple[int, int]:
+    """
+    Insert a user_notifications row and its push_outbox rows (one per device, tokens
+    resolved through the token cache like _tokens_for_uid) in one statement.
+    Returns (notification_id, pushes).
+    """
+    tokens = _device_tokens.get_user(user_id)
+    if tokens is None:
+        tokens = _load_device_tokens(cur, "id", user_id)
+    cur.execute("""
+        WITH n AS (
+            INSERT INTO public.user_notifications (user_id, order_id, title, body, status, created_at)
+            VALUES (%(user_id)s, %(order_id)s, %(title)s, %(body)s, 'unread', NOW())
+            RETURNING id
+        ), q AS (
+            INSERT INTO public.push_outbox (notification_id, user_id, fcm_token, title, body, order_id)
+            SELECT n.id, %(user_id)s, t.fcm_token, %(title)s, %(body)s, %(order_id)s
+            FROM n CROSS JOIN (SELECT DISTINCT unnest(%(tokens)s::text[]) AS fcm_token) t
+            RETURNING 1
+        )
+        SELECT (SELECT id FROM n), (SELECT count(*) FROM q)
+    """, {"user_id": user_id, "order_id": order_id, "title": title, "body": body, "tokens": tokens})
+    nid, pushes = cur.fetchone()
+    return int(nid), int(pushes)
+
+_push_wakeup = threading.Event()
+_push_send_pool = ThreadPoolExecutor(max_workers=PUSH_SEND_CONCURRENCY, thread_name_prefix="push-send")
+_PUSH_WORKERS_STARTED = False
+
+def _wake_push_workers() -> None:
+    _push_wakeup.set()
+
+def _push_backoff(attempts: int) -> float:
+    return min(PUSH_RETRY_MAX, PUSH_RETRY_BASE * (2 ** max(0, attempts - 1)))
+
+def _push_claim(limit: int) -> List[Tuple[int, str, str, str, Optional[int], int]]:
+    conn = get_conn()
+    try:
+        with conn, conn.cursor() as cur:
+            cur.execute("""
+                UPDATE public.push_outbox o
+                SET status='sending', locked_at=NOW(), attempts=o.attempts+1
+                WHERE o.id IN (
+                    SELECT id FROM public.push_outbox
+                    WHERE status='pending' AND next_attempt_at <= NOW()
+                    ORDER BY next_attempt_at, id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING o.id, o.fcm_token, o.title, o.body, o.order_id, o.attempts
+            """, (limit,))
+            return cur.fetchall()
+    finally:
+        put_conn(conn)
+
+def _push_finish(results: List[Tuple[int, str, Optional[str], float]]) -> None:
+    """results: (id, status, last_error, retry_delay_seconds)"""
+    if not results:
+        return
+    conn = get_conn()
+    try:
+        with conn, conn.cursor() as cur:
+            execute_values(cur, """
+                UPDATE public.push_outbox o
+                SET status = v.status,
+                    last_error = v.err,
+                    locked_at = NULL,
+                    sent_at = CASE WHEN v.status = 'sent' THEN NOW() ELSE o.sent_at END,
+                    next_attempt_at = CASE WHEN v.status = 'pending'
+                                           THEN NOW() + make_interval(secs => v.delay)
+                                           ELSE o.next_attempt_at END
+                FROM (VALUES %s) AS v(id, status, err, delay)
+                WHERE o.id = v.id AND o.status = 'sending'
+            """, results, template="(%s::bigint, %s, %s, %s::float8)")
+    finally:
+        put_conn(conn)
+
+def _push_drain_once() -> int:
+    rows = _push_claim(PUSH_BATCH)
+    if not rows:
+        return 0
+    futures = [(r, _push_send_pool.submit(_fcm_deliver, r[1], r[2], r[3], r[4])) for r in rows]
+    results = []
+    counts: Dict[str, int] = {}
+    for (oid, _tok, _t, _b, _order, attempts), fut in futures:
+        try:
+            outcome, detail = fut.result()
+        except Exception as e:
+            outcome, detail = FCM_RETRY, str(e)[:200]
+        counts[outcome] = counts.get(outcome, 0) + 1
+        if outcome == FCM_SENT:
+            results.append((oid, "sent", None, 0.0))
+        elif outcome == FCM_RETRY and attempts < PUSH_MAX_ATTEMPTS:
+            results.append((oid, "pending", detail, _push_backoff(attempts)))
+        else:
+            results.append((oid, "dead", f"{outcome}: {detail}"[:500], 0.0))
+    _push_finish(results)
+    logger.info("push outbox: %s", ", ".join(f"{k}={v}" for k, v in sorted(counts.items())))
+    return len(rows)
+
+def _push_maintenance() -> None:
+    conn = get_conn()
+    try:
+        with conn, conn.cursor() as cur:
+            # worker died between claim and finish
+            cur.execute("""
+                UPDATE public.push_outbox SET status='pending', locked_at=NULL, next_attempt_at=NOW()
+                WHERE status='sending' AND locked_at < NOW() - make_interval(secs => %s)
+            """, (PUSH_STALE_AFTER,))
+            if cur.rowcount:
+                logger.warning("push outbox: reclaimed %s stale rows", cur.rowcount)
+            cur.execute("""
+                DELETE FROM public.push_outbox
+                WHERE status IN ('sent','dead') AND created_at < NOW() - make_interval(days => %s)
+            """, (PUSH_RETENTION_DAYS,))
+    finally:
+        put_conn(conn)
+
+def _push_worker() -> None:
+    last_maint = 0.0
+    while True:
+        try:
+            if time.monotonic() - last_maint > 60:
+                last_maint = time.monotonic()
+                _push_maintenance()
+            _push_wakeup.clear()
+            if _push_drain_once():
+                continue
+        except Exception as e:
+            logger.exception("push outbox worker error: %s", e)
+            time.sleep(2)
+        _push_wakeup.wait(PUSH_POLL_INTERVAL)
+
+@app.on_event("startup")
+def _startup_push_workers():
+    global _PUSH_WORKERS_STARTED
+    if _PUSH_WORKERS_STARTED:
+        return
+    _PUSH_WORKERS_STARTED = True
+    for i in range(max(0, PUSH_WORKERS)):
+        threading.Thread(target=_push_worker, name=f"push-outbox-{i}", daemon=True).start()
+
+@app.get("/api/admin/push/outbox")
+def admin_push_outbox(x_admin_password: Optional[str] = Header(None, alias="x-admin-password"), password: Optional[str] = None, limit: int = 20):
+    """Outbox health: rows per status, age of the oldest due row, latest dead letters, FCM token cache, LISTEN consumers."""
+    _require_admin(_pick_admin_password(x_admin_password, password) or "")
+    conn = get_conn()
+    try:
+        with conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("SELECT status, count(*) AS n FROM public.push_outbox GROUP BY status")
+            counts = {r["status"]: int(r["n"]) for r in cur.fetchall()}
+            cur.execute("""
+                SELECT EXTRACT(EPOCH FROM (NOW() - MIN(next_attempt_at)))*1000 AS lag_ms
+                FROM public.push_outbox WHERE status='pending' AND next_attempt_at <= NOW()
+            """)
+            lag = cur.fetchone()["lag_ms"]
+            cur.execute("""
+                SELECT id, notification_id, user_id, order_id, title, attempts, last_error,
+                       (EXTRACT(EPOCH FROM created_at)*1000)::BIGINT AS created_at
+                FROM public.push_outbox WHERE status='dead'
+                ORDER BY id DESC LIMIT %s
+            """, (max(1, min(limit, 200)),))
+            dead = cur.fetchall()
+        return {"ok": True, "counts": counts, "due_lag_ms": int(lag or 0), "dead": dead, "fcm_auth": fcm_auth.stats(),
+                "listeners": {k: v.stats() for k, v in _pg_listeners.items()}, "sse": user_event_hub.stats(),
+                "http": {k: v.stats() for k, v in _http_destinations.items()},
+                "devices": dict(_device_tokens.stats(), prune_pending=len(_bad_tokens), seen_pending=len(_device_seen)),
+                "owner_digest": _owner_digest.stats()}
+    finally:
+        put_conn(conn)
+
+# =========================
+# Broadcast jobs
+# =========================
+# App-wide pushes (announcements, pricing changes) run as background jobs
+# instead of a serial send loop inside the admin request. A job pages through
+# user_devices by id (keyset), sends each page with bounded concurrency and
+# checkpoints the cursor and counters after every page, so a restart resumes
+# from the last finished page. Jobs are leased (locked_by/locked_at); the lease
+# is renewed every BROADCAST_HEARTBEAT seconds while a page is sending, and one
+# not renewed for BROADCAST_STALE_AFTER seconds is taken over by another worker.
+# Tokens that got a transient FCM error (429/5xx, timeouts) are handed to the
+# push outbox with the checkpoint, which retries them with backoff ("deferred").
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "1"))
+BROADCAST_PAGE = int(os.getenv("BROADCAST_PAGE", "500"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "16"))
+BROADCAST_STALE_AFTER = int(os.getenv("BROADCAST_STALE_AFTER", "120"))
+BROADCAST_HEARTBEAT = float(os.getenv("BROADCAST_HEARTBEAT", str(max(5.0, BROADCAST_STALE_AFTER / 4))))
+BROADCAST_POLL_INTERVAL = float(os.getenv("BROADCAST_POLL_INTERVAL", "5"))
+
+@migration(10, "broadcast_jobs")
+def _m0010_broadcast_jobs(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS public.broadcast_jobs(
+            id          BIGSERIAL PRIMARY KEY,
+            kind        TEXT NOT NULL,                   -- announcement | pricing
+            ref_id      BIGINT NULL,                     -- announcements.id for kind=announcement
+            title       TEXT NOT NULL,
+            body        TEXT NOT NULL,
+            status      TEXT NOT NULL DEFAULT 'pending',  -- pending | running | done | failed | cancelled
+            cursor_id   BIGINT NOT NULL DEFAULT 0,        -- last user_devices.id handled
+            total       INTEGER NOT NULL DEFAULT 0,       -- devices at enqueue time (estimate)
+            sent        INTEGER NOT NULL DEFAULT 0,
+            invalid     INTEGER NOT NULL DEFAULT 0,
+            failed      INTEGER NOT NULL DEFAULT 0,
+            locked_by   TEXT NULL,
+            locked_at   TIMESTAMPTZ NULL,
+            last_error  TEXT NULL,
+            created_at  TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            started_at  TIMESTAMPTZ NULL,
+            finished_at TIMESTAMPTZ NULL
+        );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_open ON public.broadcast_jobs(id) WHERE status IN ('pending','running')")
+
+@migration(23, "broadcast_jobs_deferred")
+def _m0023_broadcast_jobs_deferred(cur):
+    # tokens handed to the push outbox after a transient FCM error
+    cur.execute("ALTER TABLE public.broadcast_jobs ADD COLUMN IF NOT EXISTS deferred INTEGER NOT NULL DEFAULT 0")
+
+_broadcast_wakeup = threading.Event()
+_broadcast_send_pool = ThreadPoolExecutor(max_workers=BROADCAST_CONCURRENCY, thread_name_prefix="broadcast-send")
+_BROADCAST_WORKERS_STARTED = False
+_BROADCAST_OWNER = f"{os.getpid()}"
+
+def _enqueue_broadcast(cur, kind: str, title: str, body: str, ref_id: Optional[int] = None) -> Tuple[int, int]:
+    """Create a broadcast job in the caller's transaction. Returns (job_id, device_estimate)."""
+    cur.execute("""
+        INSERT INTO public.broadcast_jobs(kind, ref_id, title, body, total)
+        SELECT %s, %s, %s, %s, (SELECT count(*) FROM public.user_devices WHERE fcm_token <> '')
+        RETURNING id, total
+    """, (kind, ref_id, title, body))
+    jid, total = cur.fetchone()
+    return int(jid), int(total)
+
+def _wake_broadcast_workers() -> None:
+    _broadcast_wakeup.set()
+
+def _broadcast_claim(owner: str) -> Optional[Dict[str, Any]]:
+    conn = get_conn()
+    try:
+        with conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("""
+                UPDATE public.broadcast_jobs j
+                SET status='running', locked_by=%s, locked_at=NOW(), started_at=COALESCE(j.started_at, NOW())
+                WHERE j.id = (
+                    SELECT id FROM public.broadcast_jobs
+                    WHERE status='pending'
+                       OR (status='running' AND locked_at < NOW() - make_interval(secs => %s))
+                    ORDER BY id
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING j.id, j.kind, j.title, j.body, j.cursor_id, j.topic_sent_at
+            """, (owner, BROADCAST_STALE_AFTER))
+            return cur.fetchone()
+    finally:
+        put_conn(conn)
+
+def _broadcast_page(after_id: int, topic_sent_at: Optional[Any] = None) -> List[Tuple[int, str]]:
+    """Next page of devices; after a topic send only devices the topic did not reach."""
+    conn = get_conn()
+    try:
+        with conn, conn.cursor() as cur:
+            if topic_sent_at is None:
+                cur.execute("""
+                    SELECT id, fcm_token FROM public.user_devices
+                    WHERE id > %s AND fcm_token <> ''
+                    ORDER BY id
+                    LIMIT %s
+                """, (after_id, BROADCAST_PAGE))
+            else:
+                cur.execute("""
+                    SELECT id, fcm_token FROM public.user_devices
+                    WHERE id > %s AND fcm_token <> ''
+                      AND (topic_subscribed_at IS NULL OR topic_subscribed_at > %s)
+                    ORDER BY id
+                    LIMIT %s
+                """, (after_id, topic_sent_at, BROADCAST_PAGE))
+            return cur.fetchall()
+    finally:
+        put_conn(conn)
+
+def _broadcast_topic_send(jid: int, owner: str, title: str, body: str) -> Optional[Any]:
+    """Send the job once to FCM_TOPIC_ALL; returns the recorded topic_sent_at, or None to fan out per token."""
+    outcome, detail = _fcm_send_topic(FCM_TOPIC_ALL, title, body)
+    if outcome != FCM_SENT:
+        logger.warning("broadcast #%s topic send failed (%s: %s); falling back to per-token", jid, outcome, detail)
+        return None
+    conn = get_conn()
+    try:
+        with conn, conn.cursor() as cur:
+            cur.execute("""
+                UPDATE public.broadcast_jobs SET topic_sent_at=NOW(), locked_at=NOW()
+                WHERE id=%s AND locked_by=%s RETURNING topic_sent_at
+            """, (jid, owner))
+            row = cur.fetchone()
+            return row[0] if row else None
+    finally:
+        put_conn(conn)
+
+def _broadcast_renew(jid: int, owner: str) -> bool:
+    """Extend the lease mid-page; False when the job was cancelled or its lease was taken over."""
+    conn = get_conn()
+    try:
+        with conn, conn.cursor() as cur:
+            cur.execute("""
+                UPDATE public.broadcast_jobs SET locked_at = NOW()
+                WHERE id = %s AND locked_by = %s AND status = 'running'
+            """, (jid, owner))
+            return cur.rowcount == 1
+    finally:
+        put_conn(conn)
+
+def _broadcast_checkpoint(jid: int, owner: str, cursor_id: int, counts: Dict[str, int], done: bool = False,
+                          title: str = "", body: str = "", retry_tokens: Optional[List[str]] = None) -> bool:
+    """
+    Advance the cursor and counters and queue retry_tokens in the push outbox, in one
+    transaction; False when the job was cancelled or its lease was taken over.
+    """
+    conn = get_conn()
+    try:
+        with conn, conn.cursor() as cur:
+            cur.execute("""
+                UPDATE public.broadcast_jobs
+                SET cursor_id = %s,
+                    sent = sent + %s, invalid = invalid + %s, failed = failed + %s, deferred = deferred + %s,
+                    locked_at = NOW(),
+                    status = CASE WHEN %s THEN 'done' ELSE status END,
+                    finished_at = CASE WHEN %s THEN NOW() ELSE finished_at END,
+                    locked_by = CASE WHEN %s THEN NULL ELSE locked_by END
+                WHERE id = %s AND locked_by = %s AND status = 'running'
+            """, (cursor_id, counts.get(FCM_SENT, 0), counts.get(FCM_INVALID, 0),
+                  counts.get(FCM_FAILED, 0), counts.get(FCM_RETRY, 0),
+                  done, done, done, jid, owner))
+            if cur.rowcount != 1:
+                return False
+            if retry_tokens:
+                # first attempt already made: the outbox continues from attempt 2
+                execute_values(cur, """
+                    INSERT INTO public.push_outbox(fcm_token, title, body, attempts, next_attempt_at)
+                    VALUES %s
+                """, [(t, title, body) for t in retry_tokens],
+                    template=f"(%s, %s, %s, 1, NOW() + make_interval(secs => {_push_backoff(1)}))")
+        if retry_tokens:
+            _wake_push_workers()
+        return True
+    finally:
+        put_conn(conn)
+
+def _broadcast_run(job: Dict[str, Any], owner: str) -> None:
+    jid, title, body = job["id"], job["title"], job["body"]
+    cursor_id = int(job["cursor_id"] or 0)
+    topic_sent_at = job.get("topic_sent_at")
+    logger.info("broadcast #%s (%s) started at cursor %s", jid, job["kind"], cursor_id)
+    if topic_sent_at is None and FCM_TOPIC_BROADCAST and cursor_id == 0 and _fcm_configured():
+        topic_sent_at = _broadcast_topic_send(jid, owner, title, body)
+    while True:
+        rows = _broadcast_page(cursor_id, topic_sent_at)
+        if not rows:
+            _broadcast_checkpoint(jid, owner, cursor_id, {}, done=True)
+            logger.info("broadcast #%s done", jid)
+            return
+        futures = {_broadcast_send_pool.submit(_fcm_deliver, tok, title, body, None): tok for _id, tok in rows}
+        counts: Dict[str, int] = {}
+        retry_tokens: List[str] = []
+        pending = set(futures)
+        while pending:
+            finished, pending = _wait_futures(pending, timeout=BROADCAST_HEARTBEAT)
+            for fut in finished:
+                try:
+                    outcome, _detail = fut.result()
+                except Exception:
+                    outcome = FCM_RETRY
+                counts[outcome] = counts.get(outcome, 0) + 1
+                if outcome == FCM_RETRY:
+                    retry_tokens.append(futures[fut])
+            # a slow page (degraded FCM) must not look like a dead worker
+            if pending and not _broadcast_renew(jid, owner):
+                for fut in pending:
+                    fut.cancel()
+                logger.warning("broadcast #%s stopped mid-page: cancelled or lease lost", jid)
+                return
+        cursor_id = int(rows[-1][0])
+        if not _broadcast_checkpoint(jid, owner, cursor_id, counts, title=title, body=body, retry_tokens=retry_tokens):
+            logger.warning("broadcast #%s stopped: cancelled or lease lost", jid)
+            return
+
+def _broadcast_worker(idx: int) -> None:
+    owner = f"{_BROADCAST_OWNER}:{idx}"
+    while True:
+        try:
+            _broadcast_wakeup.clear()
+            job = _broadcast_claim(owner)
+            if job:
+                try:
+                    _broadcast_run(job, owner)
+                except Exception as e:
+                    logger.exception("broadcast #%s error: %s", job["id"], e)
+                    # leave it 'running'; the stale lease makes it resumable from the last checkpoint
+                    time.sleep(2)
+                continue
+        except Exception as e:
+            logger.exception("broadcast worker error: %s", e)
+            time.sleep(2)
+        _broadcast_wakeup.wait(BROADCAST_POLL_INTERVAL)
+
+@app.on_event("startup")
+def _startup_broadcast_workers():
+    global _BROADCAST_WORKERS_STARTED
+    if _BROADCAST_WORKERS_STARTED:
+        return
+    _BROADCAST_WORKERS_STARTED = True
+    for i in range(max(0, BROADCAST_WORKERS)):
+        threading.Thread(target=_broadcast_worker, args=(i,), name=f"broadcast-{i}", daemon=True).start()
+
+_BROADCAST_COLUMNS = """
+    id, kind, ref_id, title, status, cursor_id, total, sent, invalid, failed, deferred, last_error,
+    (EXTRACT(EPOCH FROM created_at)*1000)::BIGINT AS created_at,
+    (EXTRACT(EPOCH FROM started_at)*1000)::BIGINT AS started_at,
+    (EXTRACT(EPOCH FROM finished_at)*1000)::BIGINT AS finished_at,
+    (EXTRACT(EPOCH FROM topic_sent_at)*1000)::BIGINT AS topic_sent_at,
+    EXTRACT(EPOCH FROM (COALESCE(finished_at, NOW()) - started_at)) AS elapsed_s
+"""
+
+def _broadcast_view(r: Dict[str, Any]) -> Dict[str, Any]:
+    done = int(r["sent"]) + int(r["invalid"]) + int(r["failed"]) + int(r["deferred"])
+    elapsed = float(r.pop("elapsed_s") or 0)
+    total = int(r["total"])
+    r["processed"] = done
+    if r["status"] == "done":
+        r["progress"] = 1.0
+    else:
+        r["progress"] = round(min(1.0, done / total), 4) if total else 0.0
+    r["per_second"] = round(done / elapsed, 1) if elapsed > 0 else 0.0
+    return r
+
+@app.get("/api/admin/broadcasts")
+def admin_broadcasts(x_admin_password: Optional[str] = Header(None, alias="x-admin-password"), password: Optional[str] = None, limit: int = 20):
+    """Recent broadcast jobs with progress and throughput."""
+    _require_admin(_pick_admin_password(x_admin_password, password) or "")
+    conn = get_conn()
+    try:
+        with conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(f"SELECT {_BROADCAST_COLUMNS} FROM public.broadcast_jobs ORDER BY id DESC LIMIT %s",
+                        (max(1, min(limit, 200)),))
+            return {"ok": True, "jobs": [_broadcast_view(r) for r in cur.fetchall()]}
+    finally:
+        put_conn(conn)
+
+@app.get("/api/admin/broadcasts/{jid}")
+def admin_broadcast_get(jid: int, x_admin_password: Optional[str] = Header(None, alias="x-admin-password"), password: Optional[str] = None):
+    _require_admin(_pick_admin_password(x_admin_password, password) or "")
+    conn = get_conn()
+    try:
+        with conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(f"SELECT {_BROADCAST_COLUMNS} FROM public.broadcast_jobs WHERE id=%s", (jid,))
+            r = cur.fetchone()
+            if not r:
+                raise HTTPException(404, "broadcast not found")
+            return {"ok": True, "job": _broadcast_view(r)}
+    finally:
+        put_conn(conn)
+
+@app.post("/api/admin/broadcasts/{jid}/cancel")
+def admin_broadcast_cancel(jid: int, x_admin_password: Optional[str] = Header(None, alias="x-admin-password"), password: Optional[str] = None):
+    _require_admin(_pick_admin_password(x_admin_password, password) or "")
+    conn = get_conn()
+    try:
+        with conn, conn.cursor() as cur:
+            cur.execute("""
+                UPDATE public.broadcast_jobs SET status='cancelled', finished_at=NOW(), locked_by=NULL
+                WHERE id=%s AND status IN ('pending','running')
+            """, (jid,))
+            return {"ok": True, "cancelled": cur.rowcount == 1}
+    finally:
+        put_conn(conn)
+
+# =========================
+# FCM topics
+# =========================
+# Every device is subscribed to FCM_TOPIC_ALL, so an app-wide broadcast is a
+# single topic send; the broadcast job then only fans out per token to devices
+# the topic did not cover yet. Subscriptions are done in IID batchAdd calls
+# (1000 tokens each) by a background loop that handles both freshly registered
+# devices and the backfill of existing rows (topic_subscribed_at IS NULL).
+FCM_TOPIC_ALL = os.getenv("FCM_TOPIC_ALL", "all")
+FCM_TOPIC_BROADCAST = os.getenv("FCM_TOPIC_BROADCAST", "1") == "1"
+FCM_TOPIC_BATCH = max(1, min(1000, int(os.getenv("FCM_TOPIC_BATCH", "1000"))))
+FCM_TOPIC_SYNC_INTERVAL = float(os.getenv("FCM_TOPIC_SYNC_INTERVAL", "60"))
+
+@migration(11, "fcm_topics")
+def _m0011_fcm_topics(cur):
+    cur.execute("ALTER TABLE public.user_devices ADD COLUMN IF NOT EXISTS topic_subscribed_at TIMESTAMPTZ NULL")
+    cur.execute("ALTER TABLE public.broadcast_jobs ADD COLUMN IF NOT EXISTS topic_sent_at TIMESTAMPTZ NULL")
+
+@migration(12, "idx_user_devices_topic_pending", concurrent=True)
+def _m0012_idx_user_devices_topic_pending(conn):
+    _create_index_concurrently(conn, "idx_user_devices_topic_pending", """
+        CREATE INDEX CONCURRENTLY idx_user_devices_topic_pending
+        ON public.user_devices(id) WHERE topic_subscribed_at IS NULL
+    """)
+
+_topic_wakeup = threading.Event()
+_TOPIC_SYNC_STARTED = False
+
+def _wake_topic_sync() -> None:
+    _topic_wakeup.set()
+
+def _topic_sync_pass() -> Dict[str, int]:
+    """Subscribe every not-yet-subscribed device once (keyset walk, so failing tokens cannot stall the pass)."""
+    stats = {"subscribed": 0, "invalid": 0, "skipped": 0}
+    after_id = 0
+    while True:
+        conn = get_conn()
+        try:
+            with conn, conn.cursor() as cur:
+                cur.execute("""
+                    SELECT id, fcm_token FROM public.user_devices
+                    WHERE topic_subscribed_at IS NULL AND id > %s AND fcm_token <> ''
+                    ORDER BY id LIMIT %s
+                """, (after_id, FCM_TOPIC_BATCH))
+                rows = cur.fetchall()
+        finally:
+            put_conn(conn)
+        if not rows:
+            return stats
+        after_id = int(rows[-1][0])
+        tokens = [r[1] for r in rows]
+        ok, invalid = _fcm_topic_subscribe(tokens, FCM_TOPIC_ALL)
+        if ok:
+            conn = get_conn()
+            try:
+                with conn, conn.cursor() as cur:
+                    cur.execute("UPDATE public.user_devices SET topic_subscribed_at=NOW() WHERE fcm_token = ANY(%s)", (ok,))
+            finally:
+                put_conn(conn)
+        if invalid:
+            _prune_bad_fcm_tokens(invalid)
+        stats["subscribed"] += len(ok)
+        stats["invalid"] += len(invalid)
+        stats["skipped"] += len(tokens) - len(ok) - len(invalid)
+
+def _topic_sync_worker() -> None:
+    while True:
+        try:
+            _topic_wakeup.clear()
+            st = _topic_sync_pass()
+            if st["subscribed"] or st["invalid"]:
+                logger.info("fcm topic sync: %s", st)
+        except Exception as e:
+            logger.warning("fcm topic sync failed: %s", e)
+        _topic_wakeup.wait(FCM_TOPIC_SYNC_INTERVAL)
+
+@app.on_event("startup")
+def _startup_topic_sync():
+    global _TOPIC_SYNC_STARTED
+    if _TOPIC_SYNC_STARTED or not FCM_TOPIC_BROADCAST or not _fcm_configured():
+        return
+    _TOPIC_SYNC_STARTED = True
+    threading.Thread(target=_topic_sync_worker, name="fcm-topic-sync", daemon=True).start()
+
+# =========================
+# Device garbage collection
+# =========================
+# Devices whose token has not been refreshed (api_users_fcm_token bumps
+# updated_at) for DEVICE_STALE_DAYS are removed in batches, together with a
+# matching users.fcm_token. The same thread flushes the invalid-token queue
+# filled by the FCM senders every DEVICE_PRUNE_INTERVAL seconds.
+DEVICE_STALE_DAYS = int(os.getenv("DEVICE_STALE_DAYS", "90"))            # 0 disables stale-device GC
+DEVICE_GC_INTERVAL = float(os.getenv("DEVICE_GC_INTERVAL", "3600"))
+DEVICE_GC_BATCH = int(os.getenv("DEVICE_GC_BATCH", "1000"))
+DEVICE_PRUNE_INTERVAL = float(os.getenv("DEVICE_PRUNE_INTERVAL", "30"))
+# Unchanged registrations only record a last-seen time in memory; the GC
+# thread writes them in one batch, skipping devices already touched within
+# DEVICE_SEEN_RESOLUTION seconds.
+DEVICE_SEEN_RESOLUTION = int(os.getenv("DEVICE_SEEN_RESOLUTION", "3600"))
+DEVICE_SEEN_MAX = int(os.getenv("DEVICE_SEEN_MAX", "5000"))    # flush early once this many tokens are buffered
+_DEVICE_GC_STARTED = False
+_device_seen: Dict[str, float] = {}
+_device_seen_lock = threading.Lock()
+
+def _device_touch(fcm_token: str) -> None:
+    with _device_seen_lock:
+        _device_seen[fcm_token] = time.time()
+        n = len(_device_seen)
+    if n >= DEVICE_SEEN_MAX:
+        _device_gc_wakeup.set()
+
+def _flush_device_seen() -> int:
+    with _device_seen_lock:
+        if not _device_seen:
+            return 0
+        batch = dict(_device_seen)
+        _device_seen.clear()
+    tokens = list(batch)
+    try:
+        conn = get_conn()
+        try:
+            with conn, conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE public.user_devices d SET updated_at = v.seen
+                    FROM (SELECT t.fcm_token, to_timestamp(t.ts) AS seen
+                          FROM unnest(%s::text[], %s::float8[]) AS t(fcm_token, ts)) v
+                    WHERE d.fcm_token = v.fcm_token
+                      AND d.updated_at < v.seen - make_interval(secs => %s)
+                """, (tokens, [batch[t] for t in tokens], DEVICE_SEEN_RESOLUTION))
+                return cur.rowcount
+        finally:
+            put_conn(conn)
+    except Exception:
+        # keep the newer of the buffered and failed timestamps for the next pass
+        with _device_seen_lock:
+            for t, ts in batch.items():
+                if _device_seen.get(t, 0) < ts:
+                    _device_seen[t] = ts
+        raise
+
+@migration(21, "idx_user_devices_updated_at", concurrent=True)
+def _m0021_idx_user_devices_updated_at(conn):
+    _create_index_concurrently(conn, "idx_user_devices_updated_at", """
+        CREATE INDEX CONCURRENTLY idx_user_devices_updated_at ON public.user_devices(updated_at)
+    """)
+
+def _device_gc_stale() -> int:
+    if DEVICE_STALE_DAYS <= 0:
+        return 0
+    removed = 0
+    while True:
+        conn = get_conn()
+        try:
+            with conn, conn.cursor() as cur:
+                cur.execute("""
+                    DELETE FROM public.user_devices
+                    WHERE id IN (
+                        SELECT id FROM public.user_devices
+                        WHERE updated_at < NOW() - make_interval(days => %s)
+                        ORDER BY updated_at LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING fcm_token
+                """, (DEVICE_STALE_DAYS, DEVICE_GC_BATCH))
+                tokens = [r[0] for r in cur.fetchall()]
+                if tokens:
+                    cur.execute("UPDATE public.users SET fcm_token=NULL WHERE fcm_token = ANY(%s)", (tokens,))
+        finally:
+            put_conn(conn)
+        if tokens:
+            _device_tokens.invalidate_tokens(tokens)
+            removed += len(tokens)
+        if len(tokens) < DEVICE_GC_BATCH:
+            return removed
+
+def _device_gc_worker() -> None:
+    next_stale = 0.0
+    while True:
+        try:
+            _device_gc_wakeup.clear()
+            pruned = _flush_bad_fcm_tokens()
+            _flush_device_seen()
+            stale = 0
+            if time.monotonic() >= next_stale:
+                next_stale = time.monotonic() + DEVICE_GC_INTERVAL
+                stale = _device_gc_stale()
+            if pruned or stale:
+                logger.info("device gc: pruned=%s stale=%s", pruned, stale)
+        except Exception as e:
+            logger.warning("device gc failed: %s", e)
+        _device_gc_wakeup.wait(DEVICE_PRUNE_INTERVAL)
+
+@app.on_event("startup")
+def _startup_device_gc():
+    global _DEVICE_GC_STARTED
+    if _DEVICE_GC_STARTED:
+        return
+    _DEVICE_GC_STARTED = True
+    threading.Thread(target=_device_gc_worker, name="device-gc", daemon=True).start()
+
+@app.on_event("shutdown")
+def _shutdown_device_seen():
+    try:
+        _flush_device_seen()
+    except Exception as e:
+        logger.warning("device last-seen flush failed: %s", e)
+
+@app.get("/api/admin/push/topics")
+def admin_push_topics(x_admin_password: Optional[str] = Header(None, alias="x-admin-password"), password: Optional[str] = None):
+    """Topic subscription coverage of user_devices."""
+    _require_admin(_pick_admin_password(x_admin_password, password) or "")
+    conn = get_conn()
+    try:
+        with conn, conn.cursor() as cur:
+            cur.execute("""
+                SELECT count(*) FILTER (WHERE topic_subscribed_at IS NOT NULL),
+                       count(*) FILTER (WHERE topic_subscribed_at IS NULL)
+                FROM public.user_devices WHERE fcm_token <> ''
+            """)
+            subscribed, pending = cur.fetchone()
+        return {"ok": True, "topic": FCM_TOPIC_ALL, "enabled": FCM_TOPIC_BROADCAST and _fcm_configured(),
+                "subscribed": int(subscribed), "pending": int(pending)}
     finally:
         put_conn(conn)
 
+# =========================
+# LISTEN consumers
+# =========================
+# A PgListener owns one dedicated connection (outside the pool, and on the
+# direct host: LISTEN does not survive Neon's transaction-mode pooler) and
+# calls its handler whenever notifications arrive, after every (re)connect and
+# on an idle timer. Handlers treat notifications only as a wake-up and read
+# their source table from a persisted cursor, so events missed while
+# disconnected are caught up. With leader_lock set only the process holding
+# that advisory lock consumes.
+LISTEN_DATABASE_URL = os.getenv("LISTEN_DATABASE_URL", "").strip() or DATABASE_URL.replace("-pooler.", ".")
+LISTEN_IDLE_POLL = float(os.getenv("LISTEN_IDLE_POLL", "30"))
+LISTEN_COALESCE_MS = int(os.getenv("LISTEN_COALESCE_MS", "50"))   # gather a burst before handling it
+
+class PgListener:
+    def __init__(self, name: str, channels: List[str], handler, leader_lock: Optional[int] = None,
+                 idle_poll: float = LISTEN_IDLE_POLL):
+        self.name = name
+        self.channels = list(channels)
+        self.handler = handler
+        self.leader_lock = leader_lock
+        self.idle_poll = idle_poll
+        self.connected = False
+        self.leader = False
+        self.events = 0
+        self.reconnects = 0
+        self.last_error: Optional[str] = None
+        self._started = False
+
+    def start(self) -> None:
+        if self._started:
+            return
+        self._started = True
+        threading.Thread(target=self._run, name=f"pg-listen-{self.name}", daemon=True).start()
 
-
-def ensure_announcements():
+    def _connect(self):
+        conn = psycopg2.connect(LISTEN_DATABASE_URL, keepalives=1, keepalives_idle=30,
+                                keepalives_interval=10, keepalives_count=3)
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            if self.leader_lock is not None:
+                cur.execute("SELECT pg_try_advisory_lock(%s)", (self.leader_lock,))
+                if not cur.fetchone()[0]:
+                    conn.close()
+                    return None
+            for ch in self.channels:
+                cur.execute(f"LISTEN {ch}")
+        return conn
+
+    def _run(self) -> None:
+        backoff = 1.0
+        while True:
+            conn = None
+            try:
+                conn = self._connect()
+                if conn is None:
+                    # another process consumes; try to take over later
+                    time.sleep(self.idle_poll)
+                    continue
+                self.connected = self.leader = True
+                backoff = 1.0
+                self.handler([])  # catch up on anything missed while disconnected
+                while True:
+                    if select.select([conn], [], [], self.idle_poll) == ([], [], []):
+                        self.handler([])
+                        continue
+                    if LISTEN_COALESCE_MS > 0:
+                        time.sleep(LISTEN_COALESCE_MS / 1000.0)
+                    conn.poll()
+                    payloads = [n.payload for n in conn.notifies]
+                    conn.notifies.clear()
+                    if payloads:
+                        self.events += len(payloads)
+                        self.handler(payloads)
+            except Exception as e:
+                self.last_error = str(e)[:200]
+                logger.warning("listener %s: %s; reconnecting in %.0fs", self.name, e, backoff)
+            finally:
+                self.connected = self.leader = False
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            self.reconnects += 1
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60.0)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"channels": self.channels, "connected": self.connected, "leader": self.leader,
+                "events": self.events, "reconnects": self.reconnects, "last_error": self.last_error}
+
+_pg_listeners: Dict[str, PgListener] = {}
+
+# ---- wallet_change -> push pipeline ----
+# wallet_txns_notify() fires pg_notify('wallet_change') per ledger insert. The
+# consumer walks wallet_txns from a cursor kept in settings, turns balance
+# changes into notifications (same transaction as the cursor advance) and wakes
+# the push workers. Order charges/refunds are skipped: the order flow notifies
+# the user itself. SERIAL ids can commit out of order: ids missing below a
+# visible row are remembered with the snapshot xmax seen at that moment and
+# re-checked on every batch. One is dropped only once every transaction that
+# was running then has finished (snapshot xmin >= that xmax) and
+# WALLET_NOTIFY_SETTLE seconds have passed, i.e. it was rolled back or never used.
+WALLET_LISTENER = os.getenv("WALLET_LISTENER", "1") == "1"
+WALLET_NOTIFY_BATCH = int(os.getenv("WALLET_NOTIFY_BATCH", "200"))
+WALLET_NOTIFY_SETTLE = float(os.getenv("WALLET_NOTIFY_SETTLE", "5"))
+_WALLET_CURSOR_KEY = "wallet_notify_cursor"
+_WALLET_MAX_GAP = 10000   # a larger jump (e.g. setval) is not tracked id by id
+_WALLET_LISTENER_LOCK_ID = 987654323
+
+def _wallet_message(reason: Optional[str], amount: Any, meta: Any, balance: Any) -> Optional[Tuple[str, str]]:
+    meta = meta if isinstance(meta, dict) else {}
+    if reason in ("order_charge", "order_refund", "asiacell_topup"):
+        return None
+    if str(meta.get("no_notify")).lower() == "true":
+        return None
+    if reason == "paytabs_topup":
+        return "تمت إضافة رصيد", f"تم شحن رصيدك بمبلغ {_format_amount_for_notification(amount)} دولار."
+    if meta.get("compat") == "topup":
+        return "تمت إضافة رصيد", f"تمت إضافة {float(amount)} إلى رصيدك."
+    if meta.get("compat") == "deduct":
+        return "تم خصم رصيد", f"تم خصم {float(-amount)} من رصيدك."
+    return "تم تعديل رصيدك", f"تم تحديث رصيدك. الرصيد الحالي: {_format_amount_for_notification(balance)} دينار."
+
+def _wallet_notify_batch() -> Tuple[int, bool]:
+    """Handle one batch past the cursor (and any unresolved gaps). Returns (notifications queued, more rows may be ready)."""
     conn = get_conn()
     try:
-        with conn:
-            with conn.cursor() as cur:
+        with conn, conn.cursor() as cur:
+            cur.execute("SELECT value FROM public.settings WHERE key=%s FOR UPDATE", (_WALLET_CURSOR_KEY,))
+            row = cur.fetchone()
+            if row is None:
+                # first start: begin at the end of the ledger instead of replaying history
                 cur.execute("""
-                    CREATE TABLE IF NOT EXISTS public.announcements(
-                        id         BIGSERIAL PRIMARY KEY,
-                        title      TEXT NULL,
-                        body       TEXT NOT NULL,
-                        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-                        updated_at TIMESTAMPTZ NULL
-                    );
-                """)
-                try:
-                    cur.execute("CREATE INDEX IF NOT EXISTS idx_announcements_created ON public.announcements(created_at DESC)")
-                except Exception:
-                    pass
+                    INSERT INTO public.settings(key, value, updated_at)
+                    SELECT %s, to_jsonb(COALESCE(MAX(id), 0)), NOW() FROM public.wallet_txns
+                    ON CONFLICT (key) DO NOTHING
+                """, (_WALLET_CURSOR_KEY,))
+                return 0, False
+            state = row[0]
+            if isinstance(state, dict):
+                cursor = int(state.get("cursor") or 0)
+                gaps = {int(g[0]): (int(g[1]), float(g[2])) for g in state.get("gaps") or []}
+            else:
+                cursor, gaps = int(state or 0), {}
+            # xmin before reading and xmax after, so both bracket the snapshot the rows come from
+            cur.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint")
+            snap_xmin = cur.fetchone()[0]
+            cur.execute("""
+                SELECT t.id, t.user_id, t.amount, t.reason, t.meta,
+                       -- balance right after this entry
+                       u.balance - COALESCE((SELECT SUM(x.amount) FROM public.wallet_txns x
+                                             WHERE x.user_id = t.user_id AND x.id > t.id), 0)
+                FROM public.wallet_txns t
+                JOIN public.users u ON u.id = t.user_id
+                WHERE t.id = ANY(%s) OR t.id IN (
+                    SELECT id FROM public.wallet_txns WHERE id > %s ORDER BY id LIMIT %s
+                )
+                ORDER BY t.id
+            """, (list(gaps), cursor, WALLET_NOTIFY_BATCH))
+            rows = cur.fetchall()
+            cur.execute("""
+                SELECT pg_snapshot_xmax(pg_current_snapshot())::text::bigint,
+                       EXTRACT(EPOCH FROM clock_timestamp())::float8
+            """)
+            snap_xmax, now = cur.fetchone()
+            new_cursor, queued, scanned = cursor, 0, 0
+            for tid, user_id, amount, reason, meta, balance in rows:
+                if tid in gaps:
+                    del gaps[tid]          # a late commit filled the gap
+                elif tid > new_cursor:
+                    scanned += 1
+                    if tid - new_cursor - 1 > _WALLET_MAX_GAP:
+                        logger.warning("wallet notify: not tracking %s missing ids before %s", tid - new_cursor - 1, tid)
+                    else:
+                        for gid in range(new_cursor + 1, tid):
+                            gaps[gid] = (snap_xmax, now)
+                    new_cursor = tid
+                else:
+                    continue
+                msg = _wallet_message(reason, amount, meta, balance)
+                if msg:
+                    _enqueue_notification(cur, user_id, None, msg[0], msg[1])
+                    queued += 1
+            # still invisible after every transaction that could hold them ended: rolled back
+            gaps = {g: v for g, v in gaps.items()
+                    if not (snap_xmin >= v[0] and now - v[1] >= WALLET_NOTIFY_SETTLE)}
+            new_state = {"cursor": new_cursor, "gaps": [[g, x, t] for g, (x, t) in sorted(gaps.items())]}
+            if new_state != state:
+                cur.execute("UPDATE public.settings SET value=%s, updated_at=NOW() WHERE key=%s",
+                            (Json(new_state), _WALLET_CURSOR_KEY))
+        return queued, scanned == WALLET_NOTIFY_BATCH
     finally:
         put_conn(conn)
-ensure_schema()
-ensure_auth_schema()
-
-# === Auth AES key (for reveal_password) ===
-USERPWD_AES_KEY_B64 = os.getenv("USERPWD_AES_KEY")
-_AUTH_AES_KEY = base64.b64decode(USERPWD_AES_KEY_B64) if USERPWD_AES_KEY_B64 else None
-
-# === Auth crypto helpers ===
-def _auth_hash_password(pw: str) -> str:
-    return bcrypt.hashpw(pw.encode("utf-8"), bcrypt.gensalt(rounds=12)).decode("utf-8")
-
-def _auth_verify_password(pw: str, pw_hash: str) -> bool:
-    try:
-        return bcrypt.checkpw(pw.encode("utf-8"), pw_hash.encode("utf-8"))
-    except Exception:
-        return False
-
-def _auth_encrypt_password(uid: str, pw: str):
-    if _AUTH_AES_KEY is None:
-        raise HTTPException(status_code=500, detail="SERVER_MISCONFIGURED_AES_KEY")
-    iv = os.urandom(12)
-    aead = AESGCM(_AUTH_AES_KEY)
-    ct = aead.encrypt(iv, pw.encode("utf-8"), uid.encode("utf-8"))
-    return iv, ct
-
-def _auth_decrypt_password(uid: str, iv: bytes, ct: bytes) -> str:
-    if _AUTH_AES_KEY is None:
-        raise HTTPException(status_code=500, detail="SERVER_MISCONFIGURED_AES_KEY")
-    aead = AESGCM(_AUTH_AES_KEY)
-    pt = aead.decrypt(iv, ct, uid.encode("utf-8"))
-    return pt.decode("utf-8")
 
+def _wallet_notify_drain(_payloads: List[str]) -> None:
+    total = 0
+    while True:
+        queued, more = _wallet_notify_batch()
+        total += queued
+        if not more:
+            break
+    if total:
+        _wake_push_workers()
 
+@app.on_event("startup")
+def _startup_wallet_listener():
+    if not WALLET_LISTENER or "wallet" in _pg_listeners:
+        return
+    lst = PgListener("wallet", ["wallet_change"], _wallet_notify_drain, leader_lock=_WALLET_LISTENER_LOCK_ID,
+                     idle_poll=min(LISTEN_IDLE_POLL, WALLET_NOTIFY_SETTLE * 2))
+    _pg_listeners["wallet"] = lst
+    lst.start()
+
+# ---- user_events -> SSE streams ----
+# Triggers on user_notifications, announcements, orders (status) and users
+# (balance) append a row to user_events and pg_notify('user_events') with its
+# id and user (NULL for app-wide events). Every process runs a listener that
+# wakes the SSE streams of that user; a stream then reads user_events past the
+# last id it sent, which is also how Last-Event-ID resume works. BIGSERIAL ids
+# commit out of order, so readers never go past the settled watermark (see
+# UserEventWatermark): an id that commits after a higher one was sent would
+# otherwise be skipped for good.
+SSE_ENABLED = os.getenv("SSE_ENABLED", "1") == "1"
+SSE_HEARTBEAT = float(os.getenv("SSE_HEARTBEAT", "15"))
+SSE_MAX_STREAMS = int(os.getenv("SSE_MAX_STREAMS", "2000"))   # per process
+USER_EVENTS_RETENTION_HOURS = int(os.getenv("USER_EVENTS_RETENTION_HOURS", "48"))
+USER_EVENTS_SETTLE = float(os.getenv("USER_EVENTS_SETTLE", "1"))
+_USER_EVENTS_POLL = min(LISTEN_IDLE_POLL, max(1.0, USER_EVENTS_SETTLE * 2))
+_USER_EVENTS_SCAN = 1000
+_USER_EVENTS_MAX_GAP = 10000    # a larger jump (e.g. setval) is not tracked id by id
+_USER_EVENTS_MAX_HELD = 10000   # notifications waiting for the watermark; beyond this wake every stream
+
+@migration(14, "user_events")
+def _m0014_user_events(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS public.user_events(
+            id         BIGSERIAL PRIMARY KEY,
+            user_id    INTEGER NULL,                -- NULL: every user (announcements)
+            kind       TEXT NOT NULL,               -- notification | order | balance
+            data       JSONB NOT NULL DEFAULT '{}'::jsonb,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_user_events_user ON public.user_events(user_id, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_user_events_global ON public.user_events(id) WHERE user_id IS NULL")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_user_events_created ON public.user_events(created_at)")
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION public.smm_emit_user_event(p_user_id INTEGER, p_kind TEXT, p_data JSONB)
+        RETURNS VOID AS $$
+        DECLARE v_id BIGINT;
+        BEGIN
+            INSERT INTO public.user_events(user_id, kind, data) VALUES (p_user_id, p_kind, p_data)
+            RETURNING id INTO v_id;
+            PERFORM pg_notify('user_events', json_build_object('id', v_id, 'u', p_user_id)::text);
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION public.smm_user_events_trg()
+        RETURNS trigger AS $$
+        BEGIN
+            -- row triggers on a partitioned user_notifications fire under the partition's name
+            IF starts_with(TG_TABLE_NAME, 'user_notifications') THEN
+                PERFORM public.smm_emit_user_event(NEW.user_id, 'notification', jsonb_build_object(
+                    'id', NEW.id, 'title', NEW.title, 'body', NEW.body, 'order_id', NEW.order_id,
+                    'created_at', (EXTRACT(EPOCH FROM NEW.created_at)*1000)::BIGINT));
+            ELSIF TG_TABLE_NAME = 'announcements' THEN
+                PERFORM public.smm_emit_user_event(NULL, 'notification', jsonb_build_object(
+                    'id', NEW.feed_id, 'title', COALESCE(NEW.title, 'إعلان'), 'body', NEW.body, 'order_id', NULL,
+                    'created_at', (EXTRACT(EPOCH FROM NEW.created_at)*1000)::BIGINT));
+            ELSIF TG_TABLE_NAME = 'orders' THEN
+                IF TG_OP = 'INSERT' OR NEW.status IS DISTINCT FROM OLD.status THEN
+                    PERFORM public.smm_emit_user_event(NEW.user_id, 'order', jsonb_build_object(
+                        'order_id', NEW.id, 'status', NEW.status,
+                        'previous', CASE WHEN TG_OP = 'UPDATE' THEN OLD.status END));
+                END IF;
+            ELSIF TG_TABLE_NAME = 'users' THEN
+                IF NEW.balance IS DISTINCT FROM OLD.balance THEN
+                    PERFORM public.smm_emit_user_event(NEW.id, 'balance', jsonb_build_object('balance', NEW.balance));
+                END IF;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+    for trg, ddl in (
+        ("user_notifications_events_ai", "AFTER INSERT ON public.user_notifications"),
+        ("announcements_events_ai", "AFTER INSERT ON public.announcements"),
+        ("orders_events_aiu", "AFTER INSERT OR UPDATE OF status ON public.orders"),
+        ("users_events_au", "AFTER UPDATE OF balance ON public.users"),
+    ):
+        table = ddl.rsplit(" ", 1)[1]
+        cur.execute(f"DROP TRIGGER IF EXISTS {trg} ON {table}")
+        cur.execute(f"CREATE TRIGGER {trg} {ddl} FOR EACH ROW EXECUTE FUNCTION public.smm_user_events_trg()")
 
+class UserEventWatermark:
+    """
+    Highest user_events id at or below which every id is settled: committed, or
+    rolled back for good. Works like the wallet cursor: ids missing below a
+    visible row are remembered with the snapshot xmax seen then, and count as
+    rolled back once snapshot xmin >= that xmax and USER_EVENTS_SETTLE seconds
+    have passed. The watermark stops just below the oldest unsettled id.
+    """
 
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cursor: Optional[int] = None
+        self._gaps: Dict[int, Tuple[int, float]] = {}
+        self.value: Optional[int] = None
+        self.updated = 0.0
 
-# =========================
-# FastAPI
-# =========================
-app = FastAPI(title="SMM Backend", version="1.9.3")
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"], allow_credentials=True,
-    allow_methods=["*"], allow_headers=["*"]
-)
+    def advance(self) -> int:
+        with self._lock:
+            conn = get_conn()
+            try:
+                with conn, conn.cursor() as cur:
+                    if self._cursor is None:
+                        cur.execute("SELECT COALESCE(MIN(id) - 1, 0), COALESCE(MAX(id), 0) FROM public.user_events")
+                        lo, hi = cur.fetchone()
+                        self._cursor = max(int(lo), int(hi) - _USER_EVENTS_MAX_GAP)
+                    while True:
+                        cur.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint")
+                        snap_xmin = cur.fetchone()[0]
+                        cur.execute("""
+                            SELECT id FROM public.user_events
+                            WHERE id = ANY(%s) OR id IN (
+                                SELECT id FROM public.user_events WHERE id > %s ORDER BY id LIMIT %s
+                            )
+                            ORDER BY id
+                        """, (list(self._gaps), self._cursor, _USER_EVENTS_SCAN))
+                        ids = [r[0] for r in cur.fetchall()]
+                        cur.execute("""
+                            SELECT pg_snapshot_xmax(pg_current_snapshot())::text::bigint,
+                                   EXTRACT(EPOCH FROM clock_timestamp())::float8
+                        """)
+                        snap_xmax, now = cur.fetchone()
+                        scanned = 0
+                        for eid in ids:
+                            if eid in self._gaps:
+                                del self._gaps[eid]
+                            elif eid > self._cursor:
+                                scanned += 1
+                                if eid - self._cursor - 1 > _USER_EVENTS_MAX_GAP:
+                                    logger.warning("user events: not tracking %s missing ids before %s",
+                                                   eid - self._cursor - 1, eid)
+                                else:
+                                    for gid in range(self._cursor + 1, eid):
+                                        self._gaps[gid] = (snap_xmax, now)
+                                self._cursor = eid
+                        self._gaps = {g: v for g, v in self._gaps.items()
+                                      if not (snap_xmin >= v[0] and now - v[1] >= USER_EVENTS_SETTLE)}
+                        if scanned < _USER_EVENTS_SCAN:
+                            break
+            finally:
+                put_conn(conn)
+            self.value = min(self._gaps) - 1 if self._gaps else self._cursor
+            self.updated = time.monotonic()
+            return self.value
+
+user_event_watermark = UserEventWatermark()
+
+async def _user_events_settled() -> int:
+    """Current watermark; recomputed here if the listener has not refreshed it lately."""
+    wm = user_event_watermark
+    if wm.value is None or time.monotonic() - wm.updated > _USER_EVENTS_POLL * 3:
+        return await _run_blocking(wm.advance)
+    return wm.value
+
+class UserEventHub:
+    """Per-process registry of open SSE streams, woken from the user_events listener thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subs: Dict[int, set] = {}
+        self._count = 0
+        self._order_waiters: set = set()
+        self._held: Dict[int, Tuple[Optional[int], Optional[str]]] = {}   # event id -> (user, kind) above the watermark
+        self._seen_reconnects = 0
+        self._last_gc = 0.0
+
+    def subscribe(self, user_id: int):
+        with self._lock:
+            if self._count >= SSE_MAX_STREAMS:
+                return None
+            entry = (asyncio.get_running_loop(), asyncio.Queue(maxsize=1))
+            self._subs.setdefault(user_id, set()).add(entry)
+            self._count += 1
+            return entry
+
+    def unsubscribe(self, user_id: int, entry) -> None:
+        with self._lock:
+            subs = self._subs.get(user_id)
+            if subs and entry in subs:
+                subs.discard(entry)
+                self._count -= 1
+                if not subs:
+                    self._subs.pop(user_id, None)
+
+    def subscribe_orders(self):
+        entry = (asyncio.get_running_loop(), asyncio.Queue(maxsize=1))
+        with self._lock:
+            self._order_waiters.add(entry)
+        return entry
+
+    def unsubscribe_orders(self, entry) -> None:
+        with self._lock:
+            self._order_waiters.discard(entry)
+
+    @staticmethod
+    def _wake(entry) -> None:
+        loop, q = entry
+        def put():
+            try:
+                q.put_nowait(True)
+            except asyncio.QueueFull:
+                pass
+        try:
+            loop.call_soon_threadsafe(put)
+        except RuntimeError:
+            pass  # loop closed
+
+    def handle(self, payloads: List[str]) -> None:
+        users: set = set()
+        wake_all = orders = False
+        if not payloads:
+            lst = _pg_listeners.get("events")
+            # after a reconnect notifications may have been missed: let every stream re-read
+            if lst is not None and lst.reconnects != self._seen_reconnects:
+                self._seen_reconnects = lst.reconnects
+                wake_all = orders = True
+            self._gc()
+        for p in payloads:
+            try:
+                ev = json.loads(p)
+                self._held[int(ev["id"])] = (ev.get("u"), ev.get("k"))
+            except Exception:
+                continue
+        if len(self._held) > _USER_EVENTS_MAX_HELD:
+            self._held.clear()
+            wake_all = orders = True
+        try:
+            wm = user_event_watermark.advance()
+        except Exception as e:
+            logger.warning("user events watermark: %s", e)
+            wm = None
+        # wake only for events the streams may read now; the rest wait for the watermark
+        released = [i for i in self._held if wm is not None and i <= wm]
+        for i in released:
+            u, k = self._held.pop(i)
+            if k == "order":
+                orders = True
+            if u is None:
+                wake_all = True
+            else:
+                users.add(int(u))
+        with self._lock:
+            if wake_all:
+                targets = [e for subs in self._subs.values() for e in subs]
+            else:
+                targets = [e for u in users for e in self._subs.get(u, ())]
+            if orders:
+                targets.extend(self._order_waiters)
+        for e in targets:
+            self._wake(e)
+
+    def _gc(self) -> None:
+        if time.monotonic() - self._last_gc < 600:
+            return
+        self._last_gc = time.monotonic()
+        try:
+            conn = get_conn()
+            try:
+                with conn, conn.cursor() as cur:
+                    cur.execute("DELETE FROM public.user_events WHERE created_at < NOW() - make_interval(hours => %s)",
+                                (USER_EVENTS_RETENTION_HOURS,))
+            finally:
+                put_conn(conn)
+        except Exception as e:
+            logger.warning("user_events retention failed: %s", e)
 
-# ===== Helpers =====
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"streams": self._count, "users": len(self._subs), "order_waiters": len(self._order_waiters)}
 
-def _tokens_for_uid(cur, uid: str):
-    """Return list of FCM tokens for a uid from user_devices or fallback to users.fcm_token"""
-    try:
-        cur.execute("SELECT fcm_token FROM public.user_devices WHERE uid=%s", (uid,))
-        rows = cur.fetchall()
-        toks = [r[0] for r in rows if r and r[0]]
-        if toks:
-            return toks
-    except Exception:
-        pass
-    cur.execute("SELECT fcm_token FROM public.users WHERE uid=%s", (uid,))
-    r = cur.fetchone()
-    return [r[0]] if r and r[0] else []
+user_event_hub = UserEventHub()
 
-def _require_admin(passwd: str):
-    if passwd != ADMIN_PASSWORD:
-        raise HTTPException(401, "bad admin password")
+@app.on_event("startup")
+def _startup_user_events_listener():
+    if not (SSE_ENABLED or ADMIN_LONGPOLL_ENABLED) or "events" in _pg_listeners:
+        return
+    lst = PgListener("events", ["user_events"], user_event_hub.handle, idle_poll=_USER_EVENTS_POLL)
+    _pg_listeners["events"] = lst
+    lst.start()
+
+# ---- admin live order queue (long-poll) ----
+# Order inserts and status changes are already recorded as user_events
+# (kind='order'); their ids are the version cursor, which never passes the
+# settled watermark (see UserEventWatermark). Waiters are woken by the
+# user_events listener once an event of kind 'order' is released.
+ADMIN_LONGPOLL_ENABLED = os.getenv("ADMIN_LONGPOLL_ENABLED", "1") == "1"
+ADMIN_LONGPOLL_MAX = float(os.getenv("ADMIN_LONGPOLL_MAX", "50"))
+
+@migration(15, "user_events_kind_notify")
+def _m0015_user_events_kind_notify(cur):
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION public.smm_emit_user_event(p_user_id INTEGER, p_kind TEXT, p_data JSONB)
+        RETURNS VOID AS $$
+        DECLARE v_id BIGINT;
+        BEGIN
+            INSERT INTO public.user_events(user_id, kind, data) VALUES (p_user_id, p_kind, p_data)
+            RETURNING id INTO v_id;
+            PERFORM pg_notify('user_events', json_build_object('id', v_id, 'u', p_user_id, 'k', p_kind)::text);
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
 
-def _payload_is_jsonb(conn) -> bool:
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT pg_typeof(payload)::text FROM public.orders LIMIT 1")
-            row = cur.fetchone()
-            return bool(row and isinstance(row[0], str) and row[0].lower() == "jsonb")
-    except Exception:
-        return False
+@migration(16, "idx_user_events_orders", concurrent=True)
+def _m0016_idx_user_events_orders(conn):
+    _create_index_concurrently(conn, "idx_user_events_orders", """
+        CREATE INDEX CONCURRENTLY idx_user_events_orders ON public.user_events(id) WHERE kind='order'
+    """)
 
-async def _read_json_object(request: Request) -> Dict[str, Any]:
+@app.get("/api/admin/orders/changes")
+async def admin_orders_changes(request: Request, since: Optional[int] = None, timeout: float = 25,
+                               x_admin_password: Optional[str] = Header(None, alias="x-admin-password"),
+                               password: Optional[str] = None):
+    """
+    Long-poll for the admin pending lists. Blocks up to `timeout` seconds until an
+    order is created or changes status after version `since`, then returns the
+    changed order ids per bucket (itunes, pubg, ludo, cards, balances, services)
+    and the new version. Without `since` it returns the current version at once.
+    reset=true means `since` fell out of the retention window: reload the lists.
+    """
+    _require_admin(_pick_admin_password(x_admin_password, password) or "")
+    if not ADMIN_LONGPOLL_ENABLED:
+        raise HTTPException(404, "long-poll disabled")
+    if since is None:
+        return {"ok": True, "version": await _user_events_settled(), "changes": {}, "orders": [], "reset": False}
+    entry = user_event_hub.subscribe_orders()
     try:
-        data = await request.json()
-    except Exception:
-        raw = (await request.body()).decode("utf-8", errors="ignore").strip()
-        data = json.loads(raw) if raw else {}
-    if data is None:
-        return {}
-    if not isinstance(data, dict):
-        raise HTTPException(400, "Body must be a JSON object")
-    return data
-
+        deadline = time.monotonic() + max(0.0, min(float(timeout), ADMIN_LONGPOLL_MAX))
+        while True:
+            settled = await _user_events_settled()
+            rows = await _db_fetch("""
+                SELECT e.id, (e.data->>'order_id')::BIGINT AS order_id, e.data->>'status' AS status,
+                       e.data->>'previous' AS previous
+                FROM public.user_events e
+                WHERE e.kind='order' AND e.id > %s AND e.id <= %s
+                ORDER BY e.id
+                LIMIT 500
+            """, since, settled)
+            left = deadline - time.monotonic()
+            if rows or left <= 0 or await request.is_disconnected():
+                break
+            try:
+                await asyncio.wait_for(entry[1].get(), left)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        user_event_hub.unsubscribe_orders(entry)
+
+    # every order event up to the watermark has been seen unless the page was full
+    version = int(rows[-1]["id"]) if len(rows) == 500 else max(since, settled)
+    if not rows:
+        return {"ok": True, "version": version, "changes": {}, "orders": [], "reset": False}
+    oldest = await _db_fetchrow("SELECT MIN(id) AS v FROM public.user_events")
+    reset = oldest is not None and oldest["v"] is not None and since + 1 < int(oldest["v"])
+    latest: Dict[int, Dict[str, Any]] = {}
+    for r in rows:
+        latest[int(r["order_id"])] = {"id": int(r["order_id"]), "status": r["status"], "previous": r["previous"]}
+    flags = ", ".join(f"{cond} AS {b}" for b, cond in _PENDING_SQL_FILTERS.items())
+    info = await _db_fetch(f"""
+        SELECT o.id, o.title, o.type, o.service_id, o.payload, {flags.replace('%', '%%')}
+        FROM public.orders o WHERE o.id = ANY(%s)
+    """, list(latest.keys()))
+    changes: Dict[str, List[int]] = {}
+    for o in info:
+        for b in _pending_buckets(o):
+            changes.setdefault(b, []).append(int(o["id"]))
+    return {"ok": True, "version": version, "changes": changes,
+            "orders": list(latest.values()), "reset": reset}
 
 def _notify_user(_conn_ignored, user_id: int, order_id: Optional[int], title: str, body: str):
     """
     SAFE: open a fresh DB connection (no recursive re-entry).
-    Inserts DB notification + pushes FCM to all user's devices.
+    Inserts DB notification + queues FCM pushes to all user's devices.
     """
     c = get_conn()
     try:
-        uid = None
-        tokens: List[str] = []
-        try:
-            with c, c.cursor() as cur:
-                cur.execute(
-                    "INSERT INTO public.user_notifications (user_id, order_id, title, body, status, created_at) "
-                    "VALUES (%s,%s,%s,%s,'unread', NOW())",
-                    (user_id, order_id, title, body)
-                )
-                cur.execute("SELECT uid FROM public.users WHERE id=%s", (user_id,))
-                row = cur.fetchone()
-                uid = row[0] if row else None
-                if uid:
-                    tokens = _tokens_for_uid(cur, uid)
-        except Exception as e:
-            logger.exception("notify user failed (DB): %s", e)
-
-        for t in tokens:
-            try:
-                _fcm_send_push(t, title, body, order_id)
-            except Exception as e:
-                logger.exception("notify user push error: %s", e)
+        with c, c.cursor() as cur:
+            _enqueue_notification(cur, user_id, order_id, title, body)
+        _wake_push_workers()
+    except Exception as e:
+        logger.exception("notify user failed (DB): %s", e)
     finally:
         put_conn(c)
 
@@ -625,51 +3254,112 @@ def _ensure_owner_user_id(cur) -> int:
     cur.execute("INSERT INTO public.users(uid) VALUES(%s) RETURNING id", (OWNER_UID,))
     return int(cur.fetchone()[0])
 
-def _notify_owner_new_order(_conn_ignored, order_id: int):
+# Owner new-order pushes are coalesced: the first order after a quiet period
+# is pushed at once and opens an OWNER_DIGEST_WINDOW; orders arriving inside
+# the window go out together as one digest notification when it closes, and a
+# non-empty digest opens the next window. Under a burst the owner gets about
+# one push per window instead of one per order. 0 pushes every order.
+OWNER_DIGEST_WINDOW = float(os.getenv("OWNER_DIGEST_WINDOW", "60"))
+OWNER_DIGEST_MAX_LINES = int(os.getenv("OWNER_DIGEST_MAX_LINES", "5"))
+
+def _notify_owner_orders(order_ids: List[int]):
     """
-    SAFE: open fresh connection, insert notification for OWNER, push FCM to owner devices.
+    SAFE: open fresh connection, insert one OWNER notification for the given
+    orders (a single order keeps the classic text) and queue FCM to owner devices.
     """
-    n_title = "طلب جديد"
-    n_body  = f"طلب جديد رقم {order_id}"
+    if len(order_ids) == 1:
+        n_title = "طلب جديد"
+        n_body = f"طلب جديد رقم {order_ids[0]}"
+    else:
+        n_title = "طلبات جديدة"
+        n_body = f"{len(order_ids)} طلبات جديدة: " + ", ".join(f"#{i}" for i in order_ids[:OWNER_DIGEST_MAX_LINES])
     c = get_conn()
     try:
-        tokens: List[str] = []
         try:
             with c, c.cursor() as cur:
                 # enrich body with order title + user uid if available
                 try:
                     cur.execute("""
-                        SELECT o.title, u.uid
+                        SELECT o.id, o.title, u.uid
                         FROM public.orders o
                         LEFT JOIN public.users u ON u.id = o.user_id
-                        WHERE o.id=%s
-                    """, (order_id,))
-                    row = cur.fetchone()
-                    if row:
-                        otitle = row[0] or ""
-                        u_uid = row[1] or ""
-                        n_body = f"طلب جديد رقم {order_id}: {otitle}" + (f" | UID: {u_uid}" if u_uid else "")
+                        WHERE o.id = ANY(%s)
+                        ORDER BY o.id
+                    """, (list(order_ids),))
+                    rows = cur.fetchall()
+                    if len(order_ids) == 1 and rows:
+                        otitle = rows[0][1] or ""
+                        u_uid = rows[0][2] or ""
+                        n_body = f"طلب جديد رقم {order_ids[0]}: {otitle}" + (f" | UID: {u_uid}" if u_uid else "")
+                    elif rows:
+                        lines = [f"#{r[0]} {r[1] or ''}".strip() for r in rows[:OWNER_DIGEST_MAX_LINES]]
+                        more = len(order_ids) - len(lines)
+                        n_body = f"{len(order_ids)} طلبات جديدة: " + " | ".join(lines) + (f" | +{more}" if more > 0 else "")
                 except Exception:
                     pass
 
                 owner_id = _ensure_owner_user_id(cur)
-                cur.execute(
-                    "INSERT INTO public.user_notifications(user_id, order_id, title, body, status, created_at) "
-                    "VALUES (%s,%s,%s,%s,'unread', NOW())",
-                    (owner_id, order_id, n_title, n_body)
-                )
-                tokens = _tokens_for_uid(cur, OWNER_UID)
+                _enqueue_notification(cur, owner_id, order_ids[0] if len(order_ids) == 1 else None, n_title, n_body)
+            _wake_push_workers()
         except Exception as e:
             logger.exception("owner notify (db) failed: %s", e)
-
-        for t in tokens:
-            try:
-                _fcm_send_push(t, n_title, n_body, order_id)
-            except Exception as e:
-                logger.exception("owner notify (push) failed: %s", e)
     finally:
         put_conn(c)
 
+class OwnerOrderDigest:
+    """Coalescing window for owner new-order notifications (see OWNER_DIGEST_WINDOW)."""
+
+    def __init__(self, window: float):
+        self.window = window
+        self._lock = threading.Lock()
+        self._pending: List[int] = []
+        self._window_until = 0.0
+        self._timer: Optional[threading.Timer] = None
+        self.immediate = 0
+        self.digests = 0
+
+    def add(self, order_id: int) -> None:
+        with self._lock:
+            now = time.monotonic()
+            immediate = self.window <= 0 or (now >= self._window_until and self._timer is None)
+            if immediate:
+                self._window_until = now + self.window
+                self.immediate += 1
+            else:
+                self._pending.append(order_id)
+                if self._timer is None:
+                    self._timer = threading.Timer(max(0.0, self._window_until - now), self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+        if immediate:
+            _notify_owner_orders([order_id])
+
+    def flush(self) -> None:
+        with self._lock:
+            ids, self._pending = self._pending, []
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if ids:
+                self._window_until = time.monotonic() + self.window
+                self.digests += 1
+        if ids:
+            _notify_owner_orders(ids)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"window": self.window, "pending": len(self._pending), "immediate": self.immediate, "digests": self.digests}
+
+_owner_digest = OwnerOrderDigest(OWNER_DIGEST_WINDOW)
+
+@app.on_event("shutdown")
+async def _shutdown_owner_digest():
+    # sync shutdown hooks run on the loop, and the blocking executor is already shut down here
+    await asyncio.get_running_loop().run_in_executor(None, _owner_digest.flush)
+
+def _notify_owner_new_order(_conn_ignored, order_id: int):
+    """Notify the OWNER about a new order, immediately or via the next digest."""
+    _owner_digest.add(int(order_id))
+
 def _needs_code(title: str, otype: Optional[str]) -> bool:
     t = (title or "").lower()
     if (otype or "").lower() == "topup_card":
@@ -807,35 +3497,14 @@ def _parse_game_price(d: Dict[str, Any]) -> float:
 
 
 def _push_user(conn, user_id: int, order_id: Optional[int], title: str, body: str):
-    """Store notification in DB then push FCM to all user's devices (user_devices + fallback)."""
-    # 1) Insert row in user_notifications (unread)
+    """Store notification in DB and queue FCM to all user's devices (user_devices + fallback)."""
     try:
         with conn, conn.cursor() as cur:
-            cur.execute(
-                "INSERT INTO public.user_notifications (user_id, order_id, title, body, status, created_at) "
-                "VALUES (%s,%s,%s,%s,'unread', NOW())",
-                (user_id, order_id, title, body)
-            )
+            _enqueue_notification(cur, user_id, order_id, title, body)
+        _wake_push_workers()
     except Exception as e:
         logger.exception("push_user insert failed: %s", e)
 
-    # 2) Collect tokens and send FCM
-    tokens = []
-    try:
-        with conn, conn.cursor() as cur:
-            cur.execute("SELECT uid FROM public.users WHERE id=%s", (user_id,))
-            r = cur.fetchone()
-            uid = r[0] if r else None
-            if uid:
-                tokens = _tokens_for_uid(cur, uid)
-    except Exception as e:
-        logger.exception("push_user DB read failed: %s", e)
-    try:
-        for t in tokens:
-            _fcm_send_push(t, title, body, order_id)
-    except Exception as e:
-        logger.exception("push_user send failed: %s", e)
-
 def _format_amount_for_notification(amount) -> str:
     """
     تنسيق المبلغ لعرضه في الإشعارات:
@@ -880,6 +3549,7 @@ class ProviderOrderIn(BaseModel):
     link: Optional[str] = None
     quantity: int = Field(ge=1, default=1)
     price: float = Field(ge=0, default=0)
+    idempotency_key: Optional[str] = None  # for clients that cannot send the Idempotency-Key header
 
 class ManualOrderIn(BaseModel):
     uid: str
@@ -892,6 +3562,7 @@ class WalletChangeIn(BaseModel):
 class AsiacellSubmitIn(BaseModel):
     uid: str
     card: str
+    idempotency_key: Optional[str] = None
 
 class WalletCompatIn(BaseModel):
     uid: str
@@ -901,19 +3572,244 @@ class WalletCompatIn(BaseModel):
 class PayTabsCreateIn(BaseModel):
     uid: str
     usd: float
+    idempotency_key: Optional[str] = None
 
 class PayTabsCreateOut(BaseModel):
     payment_url: str
 
+# =========================
+# Idempotency keys
+# =========================
+# Order-creating and wallet endpoints accept an Idempotency-Key header (or an
+# idempotency_key body field). Keys are scoped per endpoint family and per
+# uid. The first request with a key claims it (a random claim token) and
+# executes; flows that write to the database store their response with
+# _idem_record() in the same transaction as the order or ledger row, so the
+# charge and its record commit or roll back together. Repeats get the stored
+# response without executing again; duplicates arriving while the first is
+# still running wait for it on the event loop (up to IDEMPOTENCY_WAIT seconds).
+# A key still pending after IDEMPOTENCY_LEASE seconds is taken over by the next
+# retry in the scopes that record atomically (the old owner's _idem_record then
+# fails its claim check and rolls back); elsewhere (PayTabs, whose payment page
+# is created outside our transaction) it answers 409. A key reused with a
+# different request body is rejected. Client errors (4xx) are stored like
+# successes; server errors release the key so the client can retry. Stored keys
+# live IDEMPOTENCY_TTL_HOURS.
+IDEMPOTENCY_TTL_HOURS = float(os.getenv("IDEMPOTENCY_TTL_HOURS", "24"))
+IDEMPOTENCY_WAIT = float(os.getenv("IDEMPOTENCY_WAIT", "30"))
+IDEMPOTENCY_LEASE = float(os.getenv("IDEMPOTENCY_LEASE", "120"))
+IDEMPOTENCY_GC_INTERVAL = float(os.getenv("IDEMPOTENCY_GC_INTERVAL", "3600"))
+_IDEM_ATOMIC_SCOPES = {"order.provider", "order.manual_paid", "wallet.asiacell"}   # flows that call _idem_record
+_idem_events: Dict[Tuple[str, str, str], asyncio.Event] = {}   # keys owned by this process; loop thread only
+_idem_claim_ctx: contextvars.ContextVar = contextvars.ContextVar("idem_claim", default=None)
+_IDEM_GC_STARTED = False
+
+@migration(22, "idempotency_keys")
+def _m0022_idempotency_keys(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS public.idempotency_keys(
+            scope        TEXT NOT NULL,
+            uid          TEXT NOT NULL,
+            idem_key     TEXT NOT NULL,
+            fingerprint  TEXT NOT NULL,
+            claim        TEXT NOT NULL,                     -- token of the request that owns the key
+            status       TEXT NOT NULL DEFAULT 'pending',   -- pending | done
+            status_code  INTEGER NULL,
+            response     JSONB NULL,
+            created_at   TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            locked_until TIMESTAMPTZ NOT NULL,
+            expires_at   TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (scope, uid, idem_key)
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON public.idempotency_keys(expires_at)")
+
+def _idempotency_key(header_val: Optional[str], body: Optional[Dict[str, Any]] = None) -> Optional[str]:
+    k = header_val or (body or {}).get("idempotency_key") or (body or {}).get("idempotencyKey")
+    k = str(k).strip() if k else ""
+    if not k:
+        return None
+    if len(k) > 255:
+        raise HTTPException(422, "Idempotency-Key too long")
+    return k
+
+def _idem_claim(ident: Tuple[str, str, str], fingerprint: str, claim: str) -> Tuple[str, Optional[Tuple[int, Any]]]:
+    """('owner', None) when the caller must execute, ('done', (status_code, response)), ('pending', None) or ('stuck', None)."""
+    takeover = ident[0] in _IDEM_ATOMIC_SCOPES
+    scope, uid, key = ident
+    conn = get_conn()
+    try:
+        with conn, conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO public.idempotency_keys(scope, uid, idem_key, fingerprint, claim, locked_until, expires_at)
+                VALUES (%(scope)s, %(uid)s, %(key)s, %(fp)s, %(claim)s,
+                        NOW() + make_interval(secs => %(lease)s), NOW() + make_interval(secs => %(ttl)s))
+                ON CONFLICT (scope, uid, idem_key) DO UPDATE
+                SET fingerprint = EXCLUDED.fingerprint, claim = EXCLUDED.claim, status = 'pending',
+                    status_code = NULL, response = NULL, created_at = NOW(),
+                    locked_until = EXCLUDED.locked_until, expires_at = EXCLUDED.expires_at
+                WHERE idempotency_keys.expires_at < NOW()
+                   OR (%(takeover)s AND idempotency_keys.status = 'pending'
+                       AND idempotency_keys.locked_until < NOW()
+                       AND idempotency_keys.fingerprint = EXCLUDED.fingerprint)
+                RETURNING 1
+            """, {"scope": scope, "uid": uid, "key": key, "fp": fingerprint, "claim": claim, "takeover": takeover,
+                  "lease": IDEMPOTENCY_LEASE, "ttl": IDEMPOTENCY_TTL_HOURS * 3600})
+            if cur.fetchone():
+                return "owner", None
+            cur.execute("""
+                SELECT fingerprint, status, status_code, response, locked_until < NOW()
+                FROM public.idempotency_keys
+                WHERE scope=%s AND uid=%s AND idem_key=%s
+            """, ident)
+            row = cur.fetchone()
+    finally:
+        put_conn(conn)
+    if not row:
+        return "pending", None
+    if row[0] != fingerprint:
+        raise HTTPException(422, "Idempotency-Key was already used for a different request")
+    if row[1] == "done":
+        return "done", (int(row[2]), row[3])
+    return ("stuck" if row[4] else "pending"), None
+
+def _idem_record(cur, response: Any, status_code: int = 200) -> None:
+    """
+    Store the response of the idempotent request running in this context, inside
+    the caller's transaction. Raises 409 (rolling that transaction back) if the
+    claim is no longer ours. No-op without an Idempotency-Key.
+    """
+    ctx = _idem_claim_ctx.get()
+    if ctx is None:
+        return
+    cur.execute("""
+        UPDATE public.idempotency_keys
+        SET status='done', status_code=%s, response=%s
+        WHERE scope=%s AND uid=%s AND idem_key=%s AND claim=%s AND status='pending'
+    """, (status_code, Json(response), *ctx["ident"], ctx["claim"]))
+    if cur.rowcount != 1:
+        raise HTTPException(409, "Idempotency-Key claim lost")
+    ctx["recorded"] = True
+
+def _idem_finish(ident: Tuple[str, str, str], claim: str, status_code: Optional[int], response: Any) -> None:
+    """Store the outcome, or release the key when status_code is None; only while our claim is pending."""
+    conn = get_conn()
+    try:
+        with conn, conn.cursor() as cur:
+            if status_code is None:
+                cur.execute("""
+                    DELETE FROM public.idempotency_keys
+                    WHERE scope=%s AND uid=%s AND idem_key=%s AND claim=%s AND status='pending'
+                """, (*ident, claim))
+            else:
+                cur.execute("""
+                    UPDATE public.idempotency_keys
+                    SET status='done', status_code=%s, response=%s
+                    WHERE scope=%s AND uid=%s AND idem_key=%s AND claim=%s AND status='pending'
+                """, (status_code, Json(response), *ident, claim))
+    except Exception as e:
+        logger.exception("idempotency store failed (%s): %s", ident, e)
+    finally:
+        put_conn(conn)
+
+async def _idempotent_call(scope: str, uid: str, key: Optional[str], params: Any, fn, *args) -> Any:
+    """Run fn(*args) in the blocking executor at most once per (scope, uid, key); params identifies the request."""
+    if not key:
+        return await _run_blocking(fn, *args)
+    ident = (scope, uid or "", key)
+    fingerprint = hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    claim = os.urandom(16).hex()
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT
+    delay = 0.05
+    while True:
+        state, stored = await _run_blocking(_idem_claim, ident, fingerprint, claim)
+        if state == "owner":
+            break
+        if state == "done":
+            status_code, response = stored
+            if status_code >= 400:
+                raise HTTPException(status_code, (response or {}).get("detail"))
+            return response
+        if state == "stuck":
+            # the payment page may exist without a recorded outcome; never create it twice
+            raise HTTPException(409, "a previous request with this Idempotency-Key did not complete; contact support")
+        left = deadline - time.monotonic()
+        if left <= 0:
+            raise HTTPException(409, "a request with this Idempotency-Key is still in progress")
+        # wait on the loop, not in an executor thread; woken early when this process owns the key
+        ev = _idem_events.get(ident)
+        try:
+            await asyncio.wait_for(ev.wait() if ev else asyncio.sleep(delay), min(delay, left))
+        except asyncio.TimeoutError:
+            pass
+        delay = min(delay * 2, 1.0)
+
+    ev = _idem_events[ident] = asyncio.Event()
+    ctx = {"ident": ident, "claim": claim, "recorded": False}
+    token = _idem_claim_ctx.set(ctx)
+    try:
+        result = await _run_blocking(fn, *args)
+    except HTTPException as e:
+        if not ctx["recorded"]:
+            await _run_blocking(_idem_finish, ident, claim, e.status_code if e.status_code < 500 else None,
+                                {"detail": e.detail})
+        raise
+    except Exception:
+        if not ctx["recorded"]:
+            await _run_blocking(_idem_finish, ident, claim, None, None)
+        raise
+    else:
+        if not ctx["recorded"]:
+            await _run_blocking(_idem_finish, ident, claim, 200, result)
+        return result
+    finally:
+        _idem_claim_ctx.reset(token)
+        if _idem_events.get(ident) is ev:
+            del _idem_events[ident]
+        ev.set()
+
+def _idempotency_gc_worker() -> None:
+    while True:
+        try:
+            conn = get_conn()
+            try:
+                with conn, conn.cursor() as cur:
+                    cur.execute("DELETE FROM public.idempotency_keys WHERE expires_at < NOW()")
+            finally:
+                put_conn(conn)
+        except Exception as e:
+            logger.warning("idempotency gc failed: %s", e)
+        time.sleep(IDEMPOTENCY_GC_INTERVAL)
+
+@app.on_event("startup")
+def _startup_idempotency_gc():
+    global _IDEM_GC_STARTED
+    if _IDEM_GC_STARTED:
+        return
+    _IDEM_GC_STARTED = True
+    threading.Thread(target=_idempotency_gc_worker, name="idempotency-gc", daemon=True).start()
+
 # =========================
 # Middleware logging
 # =========================
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
+    _CURRENT_SCOPE.set(request.scope)
     t0 = time.time()
-    response = await call_next(request)
+    if loop_monitor is None:
+        response = await call_next(request)
+        dt = int((time.time() - t0) * 1000)
+        logger.info("%s %s -> %s (%d ms)", request.method, request.url.path, response.status_code, dt)
+        return response
+    m0 = time.monotonic()
+    key = loop_monitor.enter(request.scope)
+    try:
+        response = await call_next(request)
+    finally:
+        loop_monitor.exit(key)
     dt = int((time.time() - t0) * 1000)
-    logger.info("%s %s -> %s (%d ms)", request.method, request.url.path, response.status_code, dt)
+    logger.info("%s %s -> %s (%d ms, loop lag %d ms, p99 %d ms)", request.method, request.url.path,
+                response.status_code, dt, loop_monitor.lag_since(m0), loop_monitor.percentiles()["p99"])
     return response
 
 @app.get("/")
@@ -930,6 +3826,30 @@ def health():
     finally:
         put_conn(conn)
 
+@app.get("/api/admin/db/pool")
+def admin_db_pool(x_admin_password: Optional[str] = Header(None, alias="x-admin-password"), password: Optional[str] = None, reset: int = 0):
+    """Pool diagnostics: wait/hold percentiles, per call-site and per-route usage, connections held right now."""
+    _require_admin(_pick_admin_password(x_admin_password, password) or "")
+    diag = dbpool.diagnostics
+    out: Dict[str, Any] = {"ok": True, "pool": dbpool.stats()}
+    if diag is not None:
+        out.update(diag.snapshot())
+        if str(reset) == "1":
+            diag.reset()
+    return out
+
+@app.get("/api/admin/loop/lag")
+def admin_loop_lag(x_admin_password: Optional[str] = Header(None, alias="x-admin-password"), password: Optional[str] = None, reset: int = 0):
+    """Event-loop lag percentiles and the stalls captured above LOOP_LAG_THRESHOLD_MS, grouped by call site."""
+    _require_admin(_pick_admin_password(x_admin_password, password) or "")
+    if loop_monitor is None:
+        return {"ok": True, "enabled": False}
+    out: Dict[str, Any] = {"ok": True, "enabled": True}
+    out.update(loop_monitor.snapshot())
+    if str(reset) == "1":
+        loop_monitor.reset()
+    return out
+
 # =========================
 # Public user APIs
 # =========================
@@ -962,87 +3882,123 @@ def api_users_fcm_token(body: FcmTokenIn):
         raise HTTPException(422, "uid and fcm token required")
     conn = get_conn()
     try:
+        # One round trip; rows whose values are already current are left alone
+        # (no new row versions), only the device's last-seen time is buffered.
         with conn, conn.cursor() as cur:
-            cur.execute("SELECT id FROM public.users WHERE uid=%s", (uid,))
-            r = cur.fetchone()
-            if not r:
-                cur.execute("INSERT INTO public.users(uid) VALUES(%s) RETURNING id", (uid,))
-                user_id = cur.fetchone()[0]
-            else:
-                user_id = r[0]
-
-            # fallback single-token column
-            cur.execute("UPDATE public.users SET fcm_token=%s WHERE id=%s", (fcm, user_id))
-
-            # upsert into user_devices
-            try:
-                cur.execute("""
+            cur.execute("""
+                WITH u AS (
+                    INSERT INTO public.users(uid, fcm_token) VALUES (%(uid)s, %(fcm)s)
+                    ON CONFLICT (uid) DO UPDATE SET fcm_token = EXCLUDED.fcm_token
+                    WHERE users.fcm_token IS DISTINCT FROM EXCLUDED.fcm_token
+                    RETURNING 1
+                ), d AS (
                     INSERT INTO public.user_devices(uid, fcm_token, platform)
-                    VALUES (%s, %s, %s)
-                    ON CONFLICT (fcm_token) DO UPDATE SET uid=EXCLUDED.uid, platform=COALESCE(EXCLUDED.platform,'android'), updated_at=NOW()
-                """, (uid, fcm, platform))
-            except Exception:
-                pass
-
+                    VALUES (%(uid)s, %(fcm)s, %(platform)s)
+                    ON CONFLICT (fcm_token) DO UPDATE
+                    SET uid = EXCLUDED.uid, platform = EXCLUDED.platform, updated_at = NOW()
+                    WHERE (user_devices.uid, user_devices.platform) IS DISTINCT FROM (EXCLUDED.uid, EXCLUDED.platform)
+                    RETURNING (xmax = 0) AS inserted
+                )
+                SELECT (SELECT count(*) FROM u), (SELECT bool_or(inserted) FROM d)
+            """, {"uid": uid, "fcm": fcm, "platform": platform})
+            user_changed, device_inserted = cur.fetchone()
+
+        with _bad_tokens_lock:
+            _bad_tokens.discard(fcm)
+        if device_inserted is None:
+            # device row unchanged (even if users.fcm_token flipped between two devices)
+            _device_touch(fcm)
+            if not user_changed:
+                return {"ok": True, "uid": uid}
+        # the token may have moved from another uid; drop both cached lists
+        _device_tokens.invalidate(uid)
+        _device_tokens.invalidate_tokens([fcm])
+        if device_inserted:
+            # new tokens start unsubscribed; let the topic loop pick them up now
+            _wake_topic_sync()
         return {"ok": True, "uid": uid}
     finally:
         put_conn(conn)
 
 # ---- Wallet balance (with several aliases to match the app) ----
 @app.get("/api/wallet/balance")
-def wallet_balance(uid: str):
-    conn = get_conn()
-    try:
-        with conn, conn.cursor() as cur:
-            cur.execute("SELECT balance FROM public.users WHERE uid=%s", (uid,))
-            r = cur.fetchone()
-        return {"ok": True, "balance": float(r[0] if r else 0.0)}
-    finally:
-        put_conn(conn)
+async def wallet_balance(uid: str):
+    r = await _db_fetchrow("SELECT balance FROM public.users WHERE uid=%s", uid)
+    return {"ok": True, "balance": float(r["balance"] if r else 0.0)}
 
 # aliases
 @app.get("/api/get_balance")
-def wallet_balance_alias1(uid: str):
-    return wallet_balance(uid)
+async def wallet_balance_alias1(uid: str):
+    return await wallet_balance(uid)
 
 @app.get("/api/balance")
-def wallet_balance_alias2(uid: str):
-    return wallet_balance(uid)
+async def wallet_balance_alias2(uid: str):
+    return await wallet_balance(uid)
 
 @app.get("/api/wallet/get")
-def wallet_balance_alias3(uid: str):
-    return wallet_balance(uid)
+async def wallet_balance_alias3(uid: str):
+    return await wallet_balance(uid)
 
 @app.get("/api/wallet/get_balance")
-def wallet_balance_alias4(uid: str):
-    return wallet_balance(uid)
+async def wallet_balance_alias4(uid: str):
+    return await wallet_balance(uid)
 
 @app.get("/api/users/{uid}/balance")
-def wallet_balance_alias5(uid: str):
-    return wallet_balance(uid)
+async def wallet_balance_alias5(uid: str):
+    return await wallet_balance(uid)
+
+def _paytabs_create_flow(uid: str, usd: float) -> Dict[str, Any]:
+    # ensure user exists
+    conn = get_conn()
+    try:
+        with conn, conn.cursor() as cur:
+            cur.execute("SELECT id FROM public.users WHERE uid=%s", (uid,))
+            row = cur.fetchone()
+            if not row:
+                raise HTTPException(404, "user not found")
+    finally:
+        put_conn(conn)
+
+    return {"payment_url": _create_paytabs_payment_page(uid, usd)}
 
 @app.post("/api/wallet/paytabs/create", response_model=PayTabsCreateOut)
-def wallet_paytabs_create(body: PayTabsCreateIn):
+async def wallet_paytabs_create(body: PayTabsCreateIn, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
     """
     Create PayTabs hosted payment page for wallet top-up.
     """
     if not body.uid or body.usd is None or body.usd <= 0:
         raise HTTPException(422, "invalid amount")
 
-    # ensure user exists
+    key = _idempotency_key(idempotency_key, {"idempotency_key": body.idempotency_key})
+    out = await _idempotent_call("wallet.paytabs", body.uid, key, [body.uid, body.usd], _paytabs_create_flow, body.uid, body.usd)
+    return PayTabsCreateOut(**out)
+
+
+def _paytabs_credit_sync(uid: str, usd_amount: Decimal, amount: float, data: Dict[str, Any]) -> Dict[str, Any]:
     conn = get_conn()
     try:
         with conn, conn.cursor() as cur:
-            cur.execute("SELECT id FROM public.users WHERE uid=%s", (body.uid,))
+            # make sure user exists
+            cur.execute("SELECT id FROM public.users WHERE uid=%s", (uid,))
             row = cur.fetchone()
             if not row:
-                raise HTTPException(404, "user not found")
+                cur.execute("INSERT INTO public.users(uid) VALUES(%s) RETURNING id", (uid,))
+                user_id = cur.fetchone()[0]
+            else:
+                user_id = row[0]
+
+            cur.execute("UPDATE public.users SET balance=balance+%s WHERE id=%s", (usd_amount, user_id))
+            cur.execute(
+                """
+                INSERT INTO public.wallet_txns(user_id, amount, reason, meta)
+                VALUES(%s,%s,%s,%s)
+                """,
+                (user_id, usd_amount, "paytabs_topup", Json({"paytabs": data, "iqd_amount": amount})),
+            )
     finally:
         put_conn(conn)
 
-    url = _create_paytabs_payment_page(body.uid, body.usd)
-    return PayTabsCreateOut(payment_url=url)
-
+    return {"ok": True, "uid": uid, "amount": amount}
 
 @app.post("/api/wallet/paytabs/callback")
 async def wallet_paytabs_callback(request: Request):
@@ -1089,34 +4045,7 @@ async def wallet_paytabs_callback(request: Request):
     # PayTabs amount is in {"IQD"}; convert back to wallet USD using fixed rate
     usd_amount = Decimal(amount) / Decimal("1320.0")
 
-    conn = get_conn()
-    try:
-        with conn, conn.cursor() as cur:
-            # make sure user exists
-            cur.execute("SELECT id FROM public.users WHERE uid=%s", (uid,))
-            row = cur.fetchone()
-            if not row:
-                cur.execute("INSERT INTO public.users(uid) VALUES(%s) RETURNING id", (uid,))
-                user_id = cur.fetchone()[0]
-            else:
-                user_id = row[0]
-
-            cur.execute("UPDATE public.users SET balance=balance+%s WHERE id=%s", (usd_amount, user_id))
-            cur.execute(
-                """
-                INSERT INTO public.wallet_txns(user_id, amount, reason, meta)
-                VALUES(%s,%s,%s,%s)
-                """,
-                (user_id, usd_amount, "paytabs_topup", Json({"paytabs": data, "iqd_amount": amount})),
-            )
-
-        display_amount = _format_amount_for_notification(usd_amount)
-        _push_user(conn, user_id, None, "تمت إضافة رصيد", f"تم شحن رصيدك بمبلغ {display_amount} دولار.")
-    finally:
-        put_conn(conn)
-
-    return {"ok": True, "uid": uid, "amount": amount}
-
+    return await _run_blocking(_paytabs_credit_sync, uid, usd_amount, amount, data)
 
 @app.api_route("/payment/result", methods=["GET", "POST"], response_class=HTMLResponse)
 async def wallet_paytabs_return(request: Request):
@@ -1135,136 +4064,218 @@ async def wallet_paytabs_return(request: Request):
 
 
 # Create provider order core
-def _create_provider_order_core(cur, uid: str, service_id: Optional[int], service_name: str,
-                                link: Optional[str], quantity: int, price: float) -> int:
-    cur.execute("SELECT id, balance, is_banned FROM public.users WHERE uid=%s", (uid,))
-    r = cur.fetchone()
-    if not r:
-        raise HTTPException(404, "user not found")
-    user_id, bal, banned = r[0], float(r[1]), bool(r[2])
-    if banned:
-        raise HTTPException(403, "user banned")
-
-    # apply service-id override by service_name (ui_key)
-    eff_sid = service_id
-    try:
-        if service_name:
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS public.service_id_overrides(
-                    ui_key TEXT PRIMARY KEY,
-                    service_id BIGINT NOT NULL,
-                    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
-                )
-            """)
-            cur.execute("SELECT service_id FROM public.service_id_overrides WHERE ui_key=%s", (service_name,))
-            r_eff = cur.fetchone()
-            if r_eff and r_eff[0]:
-                eff_sid = int(r_eff[0])
-    except Exception:
-        pass
-
-    # apply pricing override by service_name (ui_key)
-    eff_price = price
-    try:
-        rowp = None
-        if service_name:
-            # exact match
-            cur.execute("SELECT price_per_k, min_qty, max_qty, COALESCE(mode,'per_k') FROM public.service_pricing_overrides WHERE ui_key=%s", (service_name,))
-            rowp = cur.fetchone()
-
-        # normalization fallback on ui_key
-        if not rowp and service_name:
-            cur.execute("SELECT ui_key, price_per_k, min_qty, max_qty, COALESCE(mode,'per_k') FROM public.service_pricing_overrides")
-            allp = cur.fetchall() or []
-            sn = _normalize_ui_key(service_name)
-            for ui_key, ppk, mn, mx, mode in allp:
-                if _normalize_ui_key(ui_key) == sn:
-                    rowp = (ppk, mn, mx, mode)
-                    break
-
-        # fallback by service_id mapping if present
-        if not rowp and service_id:
-            try:
-                cur.execute("SELECT p.price_per_k, p.min_qty, p.max_qty, COALESCE(p.mode,'per_k') FROM public.service_id_overrides s JOIN public.service_pricing_overrides p ON p.ui_key = s.ui_key WHERE s.service_id=%s", (int(service_id),))
-                rowp = cur.fetchone()
-            except Exception:
-                pass
+# Order creation runs server-side: one statement locks the user, resolves the
+# effective service id and price, debits the wallet, writes the ledger row and
+# inserts the order. Business errors come back as SQLSTATE SM<http status>.
+@migration(7, "order_create_functions")
+def _m0007_order_create_functions(cur):
+    # mirrors _normalize_ui_key(); IMMUTABLE so it can back an expression index
+    cur.execute(r"""
+        CREATE OR REPLACE FUNCTION public.smm_normalize_ui_key(s text) RETURNS text
+        LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE AS $fn$
+            SELECT translate(
+                lower(btrim(normalize(s, NFKC), E' \t\n\r\x0b\x0c')),
+                E'أإآىئؤةـ ‏‎‪‫‬‭‮\t\n\r-_.,',
+                'اااييوه'
+            )
+        $fn$;
+    """)
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION public.smm_lock_user(p_uid text, p_create boolean,
+                                                        OUT user_id integer, OUT balance numeric)
+        LANGUAGE plpgsql AS $fn$
+        DECLARE
+            v_banned boolean;
+        BEGIN
+            SELECT u.id, u.balance, u.is_banned INTO user_id, balance, v_banned
+            FROM public.users u WHERE u.uid = p_uid FOR UPDATE;
+            IF NOT FOUND THEN
+                IF NOT p_create THEN
+                    RAISE EXCEPTION 'user not found' USING ERRCODE = 'SM404';
+                END IF;
+                INSERT INTO public.users(uid) VALUES (p_uid) ON CONFLICT (uid) DO NOTHING;
+                SELECT u.id, u.balance, u.is_banned INTO user_id, balance, v_banned
+                FROM public.users u WHERE u.uid = p_uid FOR UPDATE;
+            END IF;
+            IF v_banned THEN
+                RAISE EXCEPTION 'user banned' USING ERRCODE = 'SM403';
+            END IF;
+        END
+        $fn$;
+    """)
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION public.smm_resolve_provider_price(
+            p_service_name text, p_service_id bigint, p_quantity integer, p_price numeric)
+        RETURNS numeric
+        LANGUAGE plpgsql STABLE AS $fn$
+        DECLARE
+            r       record;
+            v_found boolean := FALSE;
+            v_name  text := lower(coalesce(p_service_name, ''));
+            v_cat   text;
+        BEGIN
+            IF coalesce(p_service_name, '') <> '' THEN
+                SELECT p.price_per_k, p.min_qty, p.max_qty, coalesce(p.mode, 'per_k') AS mode INTO r
+                FROM public.service_pricing_overrides p WHERE p.ui_key = p_service_name;
+                v_found := FOUND;
+                IF NOT v_found THEN
+                    SELECT p.price_per_k, p.min_qty, p.max_qty, coalesce(p.mode, 'per_k') AS mode INTO r
+                    FROM public.service_pricing_overrides p
+                    WHERE public.smm_normalize_ui_key(p.ui_key) = public.smm_normalize_ui_key(p_service_name)
+                    ORDER BY p.ui_key LIMIT 1;
+                    v_found := FOUND;
+                END IF;
+            END IF;
+
+            IF NOT v_found AND p_service_id IS NOT NULL THEN
+                SELECT p.price_per_k, p.min_qty, p.max_qty, coalesce(p.mode, 'per_k') AS mode INTO r
+                FROM public.service_id_overrides s
+                JOIN public.service_pricing_overrides p ON p.ui_key = s.ui_key
+                WHERE s.service_id = p_service_id
+                LIMIT 1;
+                v_found := FOUND;
+            END IF;
+
+            -- category-level fallback for PUBG/Ludo
+            IF NOT v_found THEN
+                v_cat := CASE
+                    WHEN v_name LIKE '%pubg%' OR v_name LIKE '%ببجي%' OR v_name LIKE '%uc%' THEN 'cat.pubg'
+                    WHEN v_name LIKE '%ludo%' OR v_name LIKE '%لودو%' THEN 'cat.ludo'
+                END;
+                IF v_cat IS NOT NULL THEN
+                    SELECT p.price_per_k, p.min_qty, p.max_qty, coalesce(p.mode, 'per_k') AS mode INTO r
+                    FROM public.service_pricing_overrides p WHERE p.ui_key = v_cat;
+                    v_found := FOUND;
+                END IF;
+            END IF;
+
+            IF NOT v_found THEN
+                RETURN p_price;
+            END IF;
+            IF r.mode = 'flat' THEN
+                RETURN r.price_per_k;
+            END IF;
+            IF p_quantity < r.min_qty OR p_quantity > r.max_qty THEN
+                RAISE EXCEPTION 'quantity out of allowed range [%-%]', r.min_qty, r.max_qty USING ERRCODE = 'SM400';
+            END IF;
+            RETURN p_quantity::numeric * r.price_per_k / 1000;
+        END
+        $fn$;
+    """)
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION public.smm_charge_and_insert_order(
+            p_user_id integer, p_balance numeric, p_charge numeric, p_txn_meta jsonb,
+            p_title text, p_service_id bigint, p_link text, p_quantity integer,
+            p_price numeric, p_payload jsonb, p_type text)
+        RETURNS integer
+        LANGUAGE plpgsql AS $fn$
+        DECLARE
+            v_oid integer;
+        BEGIN
+            IF p_charge > 0 THEN
+                IF p_balance < p_charge THEN
+                    RAISE EXCEPTION 'insufficient balance' USING ERRCODE = 'SM400';
+                END IF;
+                UPDATE public.users SET balance = balance - p_charge WHERE id = p_user_id;
+                INSERT INTO public.wallet_txns(user_id, amount, reason, meta)
+                VALUES (p_user_id, -p_charge, 'order_charge', p_txn_meta);
+            END IF;
+            INSERT INTO public.orders(user_id, title, service_id, link, quantity, price, status, payload, type)
+            VALUES (p_user_id, p_title, p_service_id, p_link, p_quantity, p_price, 'Pending', p_payload, p_type)
+            RETURNING id INTO v_oid;
+            RETURN v_oid;
+        END
+        $fn$;
+    """)
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION public.smm_create_provider_order(
+            p_uid text, p_service_id bigint, p_service_name text, p_link text,
+            p_quantity integer, p_price numeric,
+            OUT order_id integer, OUT user_id integer)
+        LANGUAGE plpgsql AS $fn$
+        DECLARE
+            v_balance numeric;
+            v_sid     bigint := p_service_id;
+            v_price   numeric;
+        BEGIN
+            SELECT l.user_id, l.balance INTO user_id, v_balance
+            FROM public.smm_lock_user(p_uid, FALSE) l;
+
+            -- service-id override by service_name (ui_key)
+            IF coalesce(p_service_name, '') <> '' THEN
+                SELECT coalesce(nullif(o.service_id, 0), p_service_id) INTO v_sid
+                FROM public.service_id_overrides o WHERE o.ui_key = p_service_name;
+                IF NOT FOUND THEN
+                    v_sid := p_service_id;
+                END IF;
+            END IF;
+
+            v_price := public.smm_resolve_provider_price(p_service_name, p_service_id, p_quantity, p_price);
+
+            order_id := public.smm_charge_and_insert_order(
+                user_id, v_balance, coalesce(v_price, 0),
+                jsonb_build_object('service_id', p_service_id, 'name', p_service_name,
+                                   'qty', p_quantity, 'price_effective', v_price),
+                p_service_name, v_sid, p_link, p_quantity, coalesce(v_price, 0),
+                jsonb_build_object('source', 'provider_form', 'service_id_provided', p_service_id,
+                                   'service_id_effective', v_sid, 'price_effective', v_price),
+                'provider');
+        END
+        $fn$;
+    """)
 
-        if rowp:
-            ppk = float(rowp[0]); mn = int(rowp[1]); mx = int(rowp[2]); mode = (rowp[3] or 'per_k')
-            if mode == 'flat':
-                eff_price = float(ppk)
-            else:
-                if quantity < mn or quantity > mx:
-                    raise HTTPException(400, f"quantity out of allowed range [{mn}-{mx}]")
-                eff_price = float(Decimal(quantity) * Decimal(ppk) / Decimal(1000))
-
-        if not rowp:
-            # category-level fallback for PUBG/Ludo
-            key = None
-            sname = (service_name or "").lower()
-            if any(w in sname for w in ["pubg","ببجي","uc"]):
-                key = "cat.pubg"
-            elif any(w in sname for w in ["ludo","لودو"]):
-                key = "cat.ludo"
-            if key:
-                cur.execute("SELECT price_per_k, min_qty, max_qty, COALESCE(mode,'per_k') FROM public.service_pricing_overrides WHERE ui_key=%s", (key,))
-                rowp = cur.fetchone()
-                if rowp:
-                    ppk = float(rowp[0]); mn = int(rowp[1]); mx = int(rowp[2]); mode = (rowp[3] or 'per_k')
-                    if mode == 'flat':
-                        eff_price = float(ppk)
-                    else:
-                        if quantity < mn or quantity > mx:
-                            raise HTTPException(400, f"quantity out of allowed range [{mn}-{mx}]")
-                        eff_price = float(Decimal(quantity) * Decimal(ppk) / Decimal(1000))
-    except Exception:
-        pass
+@migration(8, "idx_pricing_overrides_norm_key", concurrent=True)
+def _m0008_idx_pricing_norm_key(conn):
+    # normalized ui_key fallback used to scan the whole table in Python
+    _create_index_concurrently(conn, "idx_pricing_overrides_norm_key",
+        "CREATE INDEX CONCURRENTLY idx_pricing_overrides_norm_key "
+        "ON public.service_pricing_overrides(public.smm_normalize_ui_key(ui_key))")
 
-    # charge if paid# charge if paid (use effective price)
-    if eff_price and eff_price > 0:
-        if bal < eff_price:
-            raise HTTPException(400, "insufficient balance")
-        cur.execute("UPDATE public.users SET balance=balance-%s WHERE id=%s", (Decimal(eff_price), user_id))
-        cur.execute("""
-            INSERT INTO public.wallet_txns(user_id, amount, reason, meta)
-            VALUES(%s,%s,%s,%s)
-        """, (user_id, Decimal(-eff_price), "order_charge",
-              Json({"service_id": service_id, "name": service_name, "qty": quantity, "price_effective": eff_price})))
+def _raise_for_sqlstate(e: psycopg2.Error):
+    """Re-raise SM<status> errors from the order functions as HTTPException."""
+    code = getattr(e, "pgcode", None) or ""
+    if code.startswith("SM") and code[2:].isdigit():
+        raise HTTPException(int(code[2:]), e.diag.message_primary or "")
+    raise e
 
-    cur.execute("""
-        INSERT INTO public.orders(user_id, title, service_id, link, quantity, price, status, payload, type)
-        VALUES(%s,%s,%s,%s,%s,%s,'Pending',%s,%s)
-        RETURNING id
-    """, (user_id, service_name, eff_sid, link, quantity, Decimal(eff_price or 0),
-          Json({"source": "provider_form", "service_id_provided": service_id, "service_id_effective": eff_sid, "price_effective": eff_price}), 'provider'))
-    oid = cur.fetchone()[0]
-    return oid
+def _create_provider_order_core(cur, uid: str, service_id: Optional[int], service_name: str,
+                                link: Optional[str], quantity: int, price: float) -> Tuple[int, int]:
+    try:
+        cur.execute(
+            "SELECT order_id, user_id FROM public.smm_create_provider_order(%s, %s::bigint, %s, %s, %s::integer, %s::numeric)",
+            (uid, service_id, service_name, link, quantity, price or 0),
+        )
+    except psycopg2.Error as e:
+        _raise_for_sqlstate(e)
+    oid, user_id = cur.fetchone()
+    return int(oid), int(user_id)
 
-@app.post("/api/orders/create/provider")
-def create_provider_order(body: ProviderOrderIn):
+def _provider_order_flow(uid: str, service_id: Optional[int], service_name: str,
+                         link: Optional[str], quantity: int, price: float) -> Dict[str, Any]:
     conn = get_conn()
     try:
         # create order & collect data inside txn
         with conn, conn.cursor() as cur:
-            oid = _create_provider_order_core(
-                cur, body.uid, body.service_id, body.service_name,
-                body.link, body.quantity, body.price
-            )
-            # collect needed fields but DO NOT notify yet (commit first)
-            cur.execute("SELECT user_id, title FROM public.orders WHERE id=%s", (oid,))
-            row = cur.fetchone()
-            user_id = row[0] if row else None
-            title = row[1] if row else body.service_name
+            oid, user_id = _create_provider_order_core(cur, uid, service_id, service_name, link, quantity, price)
+            result = {"ok": True, "order_id": oid}
+            _idem_record(cur, result)
 
         # now outside transaction (COMMITTED): safe to notify
         if user_id:
-            _notify_user(conn, user_id, oid, "تم استلام طلبك", f"تم استلام طلب {title}.")
+            _notify_user(conn, user_id, oid, "تم استلام طلبك", f"تم استلام طلب {service_name}.")
         _notify_owner_new_order(conn, oid)
-        return {"ok": True, "order_id": oid}
+        return result
     finally:
         put_conn(conn)
 
+@app.post("/api/orders/create/provider")
+async def create_provider_order(body: ProviderOrderIn, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    p = dict(uid=body.uid, service_id=body.service_id, link=body.link, quantity=body.quantity,
+             price=body.price, service_name=body.service_name)
+    return await _idempotent_call("order.provider", p["uid"], _idempotency_key(idempotency_key, {"idempotency_key": body.idempotency_key}), p,
+                                  _provider_order_flow, p["uid"], p["service_id"], p["service_name"],
+                                  p["link"], p["quantity"], p["price"])
+
 # Compat creation paths
 PROVIDER_CREATE_PATHS = [
     "/api/orders/create", "/api/order/create",
@@ -1292,23 +4303,10 @@ for path in PROVIDER_CREATE_PATHS:
                 raise ValueError
         except Exception:
             raise HTTPException(422, "invalid payload")
-        conn = get_conn()
-        try:
-            # Do all DB writes first
-            with conn, conn.cursor() as cur:
-                oid = _create_provider_order_core(cur, p["uid"], p["service_id"], p["service_name"], p["link"], p["quantity"], p["price"])
-                # collect user_id for notify after commit
-                cur.execute("SELECT user_id FROM public.orders WHERE id=%s", (oid,))
-                ur = cur.fetchone()
-                user_id = ur[0] if ur else None
-
-            # After COMMIT: push notifications
-            if user_id:
-                _notify_user(conn, user_id, oid, "تم استلام طلبك", f"تم استلام طلب {p['service_name']}.")
-            _notify_owner_new_order(conn, oid)
-            return {"ok": True, "order_id": oid}
-        finally:
-            put_conn(conn)
+        key = _idempotency_key(request.headers.get("Idempotency-Key"), data)
+        return await _idempotent_call("order.provider", p["uid"], key, p,
+                                      _provider_order_flow, p["uid"], p["service_id"], p["service_name"],
+                                      p["link"], p["quantity"], p["price"])
 
 # Manual order
 @app.post("/api/orders/create/manual")
@@ -1397,7 +4395,7 @@ def _create_paytabs_payment_page(uid: str, amount: float) -> str:
     }
 
     try:
-        resp = requests.post(url, json=payload, headers=headers, timeout=20)
+        resp = _http("paytabs").post(url, json=payload, headers=headers)
     except Exception as e:
         raise HTTPException(502, f"Error connecting to PayTabs: {e}")
 
@@ -1432,28 +4430,34 @@ ASIACELL_PATHS = [
     "/api/asiacell",
 ]
 
-@app.post("/api/wallet/asiacell/submit")
-def submit_asiacell(body: AsiacellSubmitIn):
-    digits = _extract_digits(body.card)
-    if len(digits) < 10:
-        raise HTTPException(422, "invalid card length")
+def _asiacell_order_flow(uid: str, digits: str) -> Dict[str, Any]:
     conn = get_conn()
     try:
         with conn, conn.cursor() as cur:
-            oid = _asiacell_submit_core(cur, body.uid, digits)
+            oid = _asiacell_submit_core(cur, uid, digits)
             # collect user_id for notify after commit
             cur.execute("SELECT user_id FROM public.orders WHERE id=%s", (oid,))
             r = cur.fetchone()
             user_id = r[0] if r else None
+            result = {"ok": True, "order_id": oid, "status": "received"}
+            _idem_record(cur, result)
 
         # After COMMIT: push notifications
         if user_id:
             _notify_user(conn, user_id, oid, "تم استلام طلبك", "تم استلام طلب كارت أسيا سيل.")
         _notify_owner_new_order(conn, oid)
-        return {"ok": True, "order_id": oid, "status": "received"}
+        return result
     finally:
         put_conn(conn)
 
+@app.post("/api/wallet/asiacell/submit")
+async def submit_asiacell(body: AsiacellSubmitIn, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    digits = _extract_digits(body.card)
+    if len(digits) < 10:
+        raise HTTPException(422, "invalid card length")
+    key = _idempotency_key(idempotency_key, {"idempotency_key": body.idempotency_key})
+    return await _idempotent_call("wallet.asiacell", body.uid, key, [body.uid, digits], _asiacell_order_flow, body.uid, digits)
+
 for path in ASIACELL_PATHS[1:]:
     @app.post(path)
     async def submit_asiacell_compat(request: Request, _path=path):
@@ -1466,111 +4470,296 @@ for path in ASIACELL_PATHS[1:]:
         digits = _extract_digits(raw)
         if not uid or len(digits) < 10:
             raise HTTPException(422, "invalid payload")
-        conn = get_conn()
-        try:
-            with conn, conn.cursor() as cur:
-                oid = _asiacell_submit_core(cur, uid, digits)
-                cur.execute("SELECT user_id FROM public.orders WHERE id=%s", (oid,))
-                r = cur.fetchone()
-                if r:
-                    _notify_user(conn, r[0], oid, "تم استلام طلبك", "تم استلام طلب كارت أسيا سيل.")
-            _notify_owner_new_order(conn, oid)
-            return {"ok": True, "order_id": oid, "status": "received"}
-        finally:
-            put_conn(conn)
+        key = _idempotency_key(request.headers.get("Idempotency-Key"), data)
+        return await _idempotent_call("wallet.asiacell", uid, key, [uid, digits], _asiacell_order_flow, uid, digits)
 
 # Orders of a user
-def _orders_for_uid(uid: str) -> List[dict]:
-    conn = get_conn()
-    try:
-        with conn, conn.cursor() as cur:
-            cur.execute("SELECT id FROM public.users WHERE uid=%s", (uid,))
-            r = cur.fetchone()
-            if not r:
-                return []
-            user_id = r[0]
-            cur.execute("""
-                SELECT id, title, quantity, price,
-                       status, EXTRACT(EPOCH FROM created_at)*1000, link
-                FROM public.orders
-                WHERE user_id=%s
-                ORDER BY id DESC
-            """, (user_id,))
-            rows = cur.fetchall()
-        return [{
-            "id": row[0],
-            "title": row[1],
-            "quantity": row[2],
-            "price": float(row[3] or 0),
-            "status": row[4],
-            "created_at": int(row[5] or 0),
-            "link": row[6]
-        } for row in rows]
-    finally:
-        put_conn(conn)
+async def _orders_for_uid(uid: str) -> List[dict]:
+    rows = await _db_fetch("""
+        SELECT o.id, o.title, o.quantity, o.price, o.status,
+               EXTRACT(EPOCH FROM o.created_at)*1000 AS created_at, o.link
+        FROM public.orders o
+        JOIN public.users u ON u.id = o.user_id
+        WHERE u.uid=%s
+        ORDER BY o.id DESC
+    """, uid)
+    return [{
+        "id": row["id"],
+        "title": row["title"],
+        "quantity": row["quantity"],
+        "price": float(row["price"] or 0),
+        "status": row["status"],
+        "created_at": int(row["created_at"] or 0),
+        "link": row["link"]
+    } for row in rows]
 
 @app.get("/api/orders/my")
-def my_orders(uid: str):
-    return _orders_for_uid(uid)
+async def my_orders(uid: str):
+    return await _orders_for_uid(uid)
 
 # more aliases for safety
 @app.get("/api/orders")
-def orders_alias(uid: str):
-    return _orders_for_uid(uid)
+async def orders_alias(uid: str):
+    return await _orders_for_uid(uid)
 
 @app.get("/api/user/orders")
-def user_orders_alias(uid: str):
-    return _orders_for_uid(uid)
+async def user_orders_alias(uid: str):
+    return await _orders_for_uid(uid)
 
 @app.get("/api/users/{uid}/orders")
-def user_orders_path(uid: str):
-    return _orders_for_uid(uid)
+async def user_orders_path(uid: str):
+    return await _orders_for_uid(uid)
 
 @app.get("/api/orders/list")
-def orders_list(uid: str):
-    return {"orders": _orders_for_uid(uid)}
+async def orders_list(uid: str):
+    return {"orders": await _orders_for_uid(uid)}
 
 @app.get("/api/user/orders/list")
-def user_orders_list(uid: str):
-    return {"orders": _orders_for_uid(uid)}
+async def user_orders_list(uid: str):
+    return {"orders": await _orders_for_uid(uid)}
 
 # =========================
 # Notifications
 # =========================
+@migration(19, "idx_user_notifications_user_id", concurrent=True)
+def _m0019_idx_user_notifications_user_id(conn):
+    _create_index_concurrently(conn, "idx_user_notifications_user_id", """
+        CREATE INDEX CONCURRENTLY idx_user_notifications_user_id
+        ON public.user_notifications(user_id, id DESC)
+    """)
+
 @app.get("/api/notifications/by_uid")
-def _alias_notifications_by_uid(uid: str, status: str = "unread", limit: int = 50):
-    return list_user_notifications(uid=uid, status=status, limit=limit)
+async def _alias_notifications_by_uid(response: Response, uid: str, status: str = "unread", limit: int = 50,
+                                      since_id: Optional[int] = None, before_id: Optional[int] = None):
+    return await list_user_notifications(response, uid=uid, status=status, limit=limit,
+                                         since_id=since_id, before_id=before_id)
 
 @app.get("/api/user/by-uid/{uid}/notifications")
-def list_user_notifications(uid: str, status: str = "unread", limit: int = 50):
+async def list_user_notifications(response: Response, uid: str, status: str = "unread", limit: int = 50,
+                                  since_id: Optional[int] = None, before_id: Optional[int] = None):
+    """
+    Newest first. Keyset paging: before_id=<smallest id seen> pages back;
+    since_id=<largest id seen> returns only newer rows (the oldest `limit` of
+    them, still newest first - repeat with the new largest id while
+    X-Has-More is 1). X-Has-More reports whether more rows match.
+    """
+    where = ""
+    params: List[Any] = [uid]
+    if status not in ("unread","read","all"):
+        status = "unread"
+    if status != "all":
+        where = "WHERE f.status=%s"
+        params.append(status)
+    limit = max(1, int(limit))
+    keyset = ""
+    if since_id is not None:
+        keyset += " AND {col} > %s"
+    if before_id is not None:
+        keyset += " AND {col} < %s"
+    keyset_params = [v for v in (since_id, before_id) if v is not None]
+    order = "ASC" if since_id is not None else "DESC"
+    logger.info("list_notifications request uid=%s status=%s limit=%s", uid, status, limit)
+    # per-user rows + announcements the user has seen since registering (fan-out on read)
+    rows = await _db_fetch(f"""
+        WITH u AS (
+            SELECT u.id, u.created_at, COALESCE(s.last_read_id, 0) AS wm
+            FROM public.users u
+            LEFT JOIN public.user_notification_state s ON s.user_id = u.id
+            WHERE u.uid=%s
+        ), f AS (
+            SELECT n.id, n.user_id, n.order_id, n.title, n.body,
+                   CASE WHEN n.id <= u.wm THEN 'read' ELSE n.status END AS status,
+                   n.created_at, n.read_at
+            FROM public.user_notifications n
+            JOIN u ON u.id = n.user_id
+            WHERE TRUE {keyset.format(col="n.id")}
+            UNION ALL
+            SELECT a.feed_id, u.id, NULL, COALESCE(a.title, 'إعلان'), a.body,
+                   CASE WHEN a.feed_id <= u.wm OR r.feed_id IS NOT NULL
+                        THEN 'read' ELSE 'unread' END,
+                   a.created_at, r.read_at
+            FROM u
+            JOIN public.announcements a ON a.fanout_on_read AND a.created_at >= u.created_at
+            LEFT JOIN public.user_notification_reads r ON r.user_id = u.id AND r.feed_id = a.feed_id
+            WHERE TRUE {keyset.format(col="a.feed_id")}
+        )
+        SELECT f.id, f.user_id, f.order_id, f.title, f.body, f.status,
+               EXTRACT(EPOCH FROM f.created_at)*1000 AS created_at,
+               EXTRACT(EPOCH FROM f.read_at)*1000   AS read_at
+        FROM f
+        {where}
+        ORDER BY f.id {order}
+        LIMIT %s
+    """, params[0], *keyset_params, *keyset_params, *params[1:], limit + 1)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if order == "ASC":
+        rows.reverse()
+    response.headers["X-Has-More"] = "1" if has_more else "0"
+    logger.info("list_notifications uid=%s -> %s rows", uid, len(rows))
+    return rows
+
+# Unread badge: user_notification_state.unread_count is kept in step with
+# user_notifications by a trigger (insert/status change/delete), so the badge is
+# a primary-key read plus a range scan over the few announcements above the
+# user's read watermark.
+@migration(17, "unread_counter")
+def _m0017_unread_counter(cur):
+    cur.execute("ALTER TABLE public.user_notification_state ADD COLUMN IF NOT EXISTS unread_count INTEGER NOT NULL DEFAULT 0")
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION public.smm_unread_counter_trg()
+        RETURNS trigger AS $$
+        DECLARE
+            d INTEGER := 0;
+            v_uid INTEGER;
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                v_uid := NEW.user_id;
+                d := (NEW.status = 'unread')::INTEGER;
+            ELSIF TG_OP = 'DELETE' THEN
+                v_uid := OLD.user_id;
+                d := -(OLD.status = 'unread')::INTEGER;
+            ELSE
+                v_uid := NEW.user_id;
+                d := (NEW.status = 'unread')::INTEGER - (OLD.status = 'unread')::INTEGER;
+            END IF;
+            IF d > 0 THEN
+                INSERT INTO public.user_notification_state(user_id, unread_count) VALUES (v_uid, d)
+                ON CONFLICT (user_id) DO UPDATE
+                SET unread_count = public.user_notification_state.unread_count + EXCLUDED.unread_count, updated_at = NOW();
+            ELSIF d < 0 THEN
+                -- update only: on a user delete cascade the state row is already gone
+                UPDATE public.user_notification_state
+                SET unread_count = GREATEST(0, unread_count + d), updated_at = NOW()
+                WHERE user_id = v_uid;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+    cur.execute("DROP TRIGGER IF EXISTS user_notifications_unread_aiud ON public.user_notifications")
+    cur.execute("""
+        CREATE TRIGGER user_notifications_unread_aiud
+        AFTER INSERT OR DELETE OR UPDATE OF status ON public.user_notifications
+        FOR EACH ROW EXECUTE FUNCTION public.smm_unread_counter_trg()
+    """)
+    # backfill; the trigger above holds off concurrent inserts until this commits
+    cur.execute("""
+        INSERT INTO public.user_notification_state(user_id, unread_count)
+        SELECT user_id, count(*) FILTER (WHERE status = 'unread')
+        FROM public.user_notifications
+        GROUP BY user_id
+        ON CONFLICT (user_id) DO UPDATE SET unread_count = EXCLUDED.unread_count, updated_at = NOW()
+    """)
+
+@app.get("/api/user/by-uid/{uid}/notifications/unread_count")
+async def user_unread_count(uid: str):
+    r = await _db_fetchrow("""
+        SELECT COALESCE(s.unread_count, 0) + (
+                   SELECT count(*) FROM public.announcements a
+                   WHERE a.feed_id > COALESCE(s.last_read_id, 0)
+                     AND a.fanout_on_read AND a.created_at >= u.created_at
+                     AND NOT EXISTS (SELECT 1 FROM public.user_notification_reads r
+                                     WHERE r.user_id = u.id AND r.feed_id = a.feed_id)
+               ) AS unread
+        FROM public.users u
+        LEFT JOIN public.user_notification_state s ON s.user_id = u.id
+        WHERE u.uid = %s
+    """, uid)
+    return {"ok": True, "unread": int(r["unread"]) if r else 0}
+
+# Read state is a per-user watermark (last_read_id: everything at or below it is
+# read, user rows and announcements alike since they share one id sequence)
+# plus the explicit reads above it: status='read' on user_notifications rows and
+# user_notification_reads for announcements. "Mark all read" only moves the
+# watermark. The unread counter trigger ignores rows at or below the watermark.
+@migration(18, "notification_read_watermark")
+def _m0018_notification_read_watermark(cur):
+    cur.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema='public' AND table_name='user_notification_state' AND column_name='ann_read_upto'
+    """)
+    if cur.fetchone():
+        cur.execute("ALTER TABLE public.user_notification_state RENAME COLUMN ann_read_upto TO last_read_id")
+    cur.execute("ALTER TABLE public.user_notification_state ADD COLUMN IF NOT EXISTS last_read_id BIGINT NOT NULL DEFAULT 0")
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION public.smm_unread_counter_trg()
+        RETURNS trigger AS $$
+        DECLARE
+            d INTEGER := 0;
+            v_uid INTEGER;
+            v_id BIGINT;
+            v_wm BIGINT;
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                v_uid := NEW.user_id; v_id := NEW.id;
+                d := (NEW.status = 'unread')::INTEGER;
+            ELSIF TG_OP = 'DELETE' THEN
+                v_uid := OLD.user_id; v_id := OLD.id;
+                d := -(OLD.status = 'unread')::INTEGER;
+            ELSE
+                v_uid := NEW.user_id; v_id := NEW.id;
+                d := (NEW.status = 'unread')::INTEGER - (OLD.status = 'unread')::INTEGER;
+            END IF;
+            IF d = 0 THEN
+                RETURN NULL;
+            END IF;
+            SELECT last_read_id INTO v_wm FROM public.user_notification_state WHERE user_id = v_uid;
+            IF v_id <= COALESCE(v_wm, 0) THEN
+                RETURN NULL;  -- already read through the watermark
+            END IF;
+            IF d > 0 THEN
+                INSERT INTO public.user_notification_state(user_id, unread_count) VALUES (v_uid, d)
+                ON CONFLICT (user_id) DO UPDATE
+                SET unread_count = public.user_notification_state.unread_count + EXCLUDED.unread_count, updated_at = NOW();
+            ELSE
+                -- update only: on a user delete cascade the state row is already gone
+                UPDATE public.user_notification_state
+                SET unread_count = GREATEST(0, unread_count + d), updated_at = NOW()
+                WHERE user_id = v_uid;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+
+@app.post("/api/user/{uid}/notifications/read_all")
+def mark_all_notifications_read(uid: str, up_to: Optional[int] = None):
+    """
+    Mark everything up to `up_to` (default: the newest notification or announcement) as read
+    by moving the watermark; no per-row updates.
+    """
     conn = get_conn()
     try:
-        with conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+        with conn, conn.cursor() as cur:
             cur.execute("SELECT id FROM public.users WHERE uid=%s", (uid,))
             r = cur.fetchone()
             if not r:
-                return []
-            user_id = r["id"]
-            where = "WHERE user_id=%s"
-            params = [user_id]
-            if status not in ("unread","read","all"):
-                status = "unread"
-            if status != "all":
-                where += " AND status=%s"
-                params.append(status)
-            logger.info("list_notifications request uid=%s status=%s limit=%s", uid, status, limit)
-            cur.execute(f"""
-                SELECT id, user_id, order_id, title, body, status,
-                       EXTRACT(EPOCH FROM created_at)*1000 AS created_at,
-                       EXTRACT(EPOCH FROM read_at)*1000   AS read_at
-                FROM public.user_notifications
-                {where}
-                ORDER BY id DESC
-                LIMIT %s
-            """, (*params, limit))
-            rows = cur.fetchall() or []
-            logger.info("list_notifications uid=%s -> %s rows", uid, len(rows))
-            return rows
+                raise HTTPException(404, "user not found")
+            user_id = r[0]
+            cur.execute("""
+                WITH top AS (
+                    SELECT COALESCE(%s, GREATEST(
+                        (SELECT MAX(id) FROM public.user_notifications WHERE user_id = %s),
+                        (SELECT MAX(feed_id) FROM public.announcements)), 0) AS wm
+                )
+                INSERT INTO public.user_notification_state(user_id, last_read_id, unread_count)
+                SELECT %s, top.wm, 0 FROM top
+                ON CONFLICT (user_id) DO UPDATE
+                SET last_read_id = GREATEST(public.user_notification_state.last_read_id, EXCLUDED.last_read_id),
+                    updated_at = NOW()
+                RETURNING last_read_id
+            """, (up_to, user_id, user_id))
+            wm = int(cur.fetchone()[0])
+            # unread rows above the new watermark (none unless up_to was given or rows raced in)
+            cur.execute("""
+                UPDATE public.user_notification_state
+                SET unread_count = (SELECT count(*) FROM public.user_notifications
+                                    WHERE user_id = %s AND status = 'unread' AND id > %s)
+                WHERE user_id = %s
+            """, (user_id, wm, user_id))
+            cur.execute("DELETE FROM public.user_notification_reads WHERE user_id = %s AND feed_id <= %s", (user_id, wm))
+        return {"ok": True, "last_read_id": wm}
     finally:
         put_conn(conn)
 
@@ -1579,16 +4768,33 @@ def mark_notification_read(uid: str, nid: int):
     conn = get_conn()
     try:
         with conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("SELECT id FROM public.users WHERE uid=%s", (uid,))
+            cur.execute("""
+                SELECT u.id, COALESCE(s.last_read_id, 0) AS wm
+                FROM public.users u LEFT JOIN public.user_notification_state s ON s.user_id = u.id
+                WHERE u.uid=%s
+            """, (uid,))
             r = cur.fetchone()
             if not r:
                 raise HTTPException(404, "user not found")
             user_id = r["id"]
+            if nid <= r["wm"]:
+                # already read through the watermark
+                return {"ok": True, "id": nid}
             cur.execute(
                 "UPDATE public.user_notifications SET status='read', read_at=NOW() WHERE id=%s AND user_id=%s RETURNING id",
                 (nid, user_id)
             )
             row = cur.fetchone()
+            if not row:
+                # announcement (fan-out on read): remember the read per user
+                cur.execute("""
+                    INSERT INTO public.user_notification_reads(user_id, feed_id)
+                    SELECT %s, a.feed_id FROM public.announcements a
+                    WHERE a.feed_id=%s AND a.fanout_on_read
+                    ON CONFLICT (user_id, feed_id) DO UPDATE SET read_at = public.user_notification_reads.read_at
+                    RETURNING feed_id AS id
+                """, (user_id, nid))
+                row = cur.fetchone()
             if not row:
                 raise HTTPException(404, "notification not found")
             return {"ok": True, "id": row["id"]}
@@ -1596,31 +4802,308 @@ def mark_notification_read(uid: str, nid: int):
         put_conn(conn)
 
 # =========================
-# Manual PAID orders (charge now, refund on reject)
+# Notification partitions
 # =========================
-@app.post("/api/orders/create/manual_paid")
-async def create_manual_paid(request: Request):
-    """
-    Creates a manual order (iTunes / Atheer / Asiacell / Korek / PUBG / Ludo) and atomically charges user balance.
+# user_notifications is range-partitioned by created_at, one partition per
+# month (user_notifications_pYYYYMM). Indexes are declared on the parent, so
+# every partition gets its own copy. There is no DEFAULT partition: a
+# maintenance thread keeps NOTIFICATIONS_PARTITIONS_AHEAD future months created
+# (at least one) and drops partitions whose range ended more than
+# NOTIFICATIONS_RETENTION_MONTHS ago (0 keeps everything). Dropping skips row
+# triggers, so unread counters are corrected from the partition, under an
+# exclusive lock, in the same transaction as the DROP.
+#
+# The conversion is online: the existing table is not copied but attached as
+# the partition user_notifications_history (MINVALUE .. start of the month
+# after next). Its matching unique index is built CONCURRENTLY and its range
+# is proven by a CHECK constraint validated without blocking writers, so the
+# swap itself is a short catalog change retried under NOTIFICATIONS_LOCK_TIMEOUT.
+# History rows are retired in one piece once its whole range has expired.
+NOTIFICATIONS_RETENTION_MONTHS = int(os.getenv("NOTIFICATIONS_RETENTION_MONTHS", "12"))
+NOTIFICATIONS_PARTITIONS_AHEAD = max(1, int(os.getenv("NOTIFICATIONS_PARTITIONS_AHEAD", "2")))
+NOTIFICATIONS_MAINT_INTERVAL = float(os.getenv("NOTIFICATIONS_MAINT_INTERVAL", "3600"))
+NOTIFICATIONS_LOCK_TIMEOUT = os.getenv("NOTIFICATIONS_LOCK_TIMEOUT", "3s")
+_NOTIF_PARTITION_LOCK_ID = 987654324
+_NOTIF_MAINT_STARTED = False
+
+def _month_add(year: int, month: int, n: int) -> Tuple[int, int]:
+    k = year * 12 + (month - 1) + n
+    return k // 12, k % 12 + 1
+
+def _month_start(year: int, month: int) -> str:
+    return f"{year:04d}-{month:02d}-01 00:00:00+00"
+
+def _utc_month(cur) -> Tuple[int, int]:
+    cur.execute("SELECT EXTRACT(YEAR FROM NOW() AT TIME ZONE 'UTC')::INT, EXTRACT(MONTH FROM NOW() AT TIME ZONE 'UTC')::INT")
+    y, mo = cur.fetchone()
+    return int(y), int(mo)
+
+def _notifications_partition(cur, year: int, month: int) -> str:
+    name = f"user_notifications_p{year:04d}{month:02d}"
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS public.{name} PARTITION OF public.user_notifications
+        FOR VALUES FROM ('{_month_start(year, month)}') TO ('{_month_start(*_month_add(year, month, 1))}')
+    """)
+    return name
 
-    هذه الـ endpoint تُستخدم لكل الطلبات اليدوية التي تخصم من المحفظة مباشرة ثم تعيد المبلغ
-    في حال قام المالك برفض الطلب لاحقًا.
+def _locked_tx(conn, fn, attempts: int = 20):
+    """Run fn(cur) in one transaction on an autocommit connection, retrying when lock_timeout expires."""
+    for attempt in range(attempts):
+        try:
+            with conn.cursor() as cur:
+                cur.execute("BEGIN")
+                try:
+                    cur.execute("SELECT set_config('lock_timeout', %s, true)", (NOTIFICATIONS_LOCK_TIMEOUT,))
+                    out = fn(cur)
+                    cur.execute("COMMIT")
+                    return out
+                except BaseException:
+                    cur.execute("ROLLBACK")
+                    raise
+        except psycopg2.errors.LockNotAvailable:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(1.0)
+
+@migration(20, "user_notifications_partitioned", concurrent=True)
+def _m0020_user_notifications_partitioned(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT relkind FROM pg_class WHERE oid = 'public.user_notifications'::regclass")
+        if cur.fetchone()[0] == "p":
+            return
+        ny, nm = _utc_month(cur)
+    # rows stay in the history partition until the start of the month after next
+    hy, hm = _month_add(ny, nm, 2)
+    bound = _month_start(hy, hm)
+
+    # online preparation: the (id, created_at) unique index the parent key needs,
+    # and a validated range check so ATTACH does not have to scan the table
+    _create_index_concurrently(conn, "user_notifications_id_created_key", """
+        CREATE UNIQUE INDEX CONCURRENTLY user_notifications_id_created_key
+        ON public.user_notifications(id, created_at)
+    """)
+    def add_check(cur):
+        cur.execute("ALTER TABLE public.user_notifications DROP CONSTRAINT IF EXISTS user_notifications_history_bound")
+        cur.execute(f"""
+            ALTER TABLE public.user_notifications ADD CONSTRAINT user_notifications_history_bound
+            CHECK (created_at < '{bound}') NOT VALID
+        """)
+    _locked_tx(conn, add_check)
+    with conn.cursor() as cur:
+        cur.execute("ALTER TABLE public.user_notifications VALIDATE CONSTRAINT user_notifications_history_bound")
+
+    def swap(cur):
+        cur.execute("SELECT pg_get_serial_sequence('public.user_notifications', 'id')")
+        seq = cur.fetchone()[0]
+        cur.execute("LOCK TABLE public.user_notifications IN ACCESS EXCLUSIVE MODE")
+        # the parent's row triggers are cloned onto the partition when it is attached
+        cur.execute("DROP TRIGGER IF EXISTS user_notifications_events_ai ON public.user_notifications")
+        cur.execute("DROP TRIGGER IF EXISTS user_notifications_unread_aiud ON public.user_notifications")
+        cur.execute("ALTER TABLE public.user_notifications RENAME TO user_notifications_history")
+        # the concurrently built (id, created_at) index becomes the key ATTACH matches to the parent's
+        cur.execute("ALTER TABLE public.user_notifications_history DROP CONSTRAINT user_notifications_pkey")
+        cur.execute("""
+            ALTER TABLE public.user_notifications_history ADD CONSTRAINT user_notifications_history_pkey
+            PRIMARY KEY USING INDEX user_notifications_id_created_key
+        """)
+        for idx in ("idx_user_notifications_user_created",
+                    "idx_user_notifications_status", "idx_user_notifications_user_id"):
+            cur.execute(f"ALTER INDEX IF EXISTS public.{idx} RENAME TO {idx.replace('user_notifications', 'user_notifications_history', 1)}")
+        cur.execute(f"""
+            CREATE TABLE public.user_notifications(
+                id         BIGINT NOT NULL DEFAULT nextval('{seq}'::regclass),
+                user_id    INTEGER NOT NULL REFERENCES public.users(id) ON DELETE CASCADE,
+                order_id   INTEGER NULL REFERENCES public.orders(id) ON DELETE SET NULL,
+                title      TEXT NOT NULL,
+                body       TEXT NOT NULL,
+                status     TEXT NOT NULL DEFAULT 'unread',
+                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                read_at    TIMESTAMPTZ NULL,
+                PRIMARY KEY (id, created_at)
+            ) PARTITION BY RANGE (created_at)
+        """)
+        for k in range(0, NOTIFICATIONS_PARTITIONS_AHEAD + 1):
+            _notifications_partition(cur, *_month_add(hy, hm, k))
+        cur.execute("CREATE INDEX idx_user_notifications_user_created ON public.user_notifications(user_id, created_at DESC)")
+        cur.execute("CREATE INDEX idx_user_notifications_user_id ON public.user_notifications(user_id, id DESC)")
+        cur.execute("CREATE INDEX idx_user_notifications_status ON public.user_notifications(status)")
+        cur.execute("""
+            CREATE TRIGGER user_notifications_events_ai AFTER INSERT ON public.user_notifications
+            FOR EACH ROW EXECUTE FUNCTION public.smm_user_events_trg()
+        """)
+        cur.execute("""
+            CREATE TRIGGER user_notifications_unread_aiud
+            AFTER INSERT OR DELETE OR UPDATE OF status ON public.user_notifications
+            FOR EACH ROW EXECUTE FUNCTION public.smm_unread_counter_trg()
+        """)
+        # existing indexes, foreign keys and the validated check are reused: no scan, no index build
+        cur.execute(f"""
+            ALTER TABLE public.user_notifications ATTACH PARTITION public.user_notifications_history
+            FOR VALUES FROM (MINVALUE) TO ('{bound}')
+        """)
+        cur.execute("ALTER TABLE public.user_notifications_history DROP CONSTRAINT user_notifications_history_bound")
+        cur.execute(f"ALTER SEQUENCE {seq} OWNED BY public.user_notifications.id")
+    _locked_tx(conn, swap)
 
-    Body (flexible JSON), أمثلة للحقول المتوقعة:
-      {
-        "uid": "1234567",
-        "product": "pubg_uc" | "ludo_diamond" | "ludo_gold" | "itunes" | "atheer" | "asiacell" | "korek",
-        // لببجي/لودو:
-        "quantity": 650,        // 650 شدة - أو 810 الماسة - أو 56468 ذهب (كميات)
-        "price": 2.50,          // السعر بالدولار ويحتوي أجزاء
-        // أو لإصدار أقدم:
-        // "usd": 2.50           // في هذه الحالة نعتبره هو السعر
-        // لخدمات الرصيد/ايتونز:
-        // "usd": 5              // قيمة الرصيد بالدولار (5, 10, 15, ...)
-        "account_id": "PLAYER_ID(optional)"
-      }
+def _notifications_partition_maintenance() -> Dict[str, Any]:
+    created: List[str] = []
+    dropped: List[str] = []
+    conn = get_conn()
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_lock(%s)", (_NOTIF_PARTITION_LOCK_ID,))
+            if not cur.fetchone()[0]:
+                return {"skipped": True}
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT relkind FROM pg_class WHERE oid = 'public.user_notifications'::regclass")
+                if cur.fetchone()[0] != "p":
+                    return {"skipped": True}
+                now_ym = _utc_month(cur)
+                cur.execute("""
+                    SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i
+                    JOIN pg_class c ON c.oid = i.inhrelid
+                    WHERE i.inhparent = 'public.user_notifications'::regclass
+                    ORDER BY 1
+                """)
+                parts = cur.fetchall()
+            existing = {name for name, _ in parts}
+            history_upper = None
+            for name, bound in parts:
+                mm = re.search(r"FROM \(MINVALUE\) TO \('([^']+)'\)", bound or "")
+                if mm:
+                    history_upper = mm.group(1)
+            for k in range(0, NOTIFICATIONS_PARTITIONS_AHEAD + 1):
+                y, mo = _month_add(now_ym[0], now_ym[1], k)
+                if f"user_notifications_p{y:04d}{mo:02d}" not in existing:
+                    if history_upper is not None:
+                        # months still covered by the history partition
+                        with conn.cursor() as cur:
+                            cur.execute("SELECT %s::timestamptz < %s::timestamptz", (_month_start(y, mo), history_upper))
+                            if cur.fetchone()[0]:
+                                continue
+                    try:
+                        created.append(_locked_tx(conn, lambda cur, y=y, mo=mo: _notifications_partition(cur, y, mo), attempts=1))
+                    except psycopg2.Error as e:
+                        logger.warning("notification partition %04d-%02d not created: %s", y, mo, e)
+            if NOTIFICATIONS_RETENTION_MONTHS > 0:
+                cutoff = _month_start(*_month_add(now_ym[0], now_ym[1], -NOTIFICATIONS_RETENTION_MONTHS))
+                for name, bound in parts:
+                    mm = re.search(r"TO \('([^']+)'\)", bound or "")
+                    if not mm:
+                        continue
+                    def drop(cur, name=name, upper=mm.group(1)):
+                        cur.execute("SELECT %s::timestamptz <= %s::timestamptz", (upper, cutoff))
+                        if not cur.fetchone()[0]:
+                            return False
+                        # no status change can slip in between the correction and the drop
+                        cur.execute(f"LOCK TABLE public.{name} IN ACCESS EXCLUSIVE MODE")
+                        cur.execute(f"""
+                            UPDATE public.user_notification_state s
+                            SET unread_count = GREATEST(0, s.unread_count - x.n), updated_at = NOW()
+                            FROM (
+                                SELECT n.user_id, count(*) AS n
+                                FROM public.{name} n
+                                LEFT JOIN public.user_notification_state w ON w.user_id = n.user_id
+                                WHERE n.status = 'unread' AND n.id > COALESCE(w.last_read_id, 0)
+                                GROUP BY n.user_id
+                            ) x
+                            WHERE s.user_id = x.user_id
+                        """)
+                        cur.execute(f"DROP TABLE public.{name}")
+                        return True
+                    try:
+                        if _locked_tx(conn, drop, attempts=1):
+                            dropped.append(name)
+                    except psycopg2.Error as e:
+                        logger.warning("notification partition %s not dropped: %s", name, e)
+        finally:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (_NOTIF_PARTITION_LOCK_ID,))
+    finally:
+        conn.autocommit = False
+        put_conn(conn)
+    if created or dropped:
+        logger.info("notification partitions: created=%s dropped=%s", created, dropped)
+    return {"created": created, "dropped": dropped}
+
+def _notifications_maint_worker() -> None:
+    while True:
+        try:
+            _notifications_partition_maintenance()
+        except Exception as e:
+            logger.warning("notification partition maintenance failed: %s", e)
+        time.sleep(NOTIFICATIONS_MAINT_INTERVAL)
+
+@app.on_event("startup")
+def _startup_notifications_maint():
+    global _NOTIF_MAINT_STARTED
+    if _NOTIF_MAINT_STARTED:
+        return
+    _NOTIF_MAINT_STARTED = True
+    threading.Thread(target=_notifications_maint_worker, name="notif-partitions", daemon=True).start()
+
+@app.get("/api/user/by-uid/{uid}/events")
+async def user_events_stream(uid: str, request: Request, last_event_id: Optional[int] = None,
+                             last_event_id_header: Optional[str] = Header(None, alias="Last-Event-ID")):
     """
-    data = await _read_json_object(request)
+    Server-Sent Events: new notifications, order status changes and balance changes for one user.
+    Resumes after Last-Event-ID (header, or ?last_event_id=) within the user_events retention window;
+    without it the stream starts at the current position. Sends a comment heartbeat every SSE_HEARTBEAT seconds.
+    """
+    if not SSE_ENABLED:
+        raise HTTPException(404, "events disabled")
+    u = await _db_fetchrow("SELECT id FROM public.users WHERE uid=%s", uid)
+    if not u:
+        raise HTTPException(404, "user not found")
+    user_id = int(u["id"])
+    last = last_event_id
+    if last is None and last_event_id_header and last_event_id_header.strip().isdigit():
+        last = int(last_event_id_header.strip())
+    if last is None:
+        last = await _user_events_settled()
+    entry = user_event_hub.subscribe(user_id)
+    if entry is None:
+        raise HTTPException(503, "too many event streams")
+
+    async def stream():
+        nonlocal last
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                settled = await _user_events_settled()
+                rows = await _db_fetch("""
+                    SELECT id, kind, data FROM (
+                        SELECT id, kind, data FROM public.user_events WHERE user_id=%s AND id > %s AND id <= %s
+                        UNION ALL
+                        SELECT id, kind, data FROM public.user_events WHERE user_id IS NULL AND id > %s AND id <= %s
+                    ) e
+                    ORDER BY id
+                    LIMIT 200
+                """, user_id, last, settled, last, settled)
+                for r in rows:
+                    last = int(r["id"])
+                    data = r["data"] if isinstance(r["data"], str) else json.dumps(r["data"], ensure_ascii=False, default=str)
+                    yield f"id: {last}\nevent: {r['kind']}\ndata: {data}\n\n"
+                if len(rows) == 200:
+                    continue
+                if await request.is_disconnected():
+                    break
+                try:
+                    await asyncio.wait_for(entry[1].get(), SSE_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+        finally:
+            user_event_hub.unsubscribe(user_id, entry)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# =========================
+# Manual PAID orders (charge now, refund on reject)
+# =========================
+def _create_manual_paid_sync(data: Dict[str, Any]) -> Dict[str, Any]:
     uid = (data.get("uid") or "").strip()
     product_raw = (data.get("product") or data.get("type") or data.get("category") or data.get("title") or "").strip()
 
@@ -1749,20 +5232,6 @@ async def create_manual_paid(request: Request):
                         title = f"شراء رصيد كورك {usd}$"
 
             # ---------------------------------------------------------------------------
-            # ensure user & balance
-            cur.execute("SELECT id, balance, is_banned FROM public.users WHERE uid=%s", (uid,))
-            r = cur.fetchone()
-            if not r:
-                cur.execute("INSERT INTO public.users(uid) VALUES(%s) RETURNING id, 0.0, FALSE", (uid,))
-                r = cur.fetchone()
-            user_id, bal, banned = int(r[0]), float(r[1] or 0), bool(r[2])
-            if banned:
-                raise HTTPException(403, "user banned")
-            if bal < price:
-                raise HTTPException(400, "insufficient balance")
-
-            # charge
-            cur.execute("UPDATE public.users SET balance=balance-%s WHERE id=%s", (Decimal(price), user_id))
             # meta: نحتفظ بكل من السعر والكمية لألعاب ببجي/لودو، و usd للبقية
             meta: Dict[str, Any] = {"product": product, "account_id": account_id}
             if product in telco_products:
@@ -1770,11 +5239,7 @@ async def create_manual_paid(request: Request):
             else:
                 meta["usd"] = price  # للتوافق مع البيانات القديمة
                 meta["game_qty"] = game_qty
-                meta["price"] = price
-            cur.execute(
-                "INSERT INTO public.wallet_txns(user_id, amount, reason, meta) VALUES(%s,%s,%s,%s)",
-                (user_id, Decimal(-price), "order_charge", Json(meta))
-            )
+                meta["price"] = price
 
             # create pending manual order carrying the price for future refund if rejected
             payload: Dict[str, Any] = {"product": product, "charged": float(price)}
@@ -1787,26 +5252,61 @@ async def create_manual_paid(request: Request):
                 payload["account_id"] = account_id
 
             quantity_value = usd if product in telco_products else (game_qty or usd)
-            cur.execute(
-                """
-                INSERT INTO public.orders(user_id, title, quantity, price, status, payload, type)
-                VALUES(%s,%s,%s,%s,'Pending',%s,'manual')
-                RETURNING id
-                """
-                ,
-                (user_id, title, quantity_value, float(price), Json(payload))
-            )
-            oid = cur.fetchone()[0]
+
+            # ensure user, check balance, charge and create the order in one round trip
+            try:
+                cur.execute(
+                    """
+                    SELECT public.smm_charge_and_insert_order(
+                               u.user_id, u.balance, %s::numeric, %s, %s, NULL, NULL,
+                               %s::integer, %s::numeric, %s, 'manual'),
+                           u.user_id
+                    FROM public.smm_lock_user(%s, TRUE) u
+                    """,
+                    (float(price), Json(meta), title, int(quantity_value), float(price), Json(payload), uid)
+                )
+            except psycopg2.Error as e:
+                _raise_for_sqlstate(e)
+            oid, user_id = cur.fetchone()
+            result = {"ok": True, "order_id": oid, "charged": float(price)}
+            _idem_record(cur, result)
 
         # optional: immediate user notification (order received)
         body = title + (f" | ID: {account_id}" if account_id else "")
         _notify_user(conn, user_id, oid, "تم استلام طلبك", body)
         _notify_owner_new_order(conn, oid)
 
-        return {"ok": True, "order_id": oid, "charged": float(price)}
+        return result
     finally:
         put_conn(conn)
 
+@app.post("/api/orders/create/manual_paid")
+async def create_manual_paid(request: Request):
+    """
+    Creates a manual order (iTunes / Atheer / Asiacell / Korek / PUBG / Ludo) and atomically charges user balance.
+
+    هذه الـ endpoint تُستخدم لكل الطلبات اليدوية التي تخصم من المحفظة مباشرة ثم تعيد المبلغ
+    في حال قام المالك برفض الطلب لاحقًا.
+
+    Body (flexible JSON), أمثلة للحقول المتوقعة:
+      {
+        "uid": "1234567",
+        "product": "pubg_uc" | "ludo_diamond" | "ludo_gold" | "itunes" | "atheer" | "asiacell" | "korek",
+        // لببجي/لودو:
+        "quantity": 650,        // 650 شدة - أو 810 الماسة - أو 56468 ذهب (كميات)
+        "price": 2.50,          // السعر بالدولار ويحتوي أجزاء
+        // أو لإصدار أقدم:
+        // "usd": 2.50           // في هذه الحالة نعتبره هو السعر
+        // لخدمات الرصيد/ايتونز:
+        // "usd": 5              // قيمة الرصيد بالدولار (5, 10, 15, ...)
+        "account_id": "PLAYER_ID(optional)"
+      }
+    """
+    data = await _read_json_object(request)
+    key = _idempotency_key(request.headers.get("Idempotency-Key"), data)
+    params = {k: v for k, v in data.items() if k not in ("idempotency_key", "idempotencyKey")}
+    uid = str(data.get("uid") or "").strip()
+    return await _idempotent_call("order.manual_paid", uid, key, params, _create_manual_paid_sync, data)
 
 # Additional compat aliases for manual_paid (covering multiple potential paths from the app)
 @app.post("/api/create/manual_paid")
@@ -1878,10 +5378,9 @@ def admin_approve_order(oid: int, request: Request, x_admin_password: Optional[s
                 return {"ok": True, "status": "Done"}
 
             try:
-                resp = requests.post(
+                resp = _http("provider").post(
                     PROVIDER_API_URL,
                     data={"key": PROVIDER_API_KEY, "action": "add", "service": str(service_id), "link": link, "quantity": str(quantity)},
-                    timeout=25
                 )
             except Exception:
                 _refund_if_needed(cur, user_id, price, order_id)
@@ -1924,11 +5423,7 @@ def _refund_if_needed(cur, user_id: int, price: float, order_id: int):
             VALUES(%s,%s,%s,%s)
         """, (user_id, Decimal(price), "order_refund", Json({"order_id": order_id})))
 
-@app.post("/api/admin/orders/{oid}/deliver")
-async def admin_deliver(oid: int, request: Request, x_admin_password: Optional[str] = Header(None, alias="x-admin-password"), password: Optional[str] = None):
-    data = await _read_json_object(request)
-    _require_admin(_pick_admin_password(x_admin_password, password, data) or "")
-
+def _admin_deliver_sync(oid: int, data: Dict[str, Any]) -> Dict[str, Any]:
     code_val = (data.get("code") or "").strip()
     amount   = data.get("amount")
 
@@ -2000,6 +5495,12 @@ async def admin_deliver(oid: int, request: Request, x_admin_password: Optional[s
     finally:
         put_conn(conn)
 
+@app.post("/api/admin/orders/{oid}/deliver")
+async def admin_deliver(oid: int, request: Request, x_admin_password: Optional[str] = Header(None, alias="x-admin-password"), password: Optional[str] = None):
+    data = await _read_json_object(request)
+    _require_admin(_pick_admin_password(x_admin_password, password, data) or "")
+    return await _run_blocking(_admin_deliver_sync, oid, data)
+
 # Aliases for deliver / reject to match various admin clients
 @app.post("/api/admin/orders/{oid}/execute")
 async def admin_execute_alias(oid: int, request: Request, x_admin_password: Optional[str] = Header(None, alias="x-admin-password"), password: Optional[str] = None):
@@ -2009,13 +5510,7 @@ async def admin_execute_alias(oid: int, request: Request, x_admin_password: Opti
 async def admin_card_execute_alias(oid: int, request: Request, x_admin_password: Optional[str] = Header(None, alias="x-admin-password"), password: Optional[str] = None):
     return await admin_deliver(oid, request, x_admin_password, password)
 
-@app.post("/api/admin/orders/{oid}/reject")
-async def admin_reject(oid: int, request: Request, x_admin_password: Optional[str] = Header(None, alias="x-admin-password"), password: Optional[str] = None):
-    """
-    Rejects the order and refunds balance once if order is paid.
-    """
-    data = await _read_json_object(request)
-    _require_admin(_pick_admin_password(x_admin_password, password, data) or "")
+def _admin_reject_sync(oid: int, data: Dict[str, Any]) -> Dict[str, Any]:
     reason = (data.get("reason") or data.get("message") or "").strip()
 
     conn = get_conn()
@@ -2064,6 +5559,16 @@ async def admin_reject(oid: int, request: Request, x_admin_password: Optional[st
         return {"ok": True, "status": "Rejected"}
     finally:
         put_conn(conn)
+
+@app.post("/api/admin/orders/{oid}/reject")
+async def admin_reject(oid: int, request: Request, x_admin_password: Optional[str] = Header(None, alias="x-admin-password"), password: Optional[str] = None):
+    """
+    Rejects the order and refunds balance once if order is paid.
+    """
+    data = await _read_json_object(request)
+    _require_admin(_pick_admin_password(x_admin_password, password, data) or "")
+    return await _run_blocking(_admin_reject_sync, oid, data)
+
 @app.post("/api/admin/card/{oid}/reject")
 async def admin_card_reject_alias(oid: int, request: Request, x_admin_password: Optional[str] = Header(None, alias="x-admin-password"), password: Optional[str] = None):
     return await admin_reject(oid, request, x_admin_password, password)
@@ -2071,20 +5576,116 @@ async def admin_card_reject_alias(oid: int, request: Request, x_admin_password:
 # =========================
 # Admin pending buckets
 # =========================
+# Which admin list an order belongs to. The title-based lists are SQL
+# conditions on orders o; cards and services are decided per row in Python.
+# The pending endpoints and the live-queue long-poll both use these.
+_PENDING_SQL_FILTERS: Dict[str, str] = {
+    "itunes": "(LOWER(o.title) LIKE '%itunes%' OR o.title LIKE '%ايتونز%')",
+    "pubg": """(
+        LOWER(o.title) LIKE '%pubg%' OR
+        LOWER(o.title) LIKE '%bgmi%' OR
+        LOWER(o.title) LIKE '%uc%' OR
+        o.title LIKE '%شدات%' OR
+        o.title LIKE '%بيجي%' OR
+        o.title LIKE '%ببجي%'
+    )""",
+    "ludo": """(
+        LOWER(o.title) LIKE '%ludo%' OR
+        o.title LIKE '%لودو%' OR
+        o.title LIKE '%ليدو%'
+    )""",
+    "balances": """(
+        (
+            LOWER(o.title) LIKE '%asiacell%' OR
+            o.title LIKE '%أسيا%' OR
+            o.title LIKE '%اسياسيل%' OR
+            LOWER(o.title) LIKE '%korek%' OR
+            o.title LIKE '%كورك%' OR
+            o.title LIKE '%اثير%'
+        )
+        AND (
+            LOWER(o.title) LIKE '%voucher%' OR
+            LOWER(o.title) LIKE '%code%' OR
+            LOWER(o.title) LIKE '%card%' OR
+            o.title LIKE '%رمز%' OR
+            o.title LIKE '%كود%' OR
+            o.title LIKE '%بطاقة%' OR
+            o.title LIKE '%كارت%' OR
+            o.title LIKE '%شراء%'
+        )
+        AND (o.type IS NULL OR o.type <> 'topup_card')
+        AND NOT (
+            LOWER(o.title) LIKE '%topup%' OR
+            LOWER(o.title) LIKE '%top-up%' OR
+            LOWER(o.title) LIKE '%recharge%' OR
+            o.title LIKE '%شحن%' OR
+            o.title LIKE '%شحن عبر%' OR
+            o.title LIKE '%شحن اسيا%' OR
+            LOWER(o.title) LIKE '%direct%'
+        )
+        AND NOT (
+            LOWER(o.title) LIKE '%itunes%' OR
+            o.title LIKE '%ايتونز%'
+        )
+    )""",
+}
+
+def _norm_ar(s: str) -> str:
+    s = (s or "").lower()
+    trans = str.maketrans({"أ":"ا","إ":"ا","آ":"ا","ٱ":"ا","ى":"ي","ـ":""})
+    return s.translate(trans).replace(" ", "").replace("-", "")
+
+def _payload_dict(payload: Any) -> Dict[str, Any]:
+    if isinstance(payload, str):
+        try:
+            payload = json.loads(payload)
+        except Exception:
+            payload = None
+    return payload if isinstance(payload, dict) else {}
+
+def _card_telco(title: Optional[str], payload: Any) -> str:
+    """Telco of a card order ('' when the order is not one): cards list."""
+    telco = str(_payload_dict(payload).get("telco", "") or "")
+    if telco:
+        return telco
+    nt = _norm_ar(title or "")
+    if any(t in nt for t in ["اسياسيل","asiacell","asiacel","asiacelliq","asiacelliraq"]):
+        return "asiacell"
+    if any(t in nt for t in ["كورك","korek"]):
+        return "korek"
+    if any(t in nt for t in ["زين","zain","اثير","atheer"]):
+        return "atheer"
+    return ""
+
+def _is_provider_order(otype: Optional[str], service_id: Any, payload: Any) -> bool:
+    """API/provider-like order: services list."""
+    typ = str(otype or "").lower()
+    return (typ in ("provider", "api", "smm", "service")
+            or str(_payload_dict(payload).get("source", "")).lower() == "provider_form"
+            or service_id is not None)
+
+def _pending_buckets(o: Dict[str, Any]) -> List[str]:
+    """Lists an order row shows up in; the row carries one boolean per _PENDING_SQL_FILTERS key."""
+    out = [b for b in _PENDING_SQL_FILTERS if o.get(b)]
+    if _card_telco(o.get("title"), o.get("payload")):
+        out.append("cards")
+    if _is_provider_order(o.get("type"), o.get("service_id"), o.get("payload")):
+        out.append("services")
+    return out
+
 @app.get("/api/admin/pending/itunes")
 def admin_pending_itunes(x_admin_password: Optional[str] = Header(None, alias="x-admin-password"), password: Optional[str] = None):
     _require_admin(x_admin_password or password or "")
     conn = get_conn()
     try:
         with conn, conn.cursor() as cur:
-            cur.execute("""
+            cur.execute(f"""
                 SELECT o.id, o.title, o.quantity, o.price, o.status,
                        EXTRACT(EPOCH FROM o.created_at)*1000 AS created_at,
                        o.link, u.uid
                 FROM public.orders o
                 JOIN public.users u ON u.id = o.user_id
-                WHERE o.status='Pending'
-                  AND (LOWER(o.title) LIKE '%itunes%' OR o.title LIKE '%ايتونز%')
+                WHERE o.status='Pending' AND {_PENDING_SQL_FILTERS['itunes']}
                 ORDER BY o.id DESC
             """)
             rows = cur.fetchall()
@@ -2107,21 +5708,14 @@ def admin_pending_pubg(x_admin_password: Optional[str] = Header(None, alias="x-a
     conn = get_conn()
     try:
         with conn, conn.cursor() as cur:
-            cur.execute("""
+            cur.execute(f"""
                 SELECT o.id, o.title, o.quantity, o.price, o.status,
                        EXTRACT(EPOCH FROM o.created_at)*1000 AS created_at,
                        o.link, u.uid,
                        o.payload AS payload_text
                 FROM public.orders o
                 JOIN public.users u ON u.id = o.user_id
-                WHERE o.status='Pending' AND (
-                    LOWER(o.title) LIKE '%pubg%' OR
-                    LOWER(o.title) LIKE '%bgmi%' OR
-                    LOWER(o.title) LIKE '%uc%' OR
-                    o.title LIKE '%شدات%' OR
-                    o.title LIKE '%بيجي%' OR
-                    o.title LIKE '%ببجي%'
-                )
+                WHERE o.status='Pending' AND {_PENDING_SQL_FILTERS['pubg']}
                 ORDER BY o.id DESC
             """)
             rows = cur.fetchall()
@@ -2165,18 +5759,14 @@ def admin_pending_ludo(x_admin_password: Optional[str] = Header(None, alias="x-a
     conn = get_conn()
     try:
         with conn, conn.cursor() as cur:
-            cur.execute("""
+            cur.execute(f"""
                 SELECT o.id, o.title, o.quantity, o.price, o.status,
                        EXTRACT(EPOCH FROM o.created_at)*1000 AS created_at,
                        o.link, u.uid,
                        o.payload AS payload_text
                 FROM public.orders o
                 JOIN public.users u ON u.id = o.user_id
-                WHERE o.status='Pending' AND (
-                    LOWER(o.title) LIKE '%ludo%' OR
-                    o.title LIKE '%لودو%' OR
-                    o.title LIKE '%ليدو%'
-                )
+                WHERE o.status='Pending' AND {_PENDING_SQL_FILTERS['ludo']}
                 ORDER BY o.id DESC
             """)
             rows = cur.fetchall()
@@ -2230,35 +5820,13 @@ def admin_pending_cards(x_admin_password: Optional[str] = Header(None, alias="x-
             )
             rows = cur.fetchall()
         out = []
-        def _norm(s: str) -> str:
-            s = (s or "").lower()
-            trans = str.maketrans({"أ":"ا","إ":"ا","آ":"ا","ٱ":"ا","ى":"ي","ـ":""})
-            s = s.translate(trans)
-            return s.replace(" ", "").replace("-", "")
         for (oid, title, qty, price, status, created_at, link, uid, payload_text) in rows:
-            telco = ""
-            category = ""
-            payload_code = ""
-            if payload_text:
-                try:
-                    import json as _json
-                    j = _json.loads(payload_text) if isinstance(payload_text, str) else payload_text
-                    if isinstance(j, dict):
-                        telco = str(j.get("telco","") or "")
-                        category = str(j.get("category","") or "")
-                        payload_code = str(j.get("code") or j.get("card") or "")
-                except Exception:
-                    pass
-            nt = _norm(title or "")
-            if not telco:
-                if any(t in nt for t in ["اسياسيل","asiacell","asiacel","asiacelliq","asiacelliraq"]):
-                    telco = "asiacell"
-                elif any(t in nt for t in ["كورك","korek"]):
-                    telco = "korek"
-                elif any(t in nt for t in ["زين","zain","اثير","atheer"]):
-                    telco = "atheer"
+            telco = _card_telco(title, payload_text)
             if not telco:
                 continue
+            j = _payload_dict(payload_text)
+            category = str(j.get("category","") or "")
+            payload_code = str(j.get("code") or j.get("card") or "")
             d = {
                 "id": oid, "title": title, "quantity": qty,
                 "price": float(price or 0), "status": status,
@@ -2281,45 +5849,13 @@ def admin_pending_balances(x_admin_password: Optional[str] = Header(None, alias=
     conn = get_conn()
     try:
         with conn, conn.cursor() as cur:
-            cur.execute(r"""
+            cur.execute(f"""
                 SELECT o.id, o.title, o.quantity, o.price, o.status,
                        EXTRACT(EPOCH FROM o.created_at)*1000 AS created_at,
                        o.link, u.uid
                 FROM public.orders o
                 JOIN public.users u ON u.id = o.user_id
-                WHERE o.status='Pending'
-                  AND (
-                        LOWER(o.title) LIKE '%asiacell%' OR
-                        o.title LIKE '%أسيا%' OR
-                        o.title LIKE '%اسياسيل%' OR
-                        LOWER(o.title) LIKE '%korek%' OR
-                        o.title LIKE '%كورك%' OR
-                        o.title LIKE '%اثير%'
-                  )
-                  AND (
-                        LOWER(o.title) LIKE '%voucher%' OR
-                        LOWER(o.title) LIKE '%code%' OR
-                        LOWER(o.title) LIKE '%card%' OR
-                        o.title LIKE '%رمز%' OR
-                        o.title LIKE '%كود%' OR
-                        o.title LIKE '%بطاقة%' OR
-                        o.title LIKE '%كارت%' OR
-                        o.title LIKE '%شراء%'
-                  )
-                  AND (o.type IS NULL OR o.type <> 'topup_card')
-                  AND NOT (
-                        LOWER(o.title) LIKE '%topup%' OR
-                        LOWER(o.title) LIKE '%top-up%' OR
-                        LOWER(o.title) LIKE '%recharge%' OR
-                        o.title LIKE '%شحن%' OR
-                        o.title LIKE '%شحن عبر%' OR
-                        o.title LIKE '%شحن اسيا%' OR
-                        LOWER(o.title) LIKE '%direct%'
-                  )
-                  AND NOT (
-                        LOWER(o.title) LIKE '%itunes%' OR
-                        o.title LIKE '%ايتونز%'
-                  )
+                WHERE o.status='Pending' AND {_PENDING_SQL_FILTERS['balances']}
                 ORDER BY o.id DESC
             """)
             rows = cur.fetchall()
@@ -2372,9 +5908,7 @@ def admin_pending_services_endpoint(
         out: List[Dict[str, Any]] = []
         for (oid, created_at, status, title, qty, price, link, uid, service_id, otype, payload) in rows:
             # Only API/provider-like
-            typ = str(otype or "").lower()
-            is_api = typ in ("provider","api","smm","service") or (isinstance(payload, dict) and str(payload.get("source","")).lower()=="provider_form") or (service_id is not None)
-            if not is_api:
+            if not _is_provider_order(otype, service_id, payload):
                 continue
             try:
                 created_ms = int(created_at.timestamp() * 1000)
@@ -2398,24 +5932,7 @@ def admin_pending_services_endpoint(
 # =========================
 # Admin: wallet adjust + compatibility
 # =========================
-@app.post("/api/admin/users/{uid}/wallet/adjust")
-async def admin_wallet_adjust(uid: str, request: Request, x_admin_password: Optional[str] = Header(None, alias="x-admin-password"), password: Optional[str] = None):
-    data = await _read_json_object(request)
-    _require_admin(_pick_admin_password(x_admin_password, password, data) or "")
-
-    amount = data.get("amount")
-    reason = (data.get("reason") or "manual_adjust").strip()
-    no_notify = bool(data.get("no_notify") or False)
-
-    if amount is None:
-        raise HTTPException(400, "amount is required")
-    try:
-        amt = float(amount)
-    except Exception:
-        raise HTTPException(400, "amount must be a number")
-    if amt == 0:
-        return {"ok": True, "status": "noop"}
-
+def _admin_wallet_adjust_sync(uid: str, amt: float, reason: str, no_notify: bool) -> Dict[str, Any]:
     conn = get_conn()
     try:
         with conn, conn.cursor() as cur:
@@ -2442,6 +5959,26 @@ async def admin_wallet_adjust(uid: str, request: Request, x_admin_password: Opti
     finally:
         put_conn(conn)
 
+@app.post("/api/admin/users/{uid}/wallet/adjust")
+async def admin_wallet_adjust(uid: str, request: Request, x_admin_password: Optional[str] = Header(None, alias="x-admin-password"), password: Optional[str] = None):
+    data = await _read_json_object(request)
+    _require_admin(_pick_admin_password(x_admin_password, password, data) or "")
+
+    amount = data.get("amount")
+    reason = (data.get("reason") or "manual_adjust").strip()
+    no_notify = bool(data.get("no_notify") or False)
+
+    if amount is None:
+        raise HTTPException(400, "amount is required")
+    try:
+        amt = float(amount)
+    except Exception:
+        raise HTTPException(400, "amount must be a number")
+    if amt == 0:
+        return {"ok": True, "status": "noop"}
+
+    return await _run_blocking(_admin_wallet_adjust_sync, uid, amt, reason, no_notify)
+
 # Single "change" endpoint (positive = topup, negative = deduct) to match older apps
 @app.post("/api/admin/wallet/change")
 async def admin_wallet_change(request: Request, x_admin_password: Optional[str] = Header(None, alias="x-admin-password"), password: Optional[str] = None):
@@ -2458,10 +5995,10 @@ async def admin_wallet_change(request: Request, x_admin_password: Optional[str]
     direction = "topup" if amount >= 0 else "deduct"
     if direction == "deduct":
         body = WalletCompatIn(uid=uid, amount=abs(amount), reason=data.get("reason"))
-        return admin_wallet_deduct(body, x_admin_password or password or "")
+        return await _run_blocking(admin_wallet_deduct, body, x_admin_password or password or "")
     else:
         body = WalletCompatIn(uid=uid, amount=amount, reason=data.get("reason"))
-        return admin_wallet_topup(body, x_admin_password or password or "")
+        return await _run_blocking(admin_wallet_topup, body, x_admin_password or password or "")
 
 @app.post("/api/admin/wallet/topup")
 def admin_wallet_topup(body: WalletCompatIn, x_admin_password: Optional[str] = Header(None, alias="x-admin-password"), password: Optional[str] = None):
@@ -2495,7 +6032,6 @@ def admin_wallet_topup(body: WalletCompatIn, x_admin_password: Optional[str] = H
                 """,
                 (user_id, Decimal(amt), body.reason or "manual_topup", Json({"compat": "topup"}))
             )
-        _push_user(conn, user_id, None, "تمت إضافة رصيد", f"تمت إضافة {amt} إلى رصيدك.")
         return {"ok": True, "status": "adjusted", "amount": amt, "direction": "topup"}
     finally:
         put_conn(conn)
@@ -2534,7 +6070,6 @@ def admin_wallet_deduct(body: WalletCompatIn, x_admin_password: Optional[str] =
                 """,
                 (user_id, Decimal(-amt), body.reason or "manual_deduct", Json({"compat": "deduct"}))
             )
-        _push_user(conn, user_id, None, "تم خصم رصيد", f"تم خصم {amt} من رصيدك.")
         return {"ok": True, "status": "adjusted", "amount": -amt, "direction": "deduct"}
     finally:
         put_conn(conn)
@@ -2694,6 +6229,7 @@ class SvcOverrideIn(BaseModel):
     ui_key: str
     service_id: Optional[int] = None
 
+@schema_object("service_id_overrides")
 def _ensure_overrides_table(cur):
     cur.execute("""
         CREATE TABLE IF NOT EXISTS public.service_id_overrides(
@@ -2773,6 +6309,7 @@ class PricingIn(BaseModel):
 
 class PricingClearIn(BaseModel):
     ui_key: str
+@schema_object("service_pricing_overrides")
 def _ensure_pricing_table(cur):
     cur.execute("""
         CREATE TABLE IF NOT EXISTS public.service_pricing_overrides(
@@ -2785,6 +6322,7 @@ def _ensure_pricing_table(cur):
         )
     """)
 
+@schema_object("service_pricing_overrides", "mode")
 def _ensure_pricing_mode_column(cur):
     try:
         cur.execute("ALTER TABLE public.service_pricing_overrides ADD COLUMN IF NOT EXISTS mode TEXT NOT NULL DEFAULT 'per_k'")
@@ -2793,6 +6331,7 @@ def _ensure_pricing_mode_column(cur):
 
 
 # ===== Pricing version meta (for cache-busting on clear) =====
+@schema_object("service_pricing_meta")
 def _ensure_pricing_meta_table(cur):
     try:
         cur.execute("""
@@ -2825,6 +6364,7 @@ def _bump_pricing_version():
 
 
 
+@schema_object("pricing_bumps")
 def _ensure_pricing_bumps(cur):
     try:
         cur.execute("""
@@ -3042,7 +6582,7 @@ def public_pricing_version():
 
 
 @app.get("/api/public/pricing/bulk")
-def public_pricing_bulk(keys: str):
+async def public_pricing_bulk(keys: str):
     if not keys:
         return {"map": {}, "keys": []}
     key_list_raw = [k.strip() for k in keys.split(",") if k.strip()]
@@ -3050,61 +6590,34 @@ def public_pricing_bulk(keys: str):
         return {"map": {}, "keys": []}
     # prepare normalized variants
     norm_map = {k: _normalize_ui_key(k) for k in key_list_raw}
-    conn = get_conn()
-    try:
-        with conn, conn.cursor() as cur:
-            _ensure_pricing_table(cur)
-            try:
-                _ensure_pricing_mode_column(cur)
-            except Exception:
-                pass
-            # Exact matches first
-            cur.execute(
-                """
-                SELECT ui_key, price_per_k, min_qty, max_qty, COALESCE(mode,'per_k'),
-                       EXTRACT(EPOCH FROM COALESCE(updated_at, NOW()))*1000 AS updated_at
-                FROM public.service_pricing_overrides
-                WHERE ui_key = ANY(%s)
-                """,
-                (key_list_raw,)
-            )
-            rows = cur.fetchall() or []
-            by_ui = {ui_key: (ui_key, price_per_k, min_qty, max_qty, mode, updated_ms) for ui_key, price_per_k, min_qty, max_qty, mode, updated_ms in rows}
-
-            # normalization fallback
-            missing = [k for k in key_list_raw if k not in by_ui]
-            if missing:
-                cur.execute(
-                    """
-                    SELECT ui_key, price_per_k, min_qty, max_qty, COALESCE(mode,'per_k'),
-                           EXTRACT(EPOCH FROM COALESCE(updated_at, NOW()))*1000 AS updated_at
-                    FROM public.service_pricing_overrides
-                    """
-                )
-                all_rows = cur.fetchall() or []
-                by_norm = {_normalize_ui_key(ui_key): (ui_key, price_per_k, min_qty, max_qty, mode, updated_ms)
-                           for ui_key, price_per_k, min_qty, max_qty, mode, updated_ms in all_rows}
-                for mk in missing:
-                    nk = norm_map.get(mk)
-                    if nk and nk in by_norm:
-                        ui_key, price_per_k, min_qty, max_qty, mode, updated_ms = by_norm[nk]
-                        by_ui[mk] = (ui_key, price_per_k, min_qty, max_qty, mode, updated_ms)
-
-            out = {}
-            for original in key_list_raw:
-                row = by_ui.get(original)
-                if row:
-                    (_k, price_per_k, min_qty, max_qty, mode, updated_ms) = row
-                    out[original] = {
-                        "price_per_k": float(price_per_k) if price_per_k is not None else None,
-                        "min_qty": int(min_qty) if min_qty is not None else None,
-                        "max_qty": int(max_qty) if max_qty is not None else None,
-                        "mode": mode or "per_k",
-                        "updated_at": int(updated_ms or 0)
-                    }
-            return {"map": out, "keys": key_list_raw}
-    finally:
-        put_conn(conn)
+    norm_keys = sorted({v for v in norm_map.values() if v})
+    # exact matches and normalization fallback in one query (indexed on the normalized key)
+    rows = await _db_fetch(
+        """
+        SELECT ui_key, public.smm_normalize_ui_key(ui_key) AS norm_key,
+               price_per_k, min_qty, max_qty, COALESCE(mode,'per_k') AS mode,
+               EXTRACT(EPOCH FROM COALESCE(updated_at, NOW()))*1000 AS updated_at
+        FROM public.service_pricing_overrides
+        WHERE ui_key = ANY(%s) OR public.smm_normalize_ui_key(ui_key) = ANY(%s)
+        """,
+        key_list_raw, norm_keys
+    )
+    by_ui = {r["ui_key"]: r for r in rows}
+    by_norm = {r["norm_key"]: r for r in rows if r["norm_key"]}
+
+    out = {}
+    for original in key_list_raw:
+        row = by_ui.get(original) or by_norm.get(norm_map.get(original) or "")
+        if row:
+            price_per_k, min_qty, max_qty = row["price_per_k"], row["min_qty"], row["max_qty"]
+            out[original] = {
+                "price_per_k": float(price_per_k) if price_per_k is not None else None,
+                "min_qty": int(min_qty) if min_qty is not None else None,
+                "max_qty": int(max_qty) if max_qty is not None else None,
+                "mode": row["mode"] or "per_k",
+                "updated_at": int(row["updated_at"] or 0)
+            }
+    return {"map": out, "keys": key_list_raw}
 
 
 # =========================
@@ -3115,6 +6628,7 @@ class OrderPricingIn(BaseModel):
     price: Optional[float] = None  # flat price per order
     mode: Optional[str] = None     # reserved for future
 
+@schema_object("order_pricing_overrides")
 def _ensure_order_pricing_table(cur):
     cur.execute("""
         CREATE TABLE IF NOT EXISTS public.order_pricing_overrides(
@@ -3296,7 +6810,7 @@ async def _alias_set_price(oid: int, request: Request, x_admin_password: Optiona
     if "price" not in data:
         raise HTTPException(422, "price required")
     body = OrderPricingIn(order_id=oid, price=float(data["price"]))
-    return admin_set_order_pricing(body, x_admin_password, password)
+    return await _run_blocking(admin_set_order_pricing, body, x_admin_password, password)
 
 @app.post("/api/admin/orders/{oid}/set_quantity")
 async def _alias_set_qty(oid: int, request: Request, x_admin_password: Optional[str] = Header(None, alias="x-admin-password"), password: Optional[str] = None):
@@ -3304,7 +6818,7 @@ async def _alias_set_qty(oid: int, request: Request, x_admin_password: Optional[
     if "quantity" not in data:
         raise HTTPException(422, "quantity required")
     body = OrderQtyIn(order_id=oid, quantity=int(data["quantity"]), reprice=bool(data.get("reprice", False)))
-    return admin_set_order_quantity(body, x_admin_password, password)
+    return await _run_blocking(admin_set_order_quantity, body, x_admin_password, password)
 
 @app.post("/api/admin/order/set_price")
 async def _alias_set_price2(request: Request, x_admin_password: Optional[str] = Header(None, alias="x-admin-password"), password: Optional[str] = None):
@@ -3314,7 +6828,7 @@ async def _alias_set_price2(request: Request, x_admin_password: Optional[str] =
     if not oid or price is None:
         raise HTTPException(422, "order_id and price required")
     body = OrderPricingIn(order_id=oid, price=float(price))
-    return admin_set_order_pricing(body, x_admin_password, password)
+    return await _run_blocking(admin_set_order_pricing, body, x_admin_password, password)
 
 @app.post("/api/admin/order/set_qty")
 async def _alias_set_qty2(request: Request, x_admin_password: Optional[str] = Header(None, alias="x-admin-password"), password: Optional[str] = None):
@@ -3324,7 +6838,7 @@ async def _alias_set_qty2(request: Request, x_admin_password: Optional[str] = He
     if not oid or qty is None:
         raise HTTPException(422, "order_id and quantity required")
     body = OrderQtyIn(order_id=oid, quantity=int(qty), reprice=bool(data.get("reprice", False)))
-    return admin_set_order_quantity(body, x_admin_password, password)
+    return await _run_blocking(admin_set_order_quantity, body, x_admin_password, password)
 
 # ---- Service ID overrides aliases ----
 @app.get("/api/admin/services/overrides")
@@ -3411,17 +6925,41 @@ def _refund_order_if_needed(order_id: int) -> bool:
 # =========================
 from typing import Optional as _Optional
 
-@app.post("/api/admin/announcement/create")
-async def admin_announcement_create(request: Request, x_admin_password: _Optional[str] = Header(None, alias="x-admin-password"), password: _Optional[str] = None):
-    # Body JSON: { "body": "...", "title": "..."? }
-    # Requires: x-admin-password header or ?password= in query/body
-    data = await _read_json_object(request)
-    passwd = _pick_admin_password(x_admin_password, password, data)
-    _require_admin(passwd or "")
-    body = (data.get("body") or "").strip()
-    title = (data.get("title") or "").strip() or None
-    if not body:
-        raise HTTPException(422, "body is required")
+# Announcements are stored once and merged into each user's notification list
+# at read time (fan-out on read). feed_id comes from the user_notifications id
+# sequence, so announcement and per-user notification ids never collide and
+# the merged list orders by id. A user has read an announcement when its
+# feed_id is at or below the user's read watermark (user_notification_state,
+# see migration 18), or when a user_notification_reads row exists for it. Announcements created before this
+# migration were already copied into user_notifications (fanout_on_read=FALSE).
+@migration(13, "announcement_feed")
+def _m0013_announcement_feed(cur):
+    cur.execute("SELECT pg_get_serial_sequence('public.user_notifications', 'id')")
+    seq = cur.fetchone()[0]
+    cur.execute("ALTER TABLE public.announcements ADD COLUMN IF NOT EXISTS fanout_on_read BOOLEAN NOT NULL DEFAULT FALSE")
+    cur.execute("ALTER TABLE public.announcements ALTER COLUMN fanout_on_read SET DEFAULT TRUE")
+    cur.execute("ALTER TABLE public.announcements ADD COLUMN IF NOT EXISTS feed_id BIGINT")
+    cur.execute("UPDATE public.announcements SET feed_id = nextval(%s::regclass) WHERE feed_id IS NULL", (seq,))
+    cur.execute(f"ALTER TABLE public.announcements ALTER COLUMN feed_id SET DEFAULT nextval('{seq}'::regclass)")
+    cur.execute("ALTER TABLE public.announcements ALTER COLUMN feed_id SET NOT NULL")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS uq_announcements_feed_id ON public.announcements(feed_id)")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS public.user_notification_state(
+            user_id       INTEGER PRIMARY KEY REFERENCES public.users(id) ON DELETE CASCADE,
+            ann_read_upto BIGINT NOT NULL DEFAULT 0,
+            updated_at    TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS public.user_notification_reads(
+            user_id INTEGER NOT NULL REFERENCES public.users(id) ON DELETE CASCADE,
+            feed_id BIGINT NOT NULL REFERENCES public.announcements(feed_id) ON DELETE CASCADE,
+            read_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (user_id, feed_id)
+        );
+    """)
+
+def _announcement_create_sync(title: Optional[str], body: str) -> Dict[str, Any]:
     conn = get_conn()
     try:
         with conn, conn.cursor() as cur:
@@ -3432,39 +6970,30 @@ async def admin_announcement_create(request: Request, x_admin_password: _Optiona
             )
             ann_id = cur.fetchone()[0]
 
-            # 2) bulk insert notifications for ALL users (no 'active' column dependency)
-            cur.execute(
-                """
-                INSERT INTO public.user_notifications (user_id, order_id, title, body, status, created_at)
-                SELECT id AS user_id, NULL, %s AS title, %s AS body, 'unread', NOW()
-                FROM public.users
-                """,
-                (title or 'إعلان', body)
-            )
+            # 2) no per-user rows: list_user_notifications merges announcements at read time
 
-            # 3) collect DISTINCT FCM tokens (no dependency on users.active)
-            cur.execute(
-                """
-                SELECT DISTINCT d.fcm_token
-                FROM public.user_devices d
-                WHERE d.fcm_token IS NOT NULL AND d.fcm_token <> ''
-                """
-            )
-            tokens = [r[0] for r in cur.fetchall()]
+            # 3) queue the FCM fan-out; broadcast workers page through user_devices
+            job_id, tokens = _enqueue_broadcast(cur, "announcement", title or 'إعلان', body, ann_id)
 
-        # 4) fan-out FCM
-        sent = 0
-        for t in tokens:
-            try:
-                _fcm_send_push(t, title or 'إعلان', body, None)
-                sent += 1
-            except Exception as fe:
-                logger.exception("announcement FCM send failed: %s", fe)
-        logger.info("Announcement broadcast: id=%s, tokens_sent=%s", ann_id, sent)
-        return {"ok": True, "id": ann_id, "broadcasted": True, "tokens": sent}
+        _wake_broadcast_workers()
+        logger.info("Announcement broadcast queued: id=%s, job=%s, tokens=%s", ann_id, job_id, tokens)
+        return {"ok": True, "id": ann_id, "broadcasted": True, "tokens": tokens, "job_id": job_id}
     finally:
         put_conn(conn)
 
+@app.post("/api/admin/announcement/create")
+async def admin_announcement_create(request: Request, x_admin_password: _Optional[str] = Header(None, alias="x-admin-password"), password: _Optional[str] = None):
+    # Body JSON: { "body": "...", "title": "..."? }
+    # Requires: x-admin-password header or ?password= in query/body
+    data = await _read_json_object(request)
+    passwd = _pick_admin_password(x_admin_password, password, data)
+    _require_admin(passwd or "")
+    body = (data.get("body") or "").strip()
+    title = (data.get("title") or "").strip() or None
+    if not body:
+        raise HTTPException(422, "body is required")
+    return await _run_blocking(_announcement_create_sync, title, body)
+
 @app.get("/api/public/announcements")
 def public_announcements(limit: int = 50):
     # Returns: [ { "title": str|null, "body": str, "created_at": <epoch_ms> }, ... ]
@@ -3492,16 +7021,16 @@ def public_announcements(limit: int = 50):
         put_conn(conn)
 
 @app.get("/api/admin/provider/balance")
-def admin_provider_balance(x_admin_password: _Optional[str] = Header(None, alias="x-admin-password"), password: _Optional[str] = None):
+async def admin_provider_balance(x_admin_password: _Optional[str] = Header(None, alias="x-admin-password"), password: _Optional[str] = None):
     # Returns provider balance as JSON: { "balance": <number> }
     # Uses PROVIDER_API_URL / PROVIDER_API_KEY if configured (kd1s compatible).
     _require_admin(_pick_admin_password(x_admin_password, password) or "")
     bal = 0.0
     try:
-        resp = requests.post(
+        resp = await _http("provider").apost(
             PROVIDER_API_URL,
             data={"key": PROVIDER_API_KEY, "action": "balance"},
-            timeout=20
+            timeout=20.0
         )
         txt = (resp.text or "").strip()
         # Try JSON first
@@ -3552,6 +7081,7 @@ def test_push_user(uid: str, title: str = "إشعار تجريبي", body: str =
 from pydantic import BaseModel
 import asyncio, logging, os
 
+@schema_object("settings")
 def _ensure_settings_table(cur):
     cur.execute("""
         CREATE TABLE IF NOT EXISTS public.settings(
@@ -3575,6 +7105,16 @@ def _get_flag(cur, key: str, default: bool = False) -> bool:
     except Exception:
         return default
 
+def _read_flags(*keys: str) -> List[bool]:
+    """Read several settings flags on a pooled connection (for the daemons, via _run_blocking)."""
+    conn = get_conn()
+    try:
+        with conn, conn.cursor() as cur:
+            _ensure_settings_table(cur)
+            return [_get_flag(cur, k, False) for k in keys]
+    finally:
+        put_conn(conn)
+
 def _set_flag(cur, key: str, enabled: bool) -> None:
     cur.execute("""
         INSERT INTO public.settings(key, value, updated_at)
@@ -3636,11 +7176,10 @@ def _auto_exec_process_one(conn, rec):
     oid = rec["order_id"]; user_id = rec["user_id"]
     service_id = rec["service_id"]; link = rec["link"]; qty = rec["quantity"]; eff_price = rec["price"]
     try:
-        resp = requests.post(
+        resp = _http("provider").post(
             PROVIDER_API_URL,
             data={"key": PROVIDER_API_KEY, "action": "add",
                   "service": str(service_id), "link": link, "quantity": str(qty)},
-            timeout=25
         )
     except Exception:
         with conn, conn.cursor() as cur:
@@ -3780,25 +7319,14 @@ async def _auto_exec_daemon():
     _AUTOEXEC_DAEMON_STARTED = True
     while True:
         try:
-            conn = get_conn()
-            try:
-                with conn, conn.cursor() as cur:
-                    _ensure_settings_table(cur)
-                    enabled = _get_flag(cur, "auto_exec_api", False)
-            finally:
-                put_conn(conn)
+            (enabled,) = await _run_blocking(_read_flags, "auto_exec_api")
 
             if not enabled:
                 await asyncio.sleep(AUTOEXEC_IDLE_SLEEP)
                 continue
 
-            processed_any = False
-            conn = get_conn()
-            try:
-                batch = _auto_exec_run(conn, limit=AUTOEXEC_LIMIT)
-                processed_any = bool(batch)
-            finally:
-                put_conn(conn)
+            batch = await _run_blocking(_with_conn, _auto_exec_run, limit=AUTOEXEC_LIMIT)
+            processed_any = bool(batch)
 
             await asyncio.sleep(0.5 if processed_any else AUTOEXEC_LOOP_SLEEP)
 
@@ -3845,15 +7373,7 @@ def admin_announcements_list(limit: int = 200, x_admin_password: str | None = He
     finally:
         put_conn(conn)
 
-@app.post("/api/admin/announcements/{aid}/update")
-@app.post("/api/admin/announcement/{aid}/update")
-async def admin_announcement_update(aid: int, request: Request, x_admin_password: str | None = Header(None, alias="x-admin-password"), password: str | None = None):
-    data = await _read_json_object(request)
-    _require_admin(_pick_admin_password(x_admin_password, password, data) or "")
-    title = data.get("title", None)
-    body  = data.get("body",  None)
-    if title is None and body is None:
-        raise HTTPException(422, "title or body required")
+def _announcement_update_sync(aid: int, title: Optional[str], body: Optional[str]) -> Dict[str, Any]:
     conn = get_conn()
     try:
         with conn, conn.cursor() as cur:
@@ -3874,6 +7394,17 @@ async def admin_announcement_update(aid: int, request: Request, x_admin_password
     finally:
         put_conn(conn)
 
+@app.post("/api/admin/announcements/{aid}/update")
+@app.post("/api/admin/announcement/{aid}/update")
+async def admin_announcement_update(aid: int, request: Request, x_admin_password: str | None = Header(None, alias="x-admin-password"), password: str | None = None):
+    data = await _read_json_object(request)
+    _require_admin(_pick_admin_password(x_admin_password, password, data) or "")
+    title = data.get("title", None)
+    body  = data.get("body",  None)
+    if title is None and body is None:
+        raise HTTPException(422, "title or body required")
+    return await _run_blocking(_announcement_update_sync, aid, title, body)
+
 @app.post("/api/admin/announcements/{aid}/delete")
 @app.post("/api/admin/announcement/{aid}/delete")
 def admin_announcement_delete(aid: int, x_admin_password: str | None = Header(None, alias="x-admin-password"), password: str | None = None):
@@ -4150,20 +7681,12 @@ def _notify_pricing_change_via_tokens(conn, ui_key: str, before: Optional[tuple]
 
         body = " — ".join(messages)
 
-        # إرسال FCM
-        with conn.cursor() as cur:
-            cur.execute("SELECT DISTINCT d.fcm_token FROM public.user_devices d WHERE d.fcm_token IS NOT NULL AND d.fcm_token <> ''")
-            tokens = [r[0] for r in (cur.fetchall() or [])]
-
-        sent = 0
-        for t in tokens:
-            try:
-                _fcm_send_push(t, title, body, None)
-                sent += 1
-            except Exception as fe:
-                logger.exception("pricing_change FCM send failed: %s", fe)
+        # إرسال FCM (background broadcast job)
+        with conn, conn.cursor() as cur:
+            job_id, tokens = _enqueue_broadcast(cur, "pricing", title, body)
+        _wake_broadcast_workers()
 
-        logger.info("pricing.change.notify ui_key=%s tokens=%d sent=%d", ui_key, len(tokens), sent)
+        logger.info("pricing.change.notify ui_key=%s tokens=%d job=%s", ui_key, tokens, job_id)
     except Exception as e:
         logger.exception("notify pricing change failed: %s", e)
 
@@ -4180,6 +7703,7 @@ def _notify_pricing_change_via_tokens(conn, ui_key: str, before: Optional[tuple]
 from typing import Optional, List, Any, Dict
 
 # ----- Tables ensure -----
+@schema_object("itunes_codes")
 def _ensure_itunes_codes_table(cur):
     cur.execute("""
         CREATE TABLE IF NOT EXISTS public.itunes_codes(
@@ -4195,6 +7719,7 @@ def _ensure_itunes_codes_table(cur):
     cur.execute("CREATE INDEX IF NOT EXISTS idx_itunes_codes_used ON public.itunes_codes(used)")
     cur.execute("CREATE INDEX IF NOT EXISTS idx_itunes_codes_cat ON public.itunes_codes(category)")
 
+@schema_object("card_codes")
 def _ensure_card_codes_table(cur):
     cur.execute("""
         CREATE TABLE IF NOT EXISTS public.card_codes(
@@ -4625,23 +8150,13 @@ async def _itunes_autoexec_daemon(poll_interval: float = 1.5):
     logger.info("daemon[itunes]: started")
     while True:
         try:
-            conn = get_conn()
-            try:
-                with conn, conn.cursor() as cur:
-                    _ensure_settings_table(cur)
-                    enabled = _get_flag(cur, "auto_exec_itunes", False)
-            finally:
-                put_conn(conn)
+            (enabled,) = await _run_blocking(_read_flags, "auto_exec_itunes")
             if not enabled:
                 await _ae_asyncio.sleep(3.0)
                 continue
 
             # try to process one
-            try:
-                conn = get_conn()
-                out = _itunes_auto_process_one(conn)
-            finally:
-                put_conn(conn)
+            out = await _run_blocking(_with_conn, _itunes_auto_process_one)
             if not out or out.get("skipped"):
                 await _ae_asyncio.sleep(poll_interval)
             else:
@@ -4658,23 +8173,13 @@ async def _cards_autoexec_daemon(poll_interval: float = 1.5):
     logger.info("daemon[cards]: started")
     while True:
         try:
-            conn = get_conn()
-            try:
-                with conn, conn.cursor() as cur:
-                    _ensure_settings_table(cur)
-                    enabled = _get_flag(cur, "auto_exec_cards", False)
-            finally:
-                put_conn(conn)
+            (enabled,) = await _run_blocking(_read_flags, "auto_exec_cards")
             if not enabled:
                 await _ae_asyncio.sleep(3.0)
                 continue
 
             # try to process one
-            try:
-                conn = get_conn()
-                out = _cards_auto_process_one(conn)
-            finally:
-                put_conn(conn)
+            out = await _run_blocking(_with_conn, _cards_auto_process_one)
             if not out or out.get("skipped"):
                 await _ae_asyncio.sleep(poll_interval)
             else:
@@ -4690,14 +8195,7 @@ async def _autoexec_bootstrap():
     On startup, if any auto-exec flags are enabled, ensure daemons are running.
     """
     try:
-        conn = get_conn()
-        try:
-            with conn, conn.cursor() as cur:
-                _ensure_settings_table(cur)
-                itunes_on = _get_flag(cur, "auto_exec_itunes", False)
-                cards_on  = _get_flag(cur, "auto_exec_cards", False)
-        finally:
-            put_conn(conn)
+        itunes_on, cards_on = await _run_blocking(_read_flags, "auto_exec_itunes", "auto_exec_cards")
 
         if itunes_on:
             _ae_bg_create_task(_itunes_autoexec_daemon())
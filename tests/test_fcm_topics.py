@@ -0,0 +1,147 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+
+class FcmStandIn:
+    """Local FCM/IID stand-in: records every request and answers from per-path handlers."""
+
+    def __init__(self):
+        self.requests = []
+        self.routes = {}
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                raw = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                body = json.loads(raw or b"{}")
+                stand_in.requests.append({"path": self.path, "headers": dict(self.headers), "json": body})
+                status, reply = stand_in.routes.get(self.path, lambda b: (404, {"error": "no route"}))(body)
+                out = json.dumps(reply).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def fcm(m, monkeypatch):
+    srv = FcmStandIn().start()
+    monkeypatch.setattr(m, "FCM_API_BASE", srv.base)
+    monkeypatch.setattr(m, "IID_API_BASE", srv.base)
+    monkeypatch.setattr(m, "FCM_SERVER_KEY", "legacy-key")
+    monkeypatch.setattr(m.fcm_auth, "sa_info", None)
+    yield srv
+    srv.stop()
+
+
+def _batch_add_results(errors_by_token):
+    def reply(body):
+        return 200, {"results": [({"error": errors_by_token[t]} if errors_by_token.get(t) else {})
+                                 for t in body["registration_tokens"]]}
+    return reply
+
+
+def test_topic_send_legacy(m, fcm):
+    fcm.routes["/fcm/send"] = lambda body: (200, {"message_id": 1})
+
+    assert m._fcm_send_topic("all", "hello", "world") == (m.FCM_SENT, "")
+
+    (req,) = fcm.requests
+    assert req["headers"]["Authorization"] == "key=legacy-key"
+    assert req["json"]["to"] == "/topics/all"
+    assert req["json"]["notification"] == {"title": "hello", "body": "world"}
+
+
+def test_topic_send_v1(m, fcm, monkeypatch):
+    monkeypatch.setattr(m.fcm_auth, "sa_info", {"project_id": "demo"})
+    monkeypatch.setattr(m.fcm_auth, "token", lambda: "access-1")
+    fcm.routes["/v1/projects/demo/messages:send"] = lambda body: (200, {"name": "projects/demo/messages/1"})
+
+    assert m._fcm_send_topic("all", "hello", "world") == (m.FCM_SENT, "")
+
+    (req,) = fcm.requests
+    assert req["headers"]["Authorization"] == "Bearer access-1"
+    assert req["json"]["message"]["topic"] == "all"
+    assert "token" not in req["json"]["message"]
+
+
+def test_topic_send_transient_failure_is_retryable(m, fcm):
+    fcm.routes["/fcm/send"] = lambda body: (503, {"error": "unavailable"})
+
+    outcome, detail = m._fcm_send_topic("all", "hello", "world")
+    assert outcome == m.FCM_RETRY
+    assert detail == "503"
+
+
+def test_batch_add_splits_ok_invalid_skipped(m, fcm):
+    fcm.routes["/iid/v1:batchAdd"] = _batch_add_results({
+        "bad-1": "NOT_FOUND",
+        "bad-2": "INVALID_ARGUMENT",
+        "busy": "INTERNAL",
+    })
+
+    ok, invalid = m._fcm_topic_subscribe(["good-1", "bad-1", "busy", "good-2", "bad-2"], "all")
+
+    assert ok == ["good-1", "good-2"]
+    assert invalid == ["bad-1", "bad-2"]
+    (req,) = fcm.requests
+    assert req["headers"]["Authorization"] == "key=legacy-key"
+    assert req["json"] == {"to": "/topics/all",
+                           "registration_tokens": ["good-1", "bad-1", "busy", "good-2", "bad-2"]}
+
+
+def test_batch_add_whole_request_failure_raises(m, fcm):
+    fcm.routes["/iid/v1:batchAdd"] = lambda body: (500, {"error": "backend"})
+
+    with pytest.raises(RuntimeError, match="batchAdd 500"):
+        m._fcm_topic_subscribe(["good-1"], "all")
+
+
+def test_topic_sync_pass_marks_ok_and_prunes_invalid(m, fcm, stub_pool):
+    devices = [(1, "good-1"), (2, "bad-1"), (3, "busy"), (4, "good-2")]
+
+    def responder(sql, params):
+        if "FROM public.user_devices" in sql and "SELECT" in sql:
+            after_id, limit = params
+            return [d for d in devices if d[0] > after_id][:limit]
+        return []
+
+    stub_pool.responder = responder
+    fcm.routes["/iid/v1:batchAdd"] = _batch_add_results({"bad-1": "NOT_FOUND", "busy": "UNAVAILABLE"})
+
+    stats = m._topic_sync_pass()
+
+    assert stats == {"subscribed": 2, "invalid": 1, "skipped": 1}
+    marked = [p for s, p in stub_pool.statements if s.startswith("UPDATE public.user_devices SET topic_subscribed_at")]
+    assert marked == [(["good-1", "good-2"],)]
+    pruned = [p for s, p in stub_pool.statements if s.startswith("DELETE FROM public.user_devices")]
+    assert pruned == [(["bad-1"],)]
+    cleared = [p for s, p in stub_pool.statements if s.startswith("UPDATE public.users SET fcm_token=NULL")]
+    assert cleared == [(["bad-1"],)]
+
+
+def test_legacy_send_queues_unregistered_token_for_pruning(m, fcm, monkeypatch):
+    monkeypatch.setattr(m, "_bad_tokens", set())
+    fcm.routes["/fcm/send"] = lambda body: (200, {"results": [{"error": "NotRegistered"}]})
+
+    assert m._fcm_deliver("gone-1", "t", "b", None) == (m.FCM_INVALID, "NotRegistered")
+    assert m._bad_tokens == {"gone-1"}
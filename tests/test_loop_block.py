@@ -0,0 +1,79 @@
+import asyncio
+import threading
+
+import pytest
+from fastapi.testclient import TestClient
+
+ADMIN = {"x-admin-password": "test-admin"}
+
+# (method path, json body, headers, module attribute the handler hands its DB work to, stub result)
+ASYNC_HANDLERS = [
+    ("/api/orders/create/manual_paid", {"uid": "u1", "product": "itunes", "usd": 5}, {},
+     "_create_manual_paid_sync", {"ok": True}),
+    ("/api/orders/create/provider", {"uid": "u1", "service_id": 1, "service_name": "likes", "link": "x", "quantity": 100, "price": 1},
+     {}, "_provider_order_flow", {"ok": True}),
+    ("/api/orders/create", {"uid": "u1", "service_id": 1, "service_name": "likes", "link": "x", "quantity": 100, "price": 1},
+     {}, "_provider_order_flow", {"ok": True}),
+    ("/api/wallet/asiacell/submit", {"uid": "u1", "card": "1234567890123456"}, {},
+     "_asiacell_order_flow", {"ok": True}),
+    ("/api/asiacell/submit", {"uid": "u1", "card": "1234567890123456"}, {},
+     "_asiacell_order_flow", {"ok": True}),
+    ("/api/wallet/paytabs/create", {"uid": "u1", "usd": 5}, {},
+     "_paytabs_create_flow", {"payment_url": "https://pay.example/1"}),
+    ("/api/wallet/paytabs/callback", {"cart_id": "WALLET-u1-1", "payment_result": {"response_status": "A"}, "cart_amount": 1320},
+     {}, "_paytabs_credit_sync", {"ok": True}),
+    ("/api/admin/orders/7/deliver", {}, ADMIN, "_admin_deliver_sync", {"ok": True}),
+    ("/api/admin/orders/7/reject", {}, ADMIN, "_admin_reject_sync", {"ok": True}),
+    ("/api/admin/users/u1/wallet/adjust", {"amount": 5}, ADMIN, "_admin_wallet_adjust_sync", {"ok": True}),
+    ("/api/admin/wallet/change", {"uid": "u1", "amount": 5}, ADMIN, "admin_wallet_topup", {"ok": True}),
+    ("/api/admin/wallet/change", {"uid": "u1", "amount": -5}, ADMIN, "admin_wallet_deduct", {"ok": True}),
+    ("/api/admin/orders/7/set_price", {"price": 2}, ADMIN, "admin_set_order_pricing", {"ok": True}),
+    ("/api/admin/orders/7/set_quantity", {"quantity": 3}, ADMIN, "admin_set_order_quantity", {"ok": True}),
+    ("/api/admin/announcement/create", {"title": "t", "body": "b"}, ADMIN, "_announcement_create_sync", {"ok": True}),
+    ("/api/admin/announcement/7/update", {"body": "b"}, ADMIN, "_announcement_update_sync", {"ok": True}),
+]
+
+
+@pytest.mark.parametrize("path,body,headers,target,result", ASYNC_HANDLERS,
+                         ids=[f"{c[0]}:{c[3]}" for c in ASYNC_HANDLERS])
+def test_async_handler_runs_db_work_in_blocking_executor(m, stub_pool, monkeypatch, path, body, headers, target, result):
+    calls = []
+
+    def recorder(*args, **kwargs):
+        conn = m.get_conn()  # raises under LOOP_BLOCK_GUARD=raise if still on the loop
+        m.put_conn(conn)
+        calls.append(threading.current_thread().name)
+        return dict(result)
+
+    monkeypatch.setattr(m, target, recorder)
+    client = TestClient(m.app, raise_server_exceptions=True)
+    resp = client.post(path, json=body, headers=headers)
+
+    assert resp.status_code == 200, resp.text
+    assert len(calls) == 1
+    assert calls[0].startswith("blocking"), calls
+    assert stub_pool.checkouts and all(name.startswith("blocking") for name in stub_pool.checkouts)
+
+
+def test_get_conn_inside_coroutine_raises(m, stub_pool):
+    async def handler():
+        return m.get_conn()
+
+    with pytest.raises(RuntimeError, match="blocking DB call on the event loop"):
+        asyncio.run(handler())
+    assert stub_pool.checkouts == []
+
+
+def test_get_conn_via_run_blocking_is_allowed(m, stub_pool):
+    async def handler():
+        conn = await m._run_blocking(m.get_conn)
+        m.put_conn(conn)
+
+    asyncio.run(handler())
+    assert len(stub_pool.checkouts) == 1
+    assert stub_pool.checkouts[0].startswith("blocking")
+
+
+def test_get_conn_off_the_loop_is_allowed(m, stub_pool):
+    m.put_conn(m.get_conn())
+    assert stub_pool.checkouts == [threading.current_thread().name]